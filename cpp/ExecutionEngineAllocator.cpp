@@ -0,0 +1,378 @@
+//===- ExecutionEngineAllocator.cpp - Allocators for JIT'd code -----------===//
+//
+// Part of the LLVM Project, under the Apache License v2.0 with LLVM Exceptions.
+// See https://llvm.org/LICENSE.txt for license information.
+// SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+//
+//===----------------------------------------------------------------------===//
+
+#include "ExecutionEngineAllocator.h"
+
+#include "llvm/Support/MathExtras.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cstdlib>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+namespace py = pybind11;
+using namespace mlir::python;
+
+namespace {
+
+class Allocator;
+
+/// Stored in front of every allocation, so that `mlirGenericFree` can find the
+/// allocator (and the block) an allocation came from.
+struct alignas(16) Header {
+  Allocator *owner;
+  void *base;
+  uint64_t size;
+  uint64_t capacity;
+};
+
+constexpr uint64_t kMinAlignment = alignof(Header);
+
+/// Base class of the allocators: keeps the counters and the headers; the
+/// subclasses provide the blocks of memory. Allocators are reference counted
+/// by their live allocations: once Python drops an allocator, it is destroyed
+/// when its last allocation is freed.
+class Allocator {
+public:
+  virtual ~Allocator() = default;
+
+  void *allocate(uint64_t size, uint64_t alignment) {
+    alignment = std::max(alignment, kMinAlignment);
+    uint64_t capacity = size + sizeof(Header) +
+                        (alignment > kMinAlignment ? alignment : 0);
+    void *base;
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      base = allocateBlock(capacity);
+      if (!base)
+        return nullptr;
+      ++numAllocations;
+      ++liveAllocations;
+      liveBytes += size;
+      totalBytes += size;
+      peakBytes = std::max(peakBytes, liveBytes);
+    }
+    uintptr_t ptr = llvm::alignTo(
+        reinterpret_cast<uintptr_t>(base) + sizeof(Header), alignment);
+    Header *header = reinterpret_cast<Header *>(ptr) - 1;
+    *header = {this, base, size, capacity};
+    return reinterpret_cast<void *>(ptr);
+  }
+
+  static void deallocate(void *ptr) {
+    Header *header = reinterpret_cast<Header *>(ptr) - 1;
+    header->owner->deallocate(*header);
+  }
+
+  /// Called when Python drops its reference to the allocator.
+  void retire() {
+    bool destroy;
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      retired = true;
+      destroy = liveAllocations == 0;
+    }
+    if (destroy)
+      delete this;
+  }
+
+  /// Releases the memory the allocator holds on to without it being in use
+  /// (pools) or, for arenas, all of it.
+  virtual void reset() {}
+
+  py::dict getStats() {
+    std::lock_guard<std::mutex> lock(mutex);
+    py::dict stats;
+    stats["live_bytes"] = liveBytes;
+    stats["live_allocations"] = liveAllocations;
+    stats["peak_bytes"] = peakBytes;
+    stats["total_bytes"] = totalBytes;
+    stats["num_allocations"] = numAllocations;
+    stats["num_frees"] = numFrees;
+    addStats(stats);
+    return stats;
+  }
+
+  void resetStats() {
+    std::lock_guard<std::mutex> lock(mutex);
+    totalBytes = numAllocations = numFrees = 0;
+    peakBytes = liveBytes;
+  }
+
+protected:
+  /// Returns a block of at least `capacity` bytes, aligned to kMinAlignment;
+  /// may round `capacity` up. Called with `mutex` held.
+  virtual void *allocateBlock(uint64_t &capacity) = 0;
+  /// Called with `mutex` held.
+  virtual void deallocateBlock(void *base, uint64_t capacity) = 0;
+  virtual void addStats(py::dict &stats) {}
+
+  std::mutex mutex;
+  uint64_t liveBytes = 0;
+  uint64_t liveAllocations = 0;
+  uint64_t peakBytes = 0;
+  uint64_t totalBytes = 0;
+  uint64_t numAllocations = 0;
+  uint64_t numFrees = 0;
+
+private:
+  void deallocate(const Header &header) {
+    bool destroy;
+    {
+      std::lock_guard<std::mutex> lock(mutex);
+      --liveAllocations;
+      liveBytes -= header.size;
+      ++numFrees;
+      deallocateBlock(header.base, header.capacity);
+      destroy = retired && liveAllocations == 0;
+    }
+    if (destroy)
+      delete this;
+  }
+
+  bool retired = false;
+};
+
+struct RetireAllocator {
+  void operator()(Allocator *allocator) const { allocator->retire(); }
+};
+using AllocatorHolder = std::unique_ptr<Allocator, RetireAllocator>;
+
+/// malloc/free with counters.
+class MallocAllocator : public Allocator {
+protected:
+  void *allocateBlock(uint64_t &capacity) override {
+    return std::malloc(capacity);
+  }
+  void deallocateBlock(void *base, uint64_t capacity) override {
+    std::free(base);
+  }
+};
+
+/// Bump-pointer allocation from blocks of `blockSize` bytes; frees only count
+/// and `reset` releases everything at once, e.g. the scratch memory of an
+/// invocation, once every allocation has been freed.
+class ArenaAllocator : public Allocator {
+public:
+  explicit ArenaAllocator(uint64_t blockSize) : blockSize(blockSize) {}
+  ~ArenaAllocator() override {
+    for (auto &block : blocks)
+      std::free(block.first);
+  }
+
+  /// Refuses to reset while allocations are live: their memory would be
+  /// reused, and freeing them afterwards would read their freed headers.
+  void reset() override {
+    std::lock_guard<std::mutex> lock(mutex);
+    if (liveAllocations)
+      throw std::runtime_error(
+          "Can't reset an arena with " + std::to_string(liveAllocations) +
+          " live allocations; free them (e.g. the OwnedMemRef results) first");
+    // Keep the first block around for the next round of allocations.
+    for (size_t i = 1; i < blocks.size(); ++i)
+      std::free(blocks[i].first);
+    blocks.resize(std::min<size_t>(blocks.size(), 1));
+    cursor = blocks.empty() ? nullptr : blocks[0].first;
+    end = blocks.empty() ? nullptr : blocks[0].first + blocks[0].second;
+  }
+
+protected:
+  void *allocateBlock(uint64_t &capacity) override {
+    capacity = llvm::alignTo(capacity, kMinAlignment);
+    if (!cursor || static_cast<uint64_t>(end - cursor) < capacity) {
+      uint64_t size = std::max(blockSize, capacity);
+      char *block = static_cast<char *>(std::malloc(size));
+      if (!block)
+        return nullptr;
+      blocks.emplace_back(block, size);
+      cursor = block;
+      end = block + size;
+    }
+    void *ptr = cursor;
+    cursor += capacity;
+    return ptr;
+  }
+  void deallocateBlock(void *base, uint64_t capacity) override {}
+  void addStats(py::dict &stats) override {
+    uint64_t reserved = 0;
+    for (auto &block : blocks)
+      reserved += block.second;
+    stats["reserved_bytes"] = reserved;
+  }
+
+private:
+  uint64_t blockSize;
+  std::vector<std::pair<char *, uint64_t>> blocks;
+  char *cursor = nullptr;
+  char *end = nullptr;
+};
+
+/// Power-of-two size classes with free lists, so that buffers are reused
+/// across invocations. Blocks larger than `maxPooledSize` bypass the pool.
+class PoolAllocator : public Allocator {
+public:
+  explicit PoolAllocator(uint64_t maxPooledSize)
+      : maxPooledSize(maxPooledSize),
+        freeLists(llvm::Log2_64_Ceil(std::max(maxPooledSize, kMinBlock)) + 1) {}
+  ~PoolAllocator() override { releaseCached(); }
+
+  void reset() override {
+    std::lock_guard<std::mutex> lock(mutex);
+    releaseCached();
+  }
+
+protected:
+  void *allocateBlock(uint64_t &capacity) override {
+    capacity = llvm::PowerOf2Ceil(std::max(capacity, kMinBlock));
+    if (capacity > maxPooledSize)
+      return std::malloc(capacity);
+    auto &freeList = freeLists[llvm::Log2_64(capacity)];
+    if (freeList.empty())
+      return std::malloc(capacity);
+    void *block = freeList.back();
+    freeList.pop_back();
+    cachedBytes -= capacity;
+    return block;
+  }
+  void deallocateBlock(void *base, uint64_t capacity) override {
+    if (capacity > maxPooledSize) {
+      std::free(base);
+      return;
+    }
+    freeLists[llvm::Log2_64(capacity)].push_back(base);
+    cachedBytes += capacity;
+  }
+  void addStats(py::dict &stats) override { stats["cached_bytes"] = cachedBytes; }
+
+private:
+  static constexpr uint64_t kMinBlock = 64;
+
+  void releaseCached() {
+    for (auto &freeList : freeLists) {
+      for (void *block : freeList)
+        std::free(block);
+      freeList.clear();
+    }
+    cachedBytes = 0;
+  }
+
+  uint64_t maxPooledSize;
+  std::vector<std::vector<void *>> freeLists;
+  uint64_t cachedBytes = 0;
+};
+
+/// Allocator used when no allocator is active on the calling thread.
+std::atomic<Allocator *> defaultAllocator{nullptr};
+/// Allocators activated with `with allocator:` on this thread, innermost last.
+thread_local std::vector<Allocator *> activeAllocators;
+
+Allocator *getAllocator() {
+  if (!activeAllocators.empty())
+    return activeAllocators.back();
+  return defaultAllocator.load(std::memory_order_acquire);
+}
+
+/// Allocator of the allocations made while no allocator is set, so that
+/// every allocation has a header.
+Allocator &getFallbackAllocator() {
+  static Allocator *fallback = new MallocAllocator();
+  return *fallback;
+}
+
+} // namespace
+
+void *mlir::python::mlirGenericAlloc(uint64_t size) {
+  return mlirGenericAlignedAlloc(kMinAlignment, size);
+}
+
+void *mlir::python::mlirGenericAlignedAlloc(uint64_t alignment,
+                                            uint64_t size) {
+  Allocator *allocator = getAllocator();
+  return (allocator ? *allocator : getFallbackAllocator())
+      .allocate(size, alignment);
+}
+
+void mlir::python::mlirGenericFree(void *ptr) {
+  if (ptr)
+    Allocator::deallocate(ptr);
+}
+
+void mlir::python::populateAllocatorBindings(py::module &m) {
+  py::class_<Allocator, AllocatorHolder>(m, "Allocator", py::module_local())
+      .def_static(
+          "malloc", []() { return AllocatorHolder(new MallocAllocator()); },
+          "An allocator forwarding to malloc/free, with counters.")
+      .def_static(
+          "arena",
+          [](uint64_t blockSize) {
+            return AllocatorHolder(new ArenaAllocator(blockSize));
+          },
+          py::arg("block_size") = 1 << 20,
+          "A bump-pointer arena allocating blocks of `block_size` bytes. "
+          "Frees don't release memory; `reset` releases it all at once, "
+          "once every allocation has been freed.")
+      .def_static(
+          "pool",
+          [](uint64_t maxPooledSize) {
+            return AllocatorHolder(new PoolAllocator(maxPooledSize));
+          },
+          py::arg("max_pooled_size") = 1 << 24,
+          "An allocator with power-of-two size classes whose freed blocks are "
+          "kept for reuse; blocks above `max_pooled_size` bytes bypass it.")
+      .def("stats", &Allocator::getStats,
+           "Return the counters (live/peak/total bytes, allocation and free "
+           "counts, plus `reserved_bytes` for arenas and `cached_bytes` for "
+           "pools) as a dict.")
+      .def("reset_stats", &Allocator::resetStats,
+           "Reset the cumulative counters; the peak restarts at the live "
+           "bytes.")
+      .def("reset", &Allocator::reset,
+           "Release the memory held by the allocator: the free lists of a "
+           "pool, or the blocks of an arena, which raises a RuntimeError "
+           "while any of its allocations is live.")
+      .def("__enter__",
+           [](Allocator &self) {
+             activeAllocators.push_back(&self);
+             return &self;
+           },
+           py::return_value_policy::reference)
+      .def("__exit__",
+           [](Allocator &self, py::args) {
+             // Leaving another allocator's block would leave the wrong one
+             // active (or pop from an empty stack).
+             if (activeAllocators.empty() || activeAllocators.back() != &self)
+               throw std::runtime_error(
+                   "Exiting an allocator that isn't the innermost active one "
+                   "on this thread.");
+             activeAllocators.pop_back();
+           })
+      .def_static(
+          "set_default",
+          [m](py::object allocator) {
+            // Keep the allocator alive for as long as it is the default.
+            m.attr("_default_allocator") = allocator;
+            defaultAllocator.store(allocator.is_none()
+                                       ? nullptr
+                                       : allocator.cast<Allocator *>(),
+                                   std::memory_order_release);
+          },
+          py::arg("allocator").none(true),
+          "Allocate from `allocator` on threads without an active allocator "
+          "(see `with allocator:`); None restores malloc.");
+
+  m.def(
+      "allocator_free",
+      [](uintptr_t ptr) { mlirGenericFree(reinterpret_cast<void *>(ptr)); },
+      py::arg("ptr"),
+      "Free memory allocated by JIT'd code through the generic allocation "
+      "functions, e.g. a returned memref.");
+}
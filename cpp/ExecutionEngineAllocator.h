@@ -0,0 +1,33 @@
+//===- ExecutionEngineAllocator.h - Allocators for JIT'd code -------------===//
+//
+// Part of the LLVM Project, under the Apache License v2.0 with LLVM Exceptions.
+// See https://llvm.org/LICENSE.txt for license information.
+// SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+//
+//===----------------------------------------------------------------------===//
+
+#ifndef MLIR_BINDINGS_PYTHON_EXECUTIONENGINEALLOCATOR_H
+#define MLIR_BINDINGS_PYTHON_EXECUTIONENGINEALLOCATOR_H
+
+#include <pybind11/pybind11.h>
+
+#include <cstdint>
+
+namespace mlir {
+namespace python {
+
+/// The generic allocation functions called by code lowered with
+/// `convert-memref-to-llvm{use-generic-functions=1}`. They allocate from the
+/// allocator active on the calling thread, or else from the default one, or
+/// else with malloc; `mlirGenericFree` returns memory to the allocator it
+/// came from.
+void *mlirGenericAlloc(uint64_t size);
+void *mlirGenericAlignedAlloc(uint64_t alignment, uint64_t size);
+void mlirGenericFree(void *ptr);
+
+void populateAllocatorBindings(pybind11::module &m);
+
+} // namespace python
+} // namespace mlir
+
+#endif // MLIR_BINDINGS_PYTHON_EXECUTIONENGINEALLOCATOR_H
@@ -6,8 +6,33 @@
 //
 //===----------------------------------------------------------------------===//
 
+#include "ExecutionEngineAllocator.h"
 #include "mlir-c/ExecutionEngine.h"
 #include "mlir/Bindings/Python/PybindAdaptors.h"
+#include "mlir/CAPI/ExecutionEngine.h"
+#include "mlir/CAPI/IR.h"
+#include "mlir/ExecutionEngine/ExecutionEngine.h"
+#include "mlir/ExecutionEngine/OptUtils.h"
+#include "mlir/Target/LLVMIR/Dialect/LLVMIR/LLVMToLLVMIRTranslation.h"
+#include "mlir/Target/LLVMIR/Export.h"
+#include "llvm/ADT/DenseSet.h"
+#include "llvm/ADT/STLExtras.h"
+#include "llvm/ADT/SmallVector.h"
+#include "llvm/Config/llvm-config.h"
+#include "llvm/ExecutionEngine/Orc/JITTargetMachineBuilder.h"
+#include "llvm/IR/IRBuilder.h"
+#include "llvm/IR/LegacyPassManager.h"
+#include "llvm/MC/MCSubtargetInfo.h"
+#include "llvm/Support/FileSystem.h"
+#include "llvm/Support/TargetSelect.h"
+#include "llvm/Support/raw_ostream.h"
+#include "llvm/Target/TargetMachine.h"
+
+#include <pybind11/stl.h>
+
+#include <algorithm>
+#include <cstring>
+#include <optional>
 
 namespace py = pybind11;
 using namespace mlir;
@@ -61,23 +86,389 @@ private:
   std::vector<py::object> referencedObjects;
 };
 
+/// The target to generate code for; unset fields default to the host's.
+/// `cpu` and `features` may be "native" for the host's CPU and features; if
+/// only `cpu` is given, the features are those of that CPU.
+struct JITTargetOptions {
+  std::optional<std::string> triple;
+  std::optional<std::string> cpu;
+  std::optional<std::string> features;
+  std::optional<unsigned> preferVectorWidth;
+};
+
+/// Returns the builder of the target machine for `options`. Raises a
+/// ValueError if the target isn't valid or can't run on the host.
+llvm::orc::JITTargetMachineBuilder
+getTargetMachineBuilder(const JITTargetOptions &options) {
+  auto hostOrError = llvm::orc::JITTargetMachineBuilder::detectHost();
+  if (!hostOrError)
+    throw std::runtime_error(llvm::toString(hostOrError.takeError()));
+  llvm::orc::JITTargetMachineBuilder builder = std::move(*hostOrError);
+  if (options.triple) {
+    llvm::Triple triple(llvm::Triple::normalize(*options.triple));
+    const llvm::Triple &host = builder.getTargetTriple();
+    // The generated code is executed in this process.
+    if (triple.getArch() != host.getArch() || triple.getOS() != host.getOS())
+      throw py::value_error("Target triple '" + *options.triple +
+                            "' can't be executed on the host (" +
+                            host.str() + ").");
+    llvm::orc::JITTargetMachineBuilder tripleBuilder(triple);
+    tripleBuilder.setCPU(builder.getCPU());
+    tripleBuilder.getFeatures() = builder.getFeatures();
+    builder = std::move(tripleBuilder);
+  }
+  if (options.cpu && *options.cpu != "native") {
+    builder.setCPU(*options.cpu);
+    builder.getFeatures() = llvm::SubtargetFeatures();
+  }
+  if (options.features && *options.features != "native")
+    builder.getFeatures() = llvm::SubtargetFeatures(*options.features);
+  return builder;
+}
+
+void initializeNativeTarget() {
+  static bool initOnce = [] {
+    llvm::InitializeNativeTarget();
+    llvm::InitializeNativeTargetAsmParser();
+    llvm::InitializeNativeTargetAsmPrinter();
+    return true;
+  }();
+  (void)initOnce;
+}
+
+/// Creates the target machine of `builder`, which was returned by
+/// `getTargetMachineBuilder(options)`. Raises a ValueError if the CPU of
+/// `options` is unknown.
+std::unique_ptr<llvm::TargetMachine>
+createTargetMachine(llvm::orc::JITTargetMachineBuilder builder,
+                    const JITTargetOptions &options) {
+  auto tmOrError = builder.createTargetMachine();
+  if (!tmOrError)
+    throw py::value_error(llvm::toString(tmOrError.takeError()));
+  std::unique_ptr<llvm::TargetMachine> targetMachine = std::move(*tmOrError);
+  if (options.cpu && !targetMachine->getMCSubtargetInfo()->isCPUStringValid(
+                         targetMachine->getTargetCPU()))
+    throw py::value_error("Unknown target CPU '" + *options.cpu + "'.");
+  return targetMachine;
+}
+
+using FunctionAttributes =
+    llvm::SmallVector<std::pair<std::string, std::string>, 3>;
+
+/// Returns the function attributes overriding the host target with the CPU,
+/// features and preferred vector width of `options`.
+FunctionAttributes getTargetAttributes(const JITTargetOptions &options,
+                                       const llvm::TargetMachine &tm) {
+  FunctionAttributes attributes;
+  if (options.cpu || options.features) {
+    attributes.emplace_back("target-cpu", tm.getTargetCPU().str());
+    attributes.emplace_back("target-features",
+                            tm.getTargetFeatureString().str());
+  }
+  if (options.preferVectorWidth)
+    attributes.emplace_back("prefer-vector-width",
+                            std::to_string(*options.preferVectorWidth));
+  return attributes;
+}
+
+void addFunctionAttributes(llvm::Module *llvmModule,
+                           const FunctionAttributes &attributes) {
+  for (llvm::Function &func : *llvmModule) {
+    if (func.isDeclaration())
+      continue;
+    for (const auto &attribute : attributes)
+      func.addFnAttr(attribute.first, attribute.second);
+  }
+}
+
+/// Same as `mlirExecutionEngineCreate`, but with control over the target and
+/// the JIT event listeners. The target CPU and features are set as function
+/// attributes (together with the preferred vector width), which take
+/// precedence over the host target the JIT compiles for. The GDB listener
+/// registers the generated code with an attached debugger (or a profiler
+/// reading the GDB JIT interface), the perf listener writes `jit-<pid>.dump`
+/// files for `perf inject --jit` (only if LLVM was built with LLVM_USE_PERF).
+MlirExecutionEngine
+createExecutionEngine(MlirModule module, int optLevel,
+                      llvm::ArrayRef<llvm::StringRef> libPaths,
+                      const JITTargetOptions &targetOptions,
+                      bool enableGDBListener, bool enablePerfListener) {
+  initializeNativeTarget();
+  registerLLVMDialectTranslation(*unwrap(module)->getContext());
+
+  std::unique_ptr<llvm::TargetMachine> targetMachine = createTargetMachine(
+      getTargetMachineBuilder(targetOptions), targetOptions);
+  FunctionAttributes attributes =
+      getTargetAttributes(targetOptions, *targetMachine);
+  std::string triple = targetMachine->getTargetTriple().str();
+
+  auto llvmOptLevel = static_cast<llvm::CodeGenOpt::Level>(optLevel);
+  ExecutionEngineOptions jitOptions;
+  auto optimize = makeOptimizingTransformer(optLevel, /*sizeLevel=*/0,
+                                            targetMachine.get());
+  // `jitOptions.transformer` is a function_ref, which owns nothing: the
+  // transformer must be a named local that outlives `ExecutionEngine::create`,
+  // which calls it. So do the target machine the optimizations query and the
+  // other locals it refers to.
+  auto transformer = [&](llvm::Module *llvmModule) {
+    llvmModule->setTargetTriple(triple);
+    addFunctionAttributes(llvmModule, attributes);
+    return optimize(llvmModule);
+  };
+  jitOptions.transformer = transformer;
+  jitOptions.jitCodeGenOptLevel = llvmOptLevel;
+  jitOptions.sharedLibPaths = libPaths;
+  jitOptions.enableObjectCache = true;
+  jitOptions.enableGDBNotificationListener = enableGDBListener;
+  jitOptions.enablePerfNotificationListener = enablePerfListener;
+  auto jitOrError = ExecutionEngine::create(unwrap(module), jitOptions);
+  if (!jitOrError) {
+    llvm::consumeError(jitOrError.takeError());
+    return MlirExecutionEngine{nullptr};
+  }
+  return wrap(jitOrError->release());
+}
+
+/// Defines, for every function of `llvmModule`, the packed wrapper
+/// `_mlir_<name>(i8 **)` taking the arguments and the result slot as an array
+/// of pointers, the same way the ExecutionEngine does before compiling.
+void packFunctionArguments(llvm::Module *llvmModule) {
+  llvm::LLVMContext &ctx = llvmModule->getContext();
+  llvm::IRBuilder<> builder(ctx);
+  llvm::SmallVector<llvm::Function *, 8> funcs;
+  for (llvm::Function &func : *llvmModule)
+    if (!func.isDeclaration())
+      funcs.push_back(&func);
+  for (llvm::Function *func : funcs) {
+    auto *packedType = llvm::FunctionType::get(
+        builder.getVoidTy(), builder.getInt8PtrTy()->getPointerTo(),
+        /*isVarArg=*/false);
+    auto *packedFunc = llvm::cast<llvm::Function>(
+        llvmModule
+            ->getOrInsertFunction("_mlir_" + func->getName().str(), packedType)
+            .getCallee());
+    builder.SetInsertPoint(llvm::BasicBlock::Create(ctx, "", packedFunc));
+    llvm::Value *argList = packedFunc->arg_begin();
+    auto loadArgPointer = [&](size_t index, llvm::Type *type) {
+      llvm::Value *argPtrPtr = builder.CreateGEP(
+          builder.getInt8PtrTy(), argList, builder.getInt64(index));
+      llvm::Value *argPtr =
+          builder.CreateLoad(builder.getInt8PtrTy(), argPtrPtr);
+      return builder.CreateBitCast(argPtr, type->getPointerTo());
+    };
+    llvm::SmallVector<llvm::Value *, 8> args;
+    for (const auto &arg : llvm::enumerate(func->args())) {
+      llvm::Type *argType = arg.value().getType();
+      args.push_back(
+          builder.CreateLoad(argType, loadArgPointer(arg.index(), argType)));
+    }
+    llvm::Value *result = builder.CreateCall(func, args);
+    if (!result->getType()->isVoidTy())
+      builder.CreateStore(result,
+                          loadArgPointer(args.size(), result->getType()));
+    builder.CreateRetVoid();
+  }
+}
+
+/// Compiles `module`, which must only contain dialects that can be translated
+/// to LLVM, to the object file `path` like the ExecutionEngine would (packed
+/// wrappers included) for the target of `targetOptions`, but with position
+/// independent code, so that the object can be linked into a shared library:
+/// the JIT generates code with a static relocation model on ELF.
+void compileToObjectFile(MlirModule module, const std::string &path,
+                         int optLevel, const JITTargetOptions &targetOptions) {
+  initializeNativeTarget();
+  registerLLVMDialectTranslation(*unwrap(module)->getContext());
+
+  llvm::orc::JITTargetMachineBuilder builder =
+      getTargetMachineBuilder(targetOptions);
+  builder.setRelocationModel(llvm::Reloc::PIC_);
+  builder.setCodeGenOptLevel(static_cast<llvm::CodeGenOpt::Level>(optLevel));
+  std::unique_ptr<llvm::TargetMachine> targetMachine =
+      createTargetMachine(std::move(builder), targetOptions);
+
+  llvm::LLVMContext llvmContext;
+  std::unique_ptr<llvm::Module> llvmModule =
+      translateModuleToLLVMIR(unwrap(module), llvmContext);
+  if (!llvmModule)
+    throw std::runtime_error("Failed to translate the module to LLVM IR.");
+  llvmModule->setDataLayout(targetMachine->createDataLayout());
+  llvmModule->setTargetTriple(targetMachine->getTargetTriple().str());
+  packFunctionArguments(llvmModule.get());
+  addFunctionAttributes(llvmModule.get(),
+                        getTargetAttributes(targetOptions, *targetMachine));
+  auto optimize = makeOptimizingTransformer(optLevel, /*sizeLevel=*/0,
+                                            targetMachine.get());
+  if (llvm::Error error = optimize(llvmModule.get()))
+    throw std::runtime_error(llvm::toString(std::move(error)));
+
+  std::error_code ec;
+  llvm::raw_fd_ostream os(path, ec, llvm::sys::fs::OF_None);
+  if (ec)
+    throw std::runtime_error("Failed to open '" + path +
+                             "': " + ec.message());
+  llvm::legacy::PassManager codegen;
+  if (targetMachine->addPassesToEmitFile(codegen, os, nullptr,
+                                         llvm::CGFT_ObjectFile))
+    throw std::runtime_error("The target can't emit object files.");
+  codegen.run(*llvmModule);
+}
+
+/// Returns the triple, CPU name and feature string of the host.
+py::dict getHostTarget() {
+  auto hostOrError = llvm::orc::JITTargetMachineBuilder::detectHost();
+  if (!hostOrError)
+    throw std::runtime_error(llvm::toString(hostOrError.takeError()));
+  py::dict target;
+  target["triple"] = hostOrError->getTargetTriple().str();
+  target["cpu"] = hostOrError->getCPU();
+  target["features"] = hostOrError->getFeatures().getString();
+  return target;
+}
+
+/// Calls the packed function `funcPtr` (a `void(void **)` wrapper generated by
+/// the ExecutionEngine) on `args`. Objects supporting the buffer protocol are
+/// passed as memrefs: a ranked (or, with `unranked`, an unranked) memref
+/// descriptor viewing the buffer in place (any strides that are multiples of
+/// the element size, including negative and zero ones) is built here, and the
+/// argument is a pointer to it, as expected by functions with a C interface.
+/// The descriptor points at element [0, ..., 0] with a zero offset, like
+/// `mlir.runtime.get_memref_layout`, so callees with the identity layout,
+/// which ignore the offset and strides, read contiguous buffers correctly.
+/// Python ints and floats are passed as 64-bit integers and doubles, NumPy
+/// scalars as their own type. The GIL is released during the call.
+void invokePacked(uintptr_t funcPtr, const py::tuple &args, bool unranked) {
+  // Leaked on purpose: it must not be destroyed after the interpreter.
+  static py::handle numpyGeneric =
+      py::module_::import("numpy").attr("generic").release();
+  // Layout of the argument words: for a memref, the ranked descriptor
+  // [allocated, aligned, offset, sizes..., strides...], then, if unranked,
+  // the unranked descriptor [rank, descriptor], then the argument (the
+  // pointer to the descriptor); for a scalar, only the argument.
+  llvm::SmallVector<py::buffer_info, 8> buffers;
+  llvm::SmallVector<int, 8> bufferIndex;
+  size_t numWords = 0;
+  for (py::handle arg : args) {
+    if (py::isinstance<py::int_>(arg) || py::isinstance<py::float_>(arg) ||
+        py::isinstance(arg, numpyGeneric)) {
+      bufferIndex.push_back(-1);
+      numWords += 1;
+      continue;
+    }
+    if (!PyObject_CheckBuffer(arg.ptr()))
+      throw py::type_error(
+          "Arguments must be scalars or support the buffer protocol, got " +
+          py::repr(arg).cast<std::string>());
+    py::buffer_info info = py::reinterpret_borrow<py::buffer>(arg).request();
+    for (py::ssize_t stride : info.strides)
+      if (stride % info.itemsize)
+        throw py::value_error("Buffer strides must be a multiple of the "
+                              "element size to be passed as a memref.");
+    numWords += 3 + 2 * info.ndim + (unranked ? 2 : 0) + 1;
+    bufferIndex.push_back(buffers.size());
+    buffers.push_back(std::move(info));
+  }
+
+  llvm::SmallVector<int64_t, 64> words(numWords);
+  llvm::SmallVector<void *, 8> packedArgs;
+  int64_t *word = words.data();
+  for (size_t i = 0, e = args.size(); i < e; ++i) {
+    py::handle arg = args[i];
+    if (bufferIndex[i] < 0) {
+      if (py::isinstance<py::float_>(arg)) {
+        double value = arg.cast<double>();
+        std::memcpy(word, &value, sizeof(value));
+      } else if (py::isinstance<py::int_>(arg)) {
+        *word = arg.cast<int64_t>();
+      } else {
+        py::buffer_info scalar =
+            py::reinterpret_borrow<py::buffer>(arg).request();
+        std::memcpy(word, scalar.ptr,
+                    std::min<size_t>(scalar.itemsize, sizeof(int64_t)));
+      }
+      packedArgs.push_back(word++);
+      continue;
+    }
+    const py::buffer_info &info = buffers[bufferIndex[i]];
+    int64_t *descriptor = word;
+    descriptor[0] = descriptor[1] = reinterpret_cast<intptr_t>(info.ptr);
+    descriptor[2] = 0;
+    for (py::ssize_t d = 0; d < info.ndim; ++d) {
+      descriptor[3 + d] = info.shape[d];
+      descriptor[3 + info.ndim + d] = info.strides[d] / info.itemsize;
+    }
+    word += 3 + 2 * info.ndim;
+    void *argValue = descriptor;
+    if (unranked) {
+      word[0] = info.ndim;
+      word[1] = reinterpret_cast<intptr_t>(descriptor);
+      argValue = word;
+      word += 2;
+    }
+    *word = reinterpret_cast<intptr_t>(argValue);
+    packedArgs.push_back(word++);
+  }
+
+  auto *func = reinterpret_cast<void (*)(void **)>(funcPtr);
+  py::gil_scoped_release release;
+  func(packedArgs.data());
+}
+
 } // namespace
 
 /// Create the `mlir.execution_engine` module here.
 PYBIND11_MODULE(_mlirExecutionEngine, m) {
   m.doc() = "MLIR Execution Engine";
 
+  populateAllocatorBindings(m);
+
+  m.def("host_target", &getHostTarget,
+        "Return the triple, CPU name and feature string of the host as a "
+        "dict.");
+  m.def(
+      "llvm_version", [] { return std::string(LLVM_VERSION_STRING); },
+      "Return the version of the LLVM (and MLIR) the bindings are built "
+      "against, e.g. '15.0.4'.");
+  m.def(
+      "compile_to_object_file",
+      [](MlirModule module, const std::string &path, int optLevel,
+         std::optional<std::string> targetTriple,
+         std::optional<std::string> targetCPU,
+         std::optional<std::string> targetFeatures,
+         std::optional<unsigned> preferVectorWidth) {
+        JITTargetOptions targetOptions{
+            std::move(targetTriple), std::move(targetCPU),
+            std::move(targetFeatures), preferVectorWidth};
+        compileToObjectFile(module, path, optLevel, targetOptions);
+      },
+      py::arg("module"), py::arg("path"), py::arg("opt_level") = 2,
+      py::arg("target_triple") = py::none(),
+      py::arg("target_cpu") = py::none(),
+      py::arg("target_features") = py::none(),
+      py::arg("prefer_vector_width") = py::none(),
+      "Compile `module` to the position independent object file `path`, "
+      "which can be linked into a shared library, with the packed wrappers "
+      "and the optimizations and target options of `ExecutionEngine`.");
+
   //----------------------------------------------------------------------------
   // Mapping of the top-level PassManager
   //----------------------------------------------------------------------------
   py::class_<PyExecutionEngine>(m, "ExecutionEngine", py::module_local())
       .def(py::init<>([](MlirModule module, int optLevel,
-                         const std::vector<std::string> &sharedLibPaths) {
-             llvm::SmallVector<MlirStringRef, 4> libPaths;
-             for (const std::string &path : sharedLibPaths)
-               libPaths.push_back({path.c_str(), path.length()});
-             MlirExecutionEngine executionEngine = mlirExecutionEngineCreate(
-                 module, optLevel, libPaths.size(), libPaths.data());
+                         const std::vector<std::string> &sharedLibPaths,
+                         bool enableGDBListener, bool enablePerfListener,
+                         std::optional<std::string> targetTriple,
+                         std::optional<std::string> targetCPU,
+                         std::optional<std::string> targetFeatures,
+                         std::optional<unsigned> preferVectorWidth) {
+             llvm::SmallVector<llvm::StringRef, 4> libPaths(
+                 sharedLibPaths.begin(), sharedLibPaths.end());
+             JITTargetOptions targetOptions{
+                 std::move(targetTriple), std::move(targetCPU),
+                 std::move(targetFeatures), preferVectorWidth};
+             MlirExecutionEngine executionEngine = createExecutionEngine(
+                 module, optLevel, libPaths, targetOptions, enableGDBListener,
+                 enablePerfListener);
              if (mlirExecutionEngineIsNull(executionEngine))
                throw std::runtime_error(
                    "Failure while creating the ExecutionEngine.");
@@ -85,12 +476,25 @@ PYBIND11_MODULE(_mlirExecutionEngine, m) {
            }),
            py::arg("module"), py::arg("opt_level") = 2,
            py::arg("shared_libs") = py::list(),
+           py::arg("enable_gdb_listener") = true,
+           py::arg("enable_perf_listener") = true,
+           py::arg("target_triple") = py::none(),
+           py::arg("target_cpu") = py::none(),
+           py::arg("target_features") = py::none(),
+           py::arg("prefer_vector_width") = py::none(),
            "Create a new ExecutionEngine instance for the given Module. The "
            "module must contain only dialects that can be translated to LLVM. "
            "Perform transformations and code generation at the optimization "
            "level `opt_level` if specified, or otherwise at the default "
            "level of two (-O2). Load a list of libraries specified in "
-           "`shared_libs`.")
+           "`shared_libs`. Notify the GDB JIT interface and, if LLVM was "
+           "built with perf support, write perf JIT dump files for the "
+           "generated code unless `enable_gdb_listener` or "
+           "`enable_perf_listener` are False. Generate code for the host, or "
+           "for `target_triple` (which must be compatible with the host), "
+           "`target_cpu` and `target_features` (a comma separated list like "
+           "'+avx2,+fma'; both may be 'native'), preferring vectors of "
+           "`prefer_vector_width` bits.")
       .def_property_readonly(MLIR_PYTHON_CAPI_PTR_ATTR,
                              &PyExecutionEngine::getCapsule)
       .def("_testing_release", &PyExecutionEngine::release,
@@ -106,6 +510,29 @@ PYBIND11_MODULE(_mlirExecutionEngine, m) {
           },
           py::arg("func_name"),
           "Lookup function `func` in the ExecutionEngine.")
+      .def(
+          "raw_lookup_symbol",
+          [](PyExecutionEngine &executionEngine, const std::string &name) {
+            auto *res = mlirExecutionEngineLookup(
+                executionEngine.get(),
+                mlirStringRefCreate(name.c_str(), name.size()));
+            return reinterpret_cast<uintptr_t>(res);
+          },
+          py::arg("name"),
+          "Lookup the address of symbol `name` (not of its packed wrapper) in "
+          "the ExecutionEngine; 0 if it doesn't exist.")
+      .def(
+          "raw_invoke",
+          [](PyExecutionEngine &executionEngine, uintptr_t funcPtr,
+             const py::tuple &args, bool unranked) {
+            invokePacked(funcPtr, args, unranked);
+          },
+          py::arg("func_ptr"), py::arg("args"), py::arg("unranked") = false,
+          "Call the packed function at `func_ptr` (see `raw_lookup`) on "
+          "`args`: buffers (e.g. NumPy arrays) are passed as pointers to "
+          "ranked, or with `unranked` unranked, memref descriptors built "
+          "natively, Python ints and floats as i64 and f64 and NumPy scalars "
+          "as their type. The GIL is released during the call.")
       .def(
           "raw_register_runtime",
           [](PyExecutionEngine &executionEngine, const std::string &name,
@@ -120,6 +547,24 @@ PYBIND11_MODULE(_mlirExecutionEngine, m) {
           },
           py::arg("name"), py::arg("callback"),
           "Register `callback` as the runtime symbol `name`.")
+      .def(
+          "raw_register_allocator_hooks",
+          [](PyExecutionEngine &executionEngine) {
+            auto registerSymbol = [&](const char *name, void *sym) {
+              mlirExecutionEngineRegisterSymbol(
+                  executionEngine.get(), mlirStringRefCreateFromCString(name),
+                  sym);
+            };
+            registerSymbol("_mlir_alloc",
+                           reinterpret_cast<void *>(&mlirGenericAlloc));
+            registerSymbol("_mlir_aligned_alloc",
+                           reinterpret_cast<void *>(&mlirGenericAlignedAlloc));
+            registerSymbol("_mlir_free",
+                           reinterpret_cast<void *>(&mlirGenericFree));
+          },
+          "Provide the generic allocation functions called by code lowered "
+          "with `convert-memref-to-llvm{use-generic-functions=1}`, backed by "
+          "the active `Allocator`.")
       .def(
           "dump_to_object_file",
           [](PyExecutionEngine &executionEngine, const std::string &fileName) {
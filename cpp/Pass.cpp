@@ -11,6 +11,17 @@
 #include "IRModule.h"
 #include "mlir-c/Bindings/Python/Interop.h"
 #include "mlir-c/Pass.h"
+#include "mlir/CAPI/Pass.h"
+#include "mlir/Pass/PassInstrumentation.h"
+#include "mlir/Pass/PassManager.h"
+#include "llvm/ADT/DenseMap.h"
+#include "llvm/ADT/MapVector.h"
+#include "llvm/Support/Threading.h"
+#include "llvm/Support/Timer.h"
+
+#include <map>
+#include <mutex>
+#include <tuple>
 
 namespace py = pybind11;
 using namespace mlir;
@@ -18,12 +29,144 @@ using namespace mlir::python;
 
 namespace {
 
+/// Pass instrumentation recording the wall and CPU time and the statistics of
+/// every pass run, as a tree mirroring the pass pipeline. Runs of the same pass
+/// at the same position of the tree (e.g. a function pass run on every
+/// function) are merged into a single record.
+class PyPassTimingInstrumentation : public PassInstrumentation {
+public:
+  struct Record {
+    std::string name;
+    std::string argument;
+    std::string opName;
+    int parent;
+    int depth;
+    unsigned count = 0;
+    unsigned failures = 0;
+    double wallTime = 0;
+    double cpuTime = 0;
+    /// Latest statistic values of every pass instance (passes are cloned for
+    /// multi-threaded runs); summed up when exported.
+    llvm::DenseMap<Pass *, llvm::MapVector<llvm::StringRef, uint64_t>>
+        statistics;
+  };
+
+  void runBeforePipeline(Optional<OperationName> name,
+                         const PipelineParentInfo &parentInfo) override {
+    std::lock_guard<std::mutex> lock(mutex);
+    auto &parentStack = stacks[parentInfo.parentThreadID];
+    int parent = parentStack.empty() ? -1 : parentStack.back().record;
+    stacks[llvm::get_threadid()].push_back({parent, llvm::TimeRecord()});
+  }
+
+  void runAfterPipeline(Optional<OperationName> name,
+                        const PipelineParentInfo &parentInfo) override {
+    std::lock_guard<std::mutex> lock(mutex);
+    stacks[llvm::get_threadid()].pop_back();
+  }
+
+  void runBeforePass(Pass *pass, Operation *op) override {
+    std::lock_guard<std::mutex> lock(mutex);
+    auto &stack = stacks[llvm::get_threadid()];
+    int parent = stack.empty() ? -1 : stack.back().record;
+    std::string opName = op->getName().getStringRef().str();
+    auto key = std::make_tuple(parent, pass->getName().str(), opName);
+    auto it = recordIndex.find(key);
+    int record;
+    if (it == recordIndex.end()) {
+      record = records.size();
+      int depth = parent < 0 ? 0 : records[parent].depth + 1;
+      records.push_back({pass->getName().str(), pass->getArgument().str(),
+                         opName, parent, depth});
+      recordIndex[key] = record;
+    } else {
+      record = it->second;
+    }
+    stack.push_back({record, llvm::TimeRecord::getCurrentTime(true)});
+  }
+
+  void runAfterPass(Pass *pass, Operation *op) override {
+    finishPass(pass, /*failed=*/false);
+  }
+
+  void runAfterPassFailed(Pass *pass, Operation *op) override {
+    finishPass(pass, /*failed=*/true);
+  }
+
+  py::list getTimings() {
+    std::lock_guard<std::mutex> lock(mutex);
+    py::list timings;
+    for (const Record &record : records) {
+      llvm::MapVector<llvm::StringRef, uint64_t> totals;
+      for (auto &instance : record.statistics)
+        for (auto &statistic : instance.second)
+          totals[statistic.first] += statistic.second;
+      py::dict statistics;
+      for (auto &statistic : totals)
+        statistics[py::str(statistic.first.data(), statistic.first.size())] =
+            statistic.second;
+
+      py::dict timing;
+      timing["name"] = record.name;
+      timing["argument"] = record.argument;
+      timing["op"] = record.opName;
+      if (record.parent < 0)
+        timing["parent"] = py::none();
+      else
+        timing["parent"] = record.parent;
+      timing["depth"] = record.depth;
+      timing["count"] = record.count;
+      timing["failures"] = record.failures;
+      timing["wall_time"] = record.wallTime;
+      timing["cpu_time"] = record.cpuTime;
+      timing["statistics"] = statistics;
+      timings.append(timing);
+    }
+    return timings;
+  }
+
+  void reset() {
+    std::lock_guard<std::mutex> lock(mutex);
+    records.clear();
+    recordIndex.clear();
+  }
+
+private:
+  struct Frame {
+    int record;
+    llvm::TimeRecord start;
+  };
+
+  void finishPass(Pass *pass, bool failed) {
+    llvm::TimeRecord end = llvm::TimeRecord::getCurrentTime(false);
+    std::lock_guard<std::mutex> lock(mutex);
+    auto &stack = stacks[llvm::get_threadid()];
+    Frame frame = stack.pop_back_val();
+    Record &record = records[frame.record];
+    record.count++;
+    record.failures += failed;
+    record.wallTime += end.getWallTime() - frame.start.getWallTime();
+    record.cpuTime += end.getProcessTime() - frame.start.getProcessTime();
+    auto &statistics = record.statistics[pass];
+    for (Pass::Statistic *statistic : pass->getStatistics())
+      statistics[statistic->getName()] = statistic->getValue();
+  }
+
+  std::mutex mutex;
+  std::vector<Record> records;
+  std::map<std::tuple<int, std::string, std::string>, int> recordIndex;
+  /// Stack of the passes (and nested pipelines) being run, per thread.
+  llvm::DenseMap<uint64_t, llvm::SmallVector<Frame>> stacks;
+};
+
 /// Owning Wrapper around a PassManager.
 class PyPassManager {
 public:
   PyPassManager(MlirPassManager passManager) : passManager(passManager) {}
-  PyPassManager(PyPassManager &&other) : passManager(other.passManager) {
+  PyPassManager(PyPassManager &&other)
+      : passManager(other.passManager), timing(other.timing) {
     other.passManager.ptr = nullptr;
+    other.timing = nullptr;
   }
   ~PyPassManager() {
     if (!mlirPassManagerIsNull(passManager))
@@ -31,6 +174,18 @@ public:
   }
   MlirPassManager get() { return passManager; }
 
+  /// Returns the timing instrumentation, adding it to the pass manager on the
+  /// first call. The pass manager owns the instrumentation.
+  PyPassTimingInstrumentation &getTimingInstrumentation() {
+    if (!timing) {
+      auto instrumentation = std::make_unique<PyPassTimingInstrumentation>();
+      timing = instrumentation.get();
+      unwrap(passManager)->addInstrumentation(std::move(instrumentation));
+    }
+    return *timing;
+  }
+  bool isTimingEnabled() { return timing != nullptr; }
+
   void release() { passManager.ptr = nullptr; }
   pybind11::object getCapsule() {
     return py::reinterpret_steal<py::object>(
@@ -46,6 +201,7 @@ public:
 
 private:
   MlirPassManager passManager;
+  PyPassTimingInstrumentation *timing = nullptr;
 };
 
 } // namespace
@@ -80,6 +236,36 @@ void mlir::python::populatePassManagerSubmodule(py::module &m) {
             mlirPassManagerEnableVerifier(passManager.get(), enable);
           },
           py::arg("enable"), "Enable / disable verify-each.")
+      .def(
+          "enable_timing",
+          [](PyPassManager &passManager) {
+            passManager.getTimingInstrumentation();
+          },
+          "Record the time and statistics of every pass run by this "
+          "PassManager, see `get_pass_timings`.")
+      .def(
+          "get_pass_timings",
+          [](PyPassManager &passManager, bool reset) {
+            if (!passManager.isTimingEnabled())
+              throw SetPyError(PyExc_RuntimeError,
+                               "Timing is not enabled on this PassManager.");
+            PyPassTimingInstrumentation &timing =
+                passManager.getTimingInstrumentation();
+            py::list timings = timing.getTimings();
+            if (reset)
+              timing.reset();
+            return timings;
+          },
+          py::arg("reset") = false,
+          "Return the timings recorded since `enable_timing` (or the last "
+          "reset) as a list of dicts, one per pass in pipeline order, with "
+          "keys `name`, `argument`, `op` (the op the pass ran on), `parent` "
+          "(index of the enclosing pass, e.g. the pass adaptor of a nested "
+          "pipeline, or None), `depth`, `count` (runs merged into the record), "
+          "`failures`, `wall_time` and `cpu_time` (seconds; the CPU time is "
+          "the process time, which includes other threads when multithreading "
+          "is enabled) and `statistics` (pass statistic name -> value; values "
+          "are only tracked if LLVM was built with statistics).")
       .def_static(
           "parse",
           [](const std::string pipeline, DefaultingPyMlirContext context) {
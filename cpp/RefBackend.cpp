@@ -15,6 +15,7 @@
 //===----------------------------------------------------------------------===//
 
 #include "RefBackend.h"
+#include "mlir/Dialect/Affine/IR/AffineOps.h"
 #include "mlir/Dialect/Arithmetic/IR/Arithmetic.h"
 #include "mlir/Dialect/Func/IR/FuncOps.h"
 #include "mlir/Dialect/Linalg/IR/Linalg.h"
@@ -22,9 +23,19 @@
 #include "mlir/Dialect/Math/IR/Math.h"
 #include "mlir/Dialect/Math/Transforms/Approximation.h"
 #include "mlir/Dialect/Math/Transforms/Passes.h"
+#include "mlir/Dialect/MemRef/IR/MemRef.h"
+#include "mlir/Dialect/PDL/IR/PDL.h"
+#include "mlir/Dialect/PDLInterp/IR/PDLInterp.h"
+#include "mlir/Dialect/SCF/IR/SCF.h"
+#include "mlir/Dialect/Tensor/IR/Tensor.h"
+#include "mlir/Dialect/Transform/IR/TransformDialect.h"
+#include "mlir/Dialect/Transform/IR/TransformInterfaces.h"
+#include "mlir/Dialect/Vector/IR/VectorOps.h"
+#include "mlir/Dialect/Vector/Transforms/VectorRewritePatterns.h"
 #include "mlir/Pass/Pass.h"
 #include "mlir/Transforms/DialectConversion.h"
 #include "mlir/Transforms/GreedyPatternRewriteDriver.h"
+#include "llvm/ADT/StringSwitch.h"
 #include "llvm/Support/Debug.h"
 #include <numeric>
 #include <set>
@@ -100,8 +111,30 @@ static void replaceReturnWithCall(OpBuilder b, func::ReturnOp op,
   toErase.push_back(op);
 }
 
+// Type of the slot a result of type `type` is stored to with
+// `results-as-out-args`: scalars are stored as they are, memrefs as ranked
+// memrefs with a fully dynamic strided layout, so that every memref result of
+// a given rank and element type is stored as a descriptor of the same layout.
+static Type getResultSlotElementType(Type type) {
+  auto memRefType = type.dyn_cast<MemRefType>();
+  if (!memRefType)
+    return type;
+  int64_t rank = memRefType.getRank();
+  SmallVector<int64_t> shape(rank, ShapedType::kDynamicSize);
+  SmallVector<int64_t> strides(rank, ShapedType::kDynamicStrideOrOffset);
+  AffineMap layout = makeStridedLinearLayoutMap(
+      strides, ShapedType::kDynamicStrideOrOffset, type.getContext());
+  return MemRefType::get(shape, memRefType.getElementType(), layout);
+}
+
+static bool isResultTypeValid(Type type) {
+  if (type.isa<MemRefType>())
+    return isArgMemRefTypeValid(type);
+  return type.isSignlessInteger() || type.isa<mlir::FloatType>();
+}
+
 static LogicalResult mungeFunction(
-    func::FuncOp func,
+    func::FuncOp func, bool resultsAsOutArgs,
     std::map<std::string, std::vector<Type>> &invokedConsumeFuncReturnFuncs) {
   // Only need to call mungeFunction for functions callable from outside of the
   // module.
@@ -118,19 +151,85 @@ static LogicalResult mungeFunction(
   //   result. Additionally, ensure that all results are passed as unranked
   //   memrefs.
   // - replace the function signature accordingly (unranked inputs, no returns).
+  // With `resultsAsOutArgs`, results are instead stored to trailing
+  // `memref<*xT>` arguments: a scalar result of type T to element 0, a memref
+  // result to element 0 as a ranked descriptor of the type given by
+  // `getResultSlotElementType`. The result types are recorded in the
+  // `refback.result_types` (type tokens) and `refback.result_ranks` function
+  // attributes, so that the caller can allocate and decode the slots.
   OpBuilder b(func.getBody());
 
+  // The unranked arguments are cast back to their type, whose layout decides
+  // which views the function reads correctly: all of them (with any strides
+  // and offset) for a strided layout, e.g. the fully dynamic one that one-shot
+  // bufferization gives arguments with `function-boundary-type-conversion=
+  // infer-layout-map`, only contiguous ones for the identity layout, which
+  // ignores the strides and offset of the descriptor. The former arguments
+  // are recorded in the `refback.strided_args` function attribute (one bool
+  // per argument), so that the caller can reject the views the others can't
+  // take.
   SmallVector<Type> newArgTypes;
+  SmallVector<Attribute> stridedArgs;
+  bool anyStridedArg = false;
   for (auto arg : func.getArguments()) {
     auto type = arg.getType();
     if (!isArgMemRefTypeValid(type))
       return emitError(arg.getLoc(),
                        "argument must be a memref of f32, f64, i32, i64, i1");
+    bool strided = !type.cast<MemRefType>().getLayout().isIdentity();
+    anyStridedArg |= strided;
+    stridedArgs.push_back(b.getBoolAttr(strided));
     auto cast = b.create<memref::CastOp>(arg.getLoc(), type, arg);
     arg.replaceAllUsesExcept(cast, cast);
     arg.setType(getAbiTypeForMemRef(type));
     newArgTypes.push_back(arg.getType());
   }
+  if (anyStridedArg)
+    func->setAttr("refback.strided_args", b.getArrayAttr(stridedArgs));
+
+  if (resultsAsOutArgs) {
+    Location loc = func.getLoc();
+    SmallVector<Value> slots;
+    SmallVector<Attribute> resultTypes, resultRanks;
+    for (Type type : func.getFunctionType().getResults()) {
+      if (!isResultTypeValid(type))
+        return func.emitError("result must be a memref of f32, f64, i32, i64, "
+                              "i1 or a scalar integer or float");
+      Type slotElementType = getResultSlotElementType(type);
+      BlockArgument slot = func.front().addArgument(
+          UnrankedMemRefType::get(slotElementType, 0), loc);
+      newArgTypes.push_back(slot.getType());
+      slots.push_back(b.create<memref::CastOp>(
+          loc, MemRefType::get({1}, slotElementType), slot));
+      auto memRefType = type.dyn_cast<MemRefType>();
+      resultTypes.push_back(b.getStringAttr(getTypeToken(
+          memRefType ? getAbiTypeForMemRef(memRefType) : type)));
+      resultRanks.push_back(
+          b.getI64IntegerAttr(memRefType ? memRefType.getRank() : 0));
+    }
+    func->setAttr("refback.result_types", b.getArrayAttr(resultTypes));
+    func->setAttr("refback.result_ranks", b.getArrayAttr(resultRanks));
+
+    SmallVector<func::ReturnOp> returns(func.getOps<func::ReturnOp>());
+    for (func::ReturnOp op : returns) {
+      b.setInsertionPoint(op);
+      Value zero = b.create<arith::ConstantIndexOp>(op.getLoc(), 0);
+      for (auto it : llvm::zip(op.getOperands(), slots)) {
+        Value result = std::get<0>(it);
+        Value slot = std::get<1>(it);
+        Type slotElementType =
+            slot.getType().cast<MemRefType>().getElementType();
+        if (result.getType() != slotElementType)
+          result =
+              b.create<memref::CastOp>(op.getLoc(), slotElementType, result);
+        b.create<memref::StoreOp>(op.getLoc(), result, slot, zero);
+      }
+      b.create<func::ReturnOp>(op.getLoc());
+      op.erase();
+    }
+    func.setType(FunctionType::get(func.getContext(), newArgTypes, {}));
+    return success();
+  }
 
   SmallVector<Operation *> toErase;
   func.walk([&](func::ReturnOp op) {
@@ -176,12 +275,19 @@ struct MungeCallingConventions
   MungeCallingConventions(const MungeCallingConventions &) {}
   StringRef getArgument() const override { return "refback-munge-calling-conventions"; }
 
+  Option<bool> resultsAsOutArgs{
+      *this, "results-as-out-args",
+      llvm::cl::desc("Store results to trailing out arguments instead of "
+                     "passing them to refbackend_consume_func_return_*"),
+      llvm::cl::init(false)};
+
   void runOnOperation() override {
     auto module = getOperation();
     OpBuilder b(module.getBodyRegion());
     std::map<std::string, std::vector<Type>> invokedConsumeFuncReturnFuncs;
     for (auto func : module.getOps<func::FuncOp>()) {
-      if (failed(mungeFunction(func, invokedConsumeFuncReturnFuncs)))
+      if (failed(mungeFunction(func, resultsAsOutArgs,
+                               invokedConsumeFuncReturnFuncs)))
         return signalPassFailure();
     }
 
@@ -300,3 +406,304 @@ std::unique_ptr<OperationPass<func::FuncOp>>
 mlir::python::createMungeMemrefCopyPass() {
   return std::make_unique<MungeMemrefCopy>();
 }
+
+//===----------------------------------------------------------------------===//
+// ForwardOutParams
+//===----------------------------------------------------------------------===//
+
+// `buffer-results-to-out-params` rewrites `return %alloc` into
+// `memref.copy %alloc, %out` followed by `return`. When `%alloc` is an
+// allocation of the same type, in the same block, which is not used after the
+// copy, the kernel can compute directly into `%out` and the copy (and the
+// allocation) can be dropped.
+static bool canForwardToOutParam(memref::CopyOp copyOp) {
+  auto outParam = copyOp.target().dyn_cast<BlockArgument>();
+  if (!outParam || !outParam.getOwner()->isEntryBlock() ||
+      !outParam.hasOneUse())
+    return false;
+  auto alloc = copyOp.source().getDefiningOp<memref::AllocOp>();
+  if (!alloc || alloc->getBlock() != copyOp->getBlock() ||
+      Type(alloc.getType()) != outParam.getType())
+    return false;
+  for (Operation *user : alloc->getUsers()) {
+    if (user == copyOp.getOperation())
+      continue;
+    if (isa<memref::DeallocOp>(user))
+      return false;
+    Operation *ancestor = copyOp->getBlock()->findAncestorOpInBlock(*user);
+    if (!ancestor || !ancestor->isBeforeInBlock(copyOp))
+      return false;
+  }
+  return true;
+}
+
+namespace {
+struct ForwardOutParams
+    : public PassWrapper<ForwardOutParams, OperationPass<func::FuncOp>> {
+  MLIR_DEFINE_EXPLICIT_INTERNAL_INLINE_TYPE_ID(ForwardOutParams)
+
+  ForwardOutParams() = default;
+  ForwardOutParams(const ForwardOutParams &) {}
+  StringRef getArgument() const override { return "refback-forward-out-params"; }
+
+  void runOnOperation() override {
+    SmallVector<memref::CopyOp> toForward;
+    getOperation().walk([&](memref::CopyOp copyOp) {
+      if (canForwardToOutParam(copyOp))
+        toForward.push_back(copyOp);
+    });
+    for (memref::CopyOp copyOp : toForward) {
+      Value outParam = copyOp.target();
+      Operation *alloc = copyOp.source().getDefiningOp();
+      copyOp->erase();
+      alloc->getResult(0).replaceAllUsesWith(outParam);
+      alloc->erase();
+    }
+  }
+};
+}// namespace
+
+std::unique_ptr<OperationPass<func::FuncOp>>
+mlir::python::createForwardOutParamsPass() {
+  return std::make_unique<ForwardOutParams>();
+}
+
+//===----------------------------------------------------------------------===//
+// VectorizeLinalg
+//===----------------------------------------------------------------------===//
+
+static constexpr StringLiteral kVectorizeMarker = "refback-vectorize";
+
+/// Returns the largest divisor of `size` that is at most `target`, so that
+/// tiles are static and evenly divide the loop.
+static int64_t getDivisorTileSize(int64_t size, int64_t target) {
+  if (ShapedType::isDynamic(size) || target <= 0)
+    return 0;
+  for (int64_t tile = std::min(size, target); tile > 1; --tile)
+    if (size % tile == 0)
+      return tile;
+  return 1;
+}
+
+/// Returns the tile sizes of `op`: one vector of `vectorWidth` elements along
+/// the innermost dimension of contractions and (decomposed) convolutions,
+/// and along the innermost loop of any other op.
+static SmallVector<int64_t> getVectorTileSizes(linalg::LinalgOp op,
+                                               int64_t vectorWidth,
+                                               ArrayRef<int64_t> matmulTiles,
+                                               ArrayRef<int64_t> convTiles) {
+  SmallVector<int64_t> ranges = op.getStaticLoopRanges();
+  SmallVector<int64_t> targets(ranges.size(), 1);
+  if (isa<linalg::MatmulOp>(op)) {
+    // (m, n, k): a 4 x vector tile, reducing 4 at a time.
+    targets = {4, vectorWidth, 4};
+    if (!matmulTiles.empty())
+      targets.assign(matmulTiles.begin(), matmulTiles.end());
+  } else if (isa<linalg::Conv2DNhwcHwcfOp>(op)) {
+    // (n, oh, ow, f, kh, kw, c): unit n, oh and kh, so that the tile can be
+    // decomposed into a 1-D convolution; kw and c are not tiled.
+    targets = {1, 1, 4, vectorWidth, 1, 0, 0};
+    if (!convTiles.empty())
+      targets.assign(convTiles.begin(), convTiles.end());
+  } else if (!targets.empty()) {
+    targets.back() = vectorWidth;
+  }
+  targets.resize(ranges.size(), 0);
+  SmallVector<int64_t> tileSizes;
+  for (auto it : llvm::zip(ranges, targets))
+    tileSizes.push_back(std::get<1>(it) == 0
+                            ? 0
+                            : getDivisorTileSize(std::get<0>(it),
+                                                 std::get<1>(it)));
+  return tileSizes;
+}
+
+static Optional<vector::VectorContractLowering>
+parseContractionLowering(StringRef name) {
+  return llvm::StringSwitch<Optional<vector::VectorContractLowering>>(name)
+      .Case("outerproduct", vector::VectorContractLowering::OuterProduct)
+      .Case("dot", vector::VectorContractLowering::Dot)
+      .Case("matmul", vector::VectorContractLowering::Matmul)
+      .Case("parallelarith", vector::VectorContractLowering::ParallelArith)
+      .Default(llvm::None);
+}
+
+namespace {
+/// Tiles the linalg ops on buffers so that each tile is a few vectors wide,
+/// vectorizes the tiles (convolutions after decomposing them into 1-D ones)
+/// and lowers the resulting vector contractions and reductions. Transfers are
+/// left to `convert-vector-to-scf` and `convert-vector-to-llvm`; ops that
+/// can't be vectorized are left to `convert-linalg-to-loops`. With
+/// `vectorize=0`, only the vector ops are lowered, e.g. those of ops
+/// vectorized by a transform script.
+struct VectorizeLinalg
+    : public PassWrapper<VectorizeLinalg, OperationPass<func::FuncOp>> {
+  MLIR_DEFINE_EXPLICIT_INTERNAL_INLINE_TYPE_ID(VectorizeLinalg)
+
+  VectorizeLinalg() = default;
+  VectorizeLinalg(const VectorizeLinalg &) {}
+  StringRef getArgument() const override { return "refback-vectorize-linalg"; }
+
+  void getDependentDialects(DialectRegistry &registry) const override {
+    registry.insert<AffineDialect, linalg::LinalgDialect, memref::MemRefDialect,
+                    scf::SCFDialect, vector::VectorDialect>();
+  }
+
+  Option<int64_t> vectorWidth{
+      *this, "vector-width",
+      llvm::cl::desc("Number of elements of the innermost vector dimension"),
+      llvm::cl::init(8)};
+  ListOption<int64_t> matmulTileSizes{
+      *this, "matmul-tile-sizes",
+      llvm::cl::desc("Tile sizes of linalg.matmul (m, n, k); by default "
+                     "4 x vector-width x 4")};
+  ListOption<int64_t> convTileSizes{
+      *this, "conv-tile-sizes",
+      llvm::cl::desc("Tile sizes of linalg.conv_2d_nhwc_hwcf (n, oh, ow, f, "
+                     "kh, kw, c); oh or kh other than 1 prevent vectorization")};
+  Option<std::string> contractionLowering{
+      *this, "contraction-lowering",
+      llvm::cl::desc("Lowering of vector.contract: outerproduct, dot, matmul "
+                     "(LLVM matrix intrinsics) or parallelarith"),
+      llvm::cl::init("outerproduct")};
+  Option<bool> vectorize{
+      *this, "vectorize",
+      llvm::cl::desc("Tile and vectorize the linalg ops before lowering the "
+                     "vector ops"),
+      llvm::cl::init(true)};
+
+  void runOnOperation() override {
+    func::FuncOp func = getOperation();
+    MLIRContext *context = &getContext();
+    auto lowering = parseContractionLowering(contractionLowering);
+    if (!lowering) {
+      func.emitError() << "unknown contraction lowering '"
+                       << contractionLowering << "'";
+      return signalPassFailure();
+    }
+    if (vectorize && failed(tileAndVectorize(func)))
+      return signalPassFailure();
+
+    // Lower the vector ops that have no direct lowering to LLVM.
+    RewritePatternSet patterns(context);
+    vector::populateVectorToVectorCanonicalizationPatterns(patterns);
+    vector::populateVectorContractLoweringPatterns(
+        patterns, vector::VectorTransformsOptions().setVectorTransformsOptions(
+                      *lowering));
+    vector::populateVectorMultiReductionLoweringPatterns(
+        patterns, vector::VectorMultiReductionLowering::InnerParallel);
+    vector::populateVectorTransferPermutationMapLoweringPatterns(patterns);
+    if (failed(applyPatternsAndFoldGreedily(func, std::move(patterns))))
+      return signalPassFailure();
+  }
+
+private:
+  LogicalResult tileAndVectorize(func::FuncOp func) {
+    MLIRContext *context = &getContext();
+    auto marker = StringAttr::get(context, kVectorizeMarker);
+
+    // Tile.
+    SmallVector<linalg::LinalgOp> toTile;
+    func.walk([&](linalg::LinalgOp op) {
+      if (op.hasBufferSemantics() && !op.hasDynamicShape())
+        toTile.push_back(op);
+    });
+    IRRewriter rewriter(context);
+    for (linalg::LinalgOp op : toTile) {
+      SmallVector<int64_t> tileSizes = getVectorTileSizes(
+          op, vectorWidth, matmulTileSizes, convTileSizes);
+      rewriter.setInsertionPoint(op);
+      FailureOr<linalg::TiledLinalgOp> tiled = linalg::tileLinalgOp(
+          rewriter, op, linalg::LinalgTilingOptions().setTileSizes(tileSizes));
+      if (failed(tiled))
+        continue;
+      tiled->op->setAttr(linalg::LinalgTransforms::kLinalgTransformMarker,
+                         marker);
+      rewriter.eraseOp(op);
+    }
+    if (failed(applyPatternsAndFoldGreedily(
+            func, linalg::getLinalgTilingCanonicalizationPatterns(context))))
+      return failure();
+
+    // Decompose the 2-D convolutions with unit height tiles into 1-D ones.
+    RewritePatternSet patterns(context);
+    linalg::populateDecomposeConvolutionPatterns(
+        patterns, linalg::LinalgTransformationFilter(marker, marker));
+    if (failed(applyPatternsAndFoldGreedily(func, std::move(patterns))))
+      return failure();
+
+    // Vectorize.
+    SmallVector<linalg::LinalgOp> toVectorize;
+    func.walk([&](linalg::LinalgOp op) {
+      if (op->removeAttr(linalg::LinalgTransforms::kLinalgTransformMarker))
+        toVectorize.push_back(op);
+    });
+    for (linalg::LinalgOp op : toVectorize) {
+      rewriter.setInsertionPoint(op);
+      (void)linalg::vectorize(rewriter, op);
+    }
+    return success();
+  }
+};
+}// namespace
+
+std::unique_ptr<OperationPass<func::FuncOp>>
+mlir::python::createVectorizeLinalgPass() {
+  return std::make_unique<VectorizeLinalg>();
+}
+
+//===----------------------------------------------------------------------===//
+// TransformInterpreter
+//===----------------------------------------------------------------------===//
+
+namespace {
+/// Applies the transform ops at the top level of the module (a transform
+/// script, e.g. a `transform.with_pdl_patterns` wrapping a
+/// `transform.sequence`) to the module, then erases them, so that the
+/// transformed payload can be lowered like any other module.
+struct TransformInterpreter
+    : public PassWrapper<TransformInterpreter, OperationPass<ModuleOp>> {
+  MLIR_DEFINE_EXPLICIT_INTERNAL_INLINE_TYPE_ID(TransformInterpreter)
+
+  TransformInterpreter() = default;
+  TransformInterpreter(const TransformInterpreter &) {}
+  StringRef getArgument() const override {
+    return "refback-transform-interpreter";
+  }
+
+  void getDependentDialects(DialectRegistry &registry) const override {
+    registry.insert<AffineDialect, arith::ArithmeticDialect,
+                    linalg::LinalgDialect, pdl::PDLDialect,
+                    pdl_interp::PDLInterpDialect, scf::SCFDialect,
+                    tensor::TensorDialect, transform::TransformDialect,
+                    vector::VectorDialect>();
+  }
+
+  Option<bool> enableExpensiveChecks{
+      *this, "enable-expensive-checks",
+      llvm::cl::desc("Check that transform ops don't use handles to payload "
+                     "ops that a previous transform erased"),
+      llvm::cl::init(false)};
+
+  void runOnOperation() override {
+    ModuleOp module = getOperation();
+    SmallVector<transform::TransformOpInterface> transforms(
+        module.getBody()->getOps<transform::TransformOpInterface>());
+    transform::TransformState state(
+        module.getBodyRegion(), module,
+        transform::TransformOptions().enableExpensiveChecks(
+            enableExpensiveChecks));
+    for (transform::TransformOpInterface transform : transforms) {
+      if (failed(state.applyTransform(transform).checkAndReport()))
+        return signalPassFailure();
+    }
+    for (transform::TransformOpInterface transform : transforms)
+      transform->erase();
+  }
+};
+}// namespace
+
+std::unique_ptr<OperationPass<ModuleOp>>
+mlir::python::createTransformInterpreterPass() {
+  return std::make_unique<TransformInterpreter>();
+}
@@ -9,5 +9,8 @@ namespace mlir::python {
 std::unique_ptr<OperationPass<func::FuncOp>> createMungeMemrefCopyPass();
 std::unique_ptr<OperationPass<func::FuncOp>> createExpandOpsForLLVMPass();
 std::unique_ptr<OperationPass<ModuleOp>> createMungeCallingConventionsPass();
+std::unique_ptr<OperationPass<func::FuncOp>> createForwardOutParamsPass();
+std::unique_ptr<OperationPass<func::FuncOp>> createVectorizeLinalgPass();
+std::unique_ptr<OperationPass<ModuleOp>> createTransformInterpreterPass();
 
 }// namespace mlir::python
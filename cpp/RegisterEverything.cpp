@@ -32,7 +32,23 @@ inline void registerExpandOpsForLLVMPass() {
   });
 }
 
+inline void registerForwardOutParamsPass() {
+  ::mlir::registerPass([]() -> std::unique_ptr<::mlir::Pass> {
+    return mlir::python::createForwardOutParamsPass();
+  });
+}
+
+inline void registerVectorizeLinalgPass() {
+  ::mlir::registerPass([]() -> std::unique_ptr<::mlir::Pass> {
+    return mlir::python::createVectorizeLinalgPass();
+  });
+}
 
+inline void registerTransformInterpreterPass() {
+  ::mlir::registerPass([]() -> std::unique_ptr<::mlir::Pass> {
+    return mlir::python::createTransformInterpreterPass();
+  });
+}
 
 PYBIND11_MODULE(_mlirRegisterEverything, m) {
   m.doc() = "MLIR All Upstream Dialects and Passes Registration";
@@ -48,4 +64,7 @@ PYBIND11_MODULE(_mlirRegisterEverything, m) {
   registerMungeMemrefCopyPass();
   registerExpandOpsForLLVMPass();
   registerMungeCallingConventionsPass();
+  registerForwardOutParamsPass();
+  registerVectorizeLinalgPass();
+  registerTransformInterpreterPass();
 }
@@ -4,7 +4,7 @@
 #   * Relative imports for cross-module references.
 #   * Add __all__
 
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional
 
 from . import ir as _ir
 
@@ -18,6 +18,8 @@ class PassManager:
     def _testing_release(self) -> None: ...
     def enable_ir_printing(self) -> None: ...
     def enable_verifier(self, enable: bool) -> None: ...
+    def enable_timing(self) -> None: ...
+    def get_pass_timings(self, reset: bool = False) -> List[Dict[str, Any]]: ...
     @staticmethod
     def parse(pipeline: str, context: Optional[_ir.Context] = None) -> PassManager: ...
     def run(self, module: _ir.Module) -> None: ...
@@ -4,20 +4,48 @@
 #   * Relative imports for cross-module references.
 #   * Add __all__
 
-from typing import List, Sequence
+from typing import Any, Dict, List, Optional, Sequence
 
 from ._mlir import ir as _ir
 
 __all__ = [
+    "Allocator",
     "ExecutionEngine",
+    "allocator_free",
+    "compile_to_object_file",
+    "host_target",
+    "llvm_version",
 ]
 
+class Allocator:
+    @staticmethod
+    def malloc() -> Allocator: ...
+    @staticmethod
+    def arena(block_size: int = 1048576) -> Allocator: ...
+    @staticmethod
+    def pool(max_pooled_size: int = 16777216) -> Allocator: ...
+    @staticmethod
+    def set_default(allocator: Optional[Allocator]) -> None: ...
+    def stats(self) -> Dict[str, int]: ...
+    def reset_stats(self) -> None: ...
+    def reset(self) -> None: ...
+    def __enter__(self) -> Allocator: ...
+    def __exit__(self, *args: Any) -> None: ...
+
 class ExecutionEngine:
-    def __init__(self, module: _ir.Module, opt_level: int = 2, shared_libs: Sequence[str] = ...) -> None: ...
+    def __init__(self, module: _ir.Module, opt_level: int = 2, shared_libs: Sequence[str] = ..., enable_gdb_listener: bool = True, enable_perf_listener: bool = True, target_triple: Optional[str] = None, target_cpu: Optional[str] = None, target_features: Optional[str] = None, prefer_vector_width: Optional[int] = None) -> None: ...
     def _CAPICreate(self) -> object: ...
     def _testing_release(self) -> None: ...
     def dump_to_object_file(self, file_name: str) -> None: ...
+    def raw_invoke(self, func_ptr: int, args: tuple, unranked: bool = False) -> None: ...
     def raw_lookup(self, func_name: str) -> int: ...
+    def raw_lookup_symbol(self, name: str) -> int: ...
+    def raw_register_allocator_hooks(self) -> None: ...
     def raw_register_runtime(self, name: str, callback: object) -> None: ...
     @property
     def _CAPIPtr(self) -> object: ...
+
+def allocator_free(ptr: int) -> None: ...
+def compile_to_object_file(module: _ir.Module, path: str, opt_level: int = 2, target_triple: Optional[str] = None, target_cpu: Optional[str] = None, target_features: Optional[str] = None, prefer_vector_width: Optional[int] = None) -> None: ...
+def host_target() -> Dict[str, str]: ...
+def llvm_version() -> str: ...
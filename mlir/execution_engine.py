@@ -4,22 +4,259 @@
 
 # Simply a wrapper around the extension module of the same name.
 from ._mlir_libs import _mlirExecutionEngine as _execution_engine
+from . import ir
+import asyncio
+import concurrent.futures
 import ctypes
+import functools
+import os
+import threading
+import weakref
 
 __all__ = [
+  "Allocator",
+  "BoundFunction",
   "ExecutionEngine",
+  "allocator_free",
+  "compile_to_object_file",
+  "host_target",
+  "llvm_version",
+  "resolve_target_options",
+  "symbol_to_func_name",
 ]
 
+Allocator = _execution_engine.Allocator
+allocator_free = _execution_engine.allocator_free
+compile_to_object_file = _execution_engine.compile_to_object_file
+host_target = _execution_engine.host_target
+llvm_version = _execution_engine.llvm_version
+
+
+def _join_features(target_features):
+  if target_features is None or isinstance(target_features, str):
+    return target_features
+  return ",".join(target_features)
+
+
+def resolve_target_options(target_triple=None, target_cpu=None,
+                           target_features=None, prefer_vector_width=None):
+  """Return the `ExecutionEngine` target options as a dict with "native"
+  replaced by the host's CPU and features, e.g. to key compilation caches:
+  code compiled for "native" on one machine isn't valid on another.
+  """
+  host = None
+  if "native" in (target_cpu, target_features):
+    host = host_target()
+  return {
+      "target_triple": target_triple,
+      "target_cpu": host["cpu"] if target_cpu == "native" else target_cpu,
+      "target_features": (host["features"] if target_features == "native" else
+                          _join_features(target_features)),
+      "prefer_vector_width": prefer_vector_width,
+  }
+
+# Prefixes of the symbols generated for a `func.func`: the packed wrapper the
+# ExecutionEngine emits for every function, and the C interface wrapper.
+_SYMBOL_PREFIXES = ("_mlir_", "_mlir_ciface_")
+
+
+def symbol_to_func_name(symbol, func_names=None):
+  """Map a symbol of JIT'd code, as it shows up in a profile (e.g.
+  `_mlir__mlir_ciface_matmul`), back to the name of the `func.func` it was
+  generated from (`matmul`). With `func_names`, the names of the functions of
+  the source module, only prefixes leading to one of them are stripped, so
+  functions whose own names start with `_mlir_` are mapped correctly.
+  """
+  name = symbol
+  while True:
+    if func_names is not None and name in func_names:
+      return name
+    for prefix in _SYMBOL_PREFIXES[::-1]:
+      if name.startswith(prefix) and len(name) > len(prefix):
+        name = name[len(prefix):]
+        break
+    else:
+      return name if func_names is None else symbol
+
+
+def _defined_llvm_funcs(module):
+  """Returns the names of the `llvm.func`s of `module` that have a body."""
+  names = []
+  for op in module.body.operations:
+    op = op.operation
+    if op.name == "llvm.func" and len(op.regions[0].blocks):
+      names.append(ir.StringAttr(op.attributes["sym_name"]).value)
+  return names
+
+
+class BoundFunction:
+  """A function of an ExecutionEngine bound to a fixed argument signature.
+
+  The symbol lookup, the ctypes prototype and the packed argument array are
+  created once, when the function is bound, and reused on every call. The
+  packed arguments are a `ctypes.Structure` with one pointer field per
+  argument, which has the same layout as the `void **` array the packed
+  interface expects, so binding an argument is a plain field store rather
+  than a `ctypes.cast`.
+
+  A BoundFunction holds a single argument buffer and is therefore not safe to
+  call concurrently from several threads; bind one per thread instead.
+  """
+
+  def __init__(self, engine, name, func_ptr, arg_types):
+    # Keep the engine alive for as long as its code may be called.
+    self._engine = engine
+    self.name = name
+    self._arg_names = tuple("arg" + str(i) for i in range(len(arg_types)))
+    packed_args_t = type(
+        "PackedArgs", (ctypes.Structure,),
+        {"_fields_": list(zip(self._arg_names, arg_types))})
+    self._packed_args = packed_args_t()
+    self._packed_args_ptr = ctypes.addressof(self._packed_args)
+    prototype = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+    self._func = prototype(func_ptr)
+
+  def bind(self, *ctypes_args):
+    """Store `ctypes_args` in the packed argument array without calling."""
+    if len(ctypes_args) != len(self._arg_names):
+      raise TypeError(
+          f"{self.name} expects {len(self._arg_names)} arguments, "
+          f"got {len(ctypes_args)}")
+    packed_args = self._packed_args
+    for arg_name, arg in zip(self._arg_names, ctypes_args):
+      setattr(packed_args, arg_name, arg)
+
+  def __call__(self, *ctypes_args):
+    """Call the function. Arguments are bound first if any are given,
+    otherwise the previously bound arguments are reused.
+    """
+    if ctypes_args:
+      self.bind(*ctypes_args)
+    self._func(self._packed_args_ptr)
+
+
 class ExecutionEngine(_execution_engine.ExecutionEngine):
 
+  _async_lock = threading.Lock()
+  _perf_map_lock = threading.Lock()
+
+  def __init__(self, module, opt_level=2, shared_libs=[],
+               enable_gdb_listener=True, enable_perf_listener=True,
+               perf_map=False, target_triple=None, target_cpu=None,
+               target_features=None, prefer_vector_width=None):
+    """Create a new ExecutionEngine for `module`; see the native constructor
+    for `opt_level`, `shared_libs`, the JIT event listeners and the target
+    options. `target_features` may also be a list like `["+avx2", "+fma"]`.
+    With `perf_map`, the symbols of the generated code are appended to
+    `/tmp/perf-<pid>.map` (or to the file `perf_map` names) once it is
+    compiled, i.e. on the first lookup, so that `perf report` and flame graphs
+    attribute samples in JIT'd code to their functions; see `write_perf_map`.
+    """
+    super().__init__(module, opt_level, shared_libs, enable_gdb_listener,
+                     enable_perf_listener, target_triple, target_cpu,
+                     _join_features(target_features), prefer_vector_width)
+    self._perf_map = None
+    if perf_map:
+      self._perf_map = (None if perf_map is True else perf_map,
+                        _defined_llvm_funcs(module))
+
+  def write_perf_map(self, symbols, path=None):
+    """Append the address ranges of `symbols` to the perf map `path`
+    (default: `/tmp/perf-<pid>.map`, where perf looks for the symbols of the
+    process). Looking the symbols up compiles the module, so runtime symbols
+    must be registered before. The JIT doesn't expose symbol sizes; they are
+    estimated as the distance to the next symbol, the last one is given
+    4 KiB.
+    """
+    addresses = sorted(
+        (address, symbol)
+        for symbol in symbols
+        for address in [self.raw_lookup_symbol(symbol)]
+        if address)
+    path = path or f"/tmp/perf-{os.getpid()}.map"
+    with ExecutionEngine._perf_map_lock, open(path, "a") as f:
+      for i, (address, symbol) in enumerate(addresses):
+        end = addresses[i + 1][0] if i + 1 < len(addresses) else address + 4096
+        f.write(f"{address:x} {end - address:x} {symbol}\n")
+
+  def _lookup_packed(self, name):
+    if getattr(self, "_perf_map", None) is not None:
+      with ExecutionEngine._perf_map_lock:
+        perf_map, self._perf_map = self._perf_map, None
+      if perf_map is not None:
+        path, func_names = perf_map
+        # Every defined function also gets a packed `_mlir_` wrapper.
+        self.write_perf_map(
+            func_names + ["_mlir_" + func for func in func_names], path)
+    func = self.raw_lookup("_mlir_ciface_" + name)
+    if not func:
+      raise RuntimeError("Unknown function " + name)
+    return func
+
+  def configure_async(self, executor=None, max_concurrency=None):
+    """Configure how `invoke_async` runs calls: on `executor` (by default a
+    thread pool owned by the engine, sized `max_concurrency`), with at most
+    `max_concurrency` calls (default: one per core) in flight; further
+    callers wait, which gives backpressure to the event loop.
+    Must be called before the first `invoke_async` to take effect. A caller
+    supplied `executor` stays the caller's to shut down; the engine's own
+    pool is shut down by `close_async`.
+    """
+    self.close_async()
+    self._async_max_concurrency = max_concurrency or os.cpu_count()
+    self._async_executor = executor
+    self._async_owns_executor = False
+    # asyncio semaphores are bound to the loop they are first used in.
+    self._async_semaphores = weakref.WeakKeyDictionary()
+
+  def close_async(self, wait=True):
+    """Shut down the thread pool `invoke_async` created, if any, waiting for
+    the calls in flight with `wait`. A later `invoke_async` creates a new
+    one.
+    """
+    with ExecutionEngine._async_lock:
+      if not getattr(self, "_async_owns_executor", False):
+        return
+      executor, self._async_executor = self._async_executor, None
+      self._async_owns_executor = False
+    executor.shutdown(wait=wait)
+
+  def _async_state(self, loop):
+    with ExecutionEngine._async_lock:
+      if not hasattr(self, "_async_semaphores"):
+        self._async_max_concurrency = os.cpu_count()
+        self._async_executor = None
+        self._async_semaphores = weakref.WeakKeyDictionary()
+      if self._async_executor is None:
+        self._async_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._async_max_concurrency,
+            thread_name_prefix="mlir-execution-engine")
+        self._async_owns_executor = True
+      semaphore = self._async_semaphores.get(loop)
+      if semaphore is None:
+        semaphore = self._async_semaphores[loop] = asyncio.Semaphore(
+            self._async_max_concurrency)
+      return self._async_executor, semaphore
+
+  async def invoke_async(self, name, *ctypes_args):
+    """Awaitable `invoke`: the function runs on the executor set with
+    `configure_async`, so the event loop isn't blocked. ctypes releases the
+    GIL for the duration of the native call, so concurrent invocations run
+    in parallel. The arguments must stay valid until the call completes.
+    Raise a RuntimeError if the function isn't found.
+    """
+    loop = asyncio.get_running_loop()
+    executor, semaphore = self._async_state(loop)
+    async with semaphore:
+      await loop.run_in_executor(
+          executor, functools.partial(self.invoke, name, *ctypes_args))
+
   def lookup(self, name):
     """Lookup a function emitted with the `llvm.emit_c_interface`
     attribute and returns a ctype callable.
     Raise a RuntimeError if the function isn't found.
     """
-    func = self.raw_lookup("_mlir_ciface_" + name)
-    if not func:
-      raise RuntimeError("Unknown function " + name)
+    func = self._lookup_packed(name)
     prototype = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
     return prototype(func)
 
@@ -34,6 +271,46 @@ class ExecutionEngine(_execution_engine.ExecutionEngine):
       packed_args[argNum] = ctypes.cast(ctypes_args[argNum], ctypes.c_void_p)
     func(packed_args)
 
+  def invoke_arrays(self, name, *args, unranked=False):
+    """Invoke a function with NumPy arrays (or any objects supporting the
+    buffer protocol) and scalars, without creating ctypes objects: the memref
+    descriptors are built natively, as ranked descriptors or, with
+    `unranked`, as unranked ones, and the call releases the GIL. Python ints
+    and floats are passed as i64 and f64, NumPy scalars as their type.
+    Raise a RuntimeError if the function isn't found.
+    """
+    try:
+      func = self._packed_funcs[name]
+    except (AttributeError, KeyError):
+      func = self._lookup_packed(name)
+      if not hasattr(self, "_packed_funcs"):
+        self._packed_funcs = {}
+      self._packed_funcs[name] = func
+    self.raw_invoke(func, args, unranked)
+
+  def get_callable(self, name, arg_types):
+    """Returns a `BoundFunction` for the function `name`, emitted with the
+    `llvm.emit_c_interface` attribute, taking arguments of the ctypes
+    pointer types `arg_types` (e.g.
+    `ctypes.POINTER(ctypes.POINTER(UnrankedMemRefDescriptor))`).
+    Unlike `invoke`, the lookup and the argument packing buffers are set up
+    once here rather than on every call.
+    Raise a RuntimeError if the function isn't found.
+    """
+    func = self._lookup_packed(name)
+    return BoundFunction(self, name, func, arg_types)
+
+  def enable_allocator_hooks(self):
+    """Provide the `_mlir_alloc`, `_mlir_aligned_alloc` and `_mlir_free`
+    functions called by code lowered with
+    `convert-memref-to-llvm{use-generic-functions=1}`. Memory is then
+    allocated from the `Allocator` active on the calling thread
+    (`with allocator: ...`), else from the default one
+    (`Allocator.set_default`), else with malloc. Such memory, e.g. of a
+    returned memref, must be freed with `allocator_free`, not libc `free`.
+    """
+    self.raw_register_allocator_hooks()
+
   def register_runtime(self, name, ctypes_callback):
     """Register a runtime function available to the jitted code
     under the provided `name`. The `ctypes_callback` must be a
@@ -6,6 +6,7 @@
 
 import numpy as np
 import ctypes
+import functools
 
 
 class C128(ctypes.Structure):
@@ -45,6 +46,7 @@ def to_numpy(array):
   return array
 
 
+@functools.lru_cache(maxsize=None)
 def make_nd_memref_descriptor(rank, dtype):
 
   class MemRefDescriptor(ctypes.Structure):
@@ -61,6 +63,7 @@ def make_nd_memref_descriptor(rank, dtype):
   return MemRefDescriptor
 
 
+@functools.lru_cache(maxsize=None)
 def make_zero_d_memref_descriptor(dtype):
 
   class MemRefDescriptor(ctypes.Structure):
@@ -80,26 +83,53 @@ class UnrankedMemRefDescriptor(ctypes.Structure):
   _fields_ = [("rank", ctypes.c_longlong), ("descriptor", ctypes.c_void_p)]
 
 
+def get_memref_layout(nparray):
+  """Returns the (base address, offset, strides) of the strided memref
+  viewing `nparray` in place: the base is the address of element
+  [0, ..., 0], the offset is 0 and the strides are in elements. Strides may
+  be negative or zero (broadcasting), which callees with a strided layout
+  honour; callees with the identity layout ignore the strides (and the
+  offset), so they only see the right elements of C-contiguous arrays (see
+  `has_identity_layout`).
+  Raise a ValueError if a stride isn't a multiple of the element size, as for
+  views of fields of structured arrays, which can't be memrefs.
+  """
+  itemsize = nparray.itemsize
+  strides = nparray.strides
+  for stride in strides:
+    if stride % itemsize:
+      raise ValueError(
+          f"Array strides {strides} must be multiples of the element size "
+          f"({itemsize}) to be passed as a memref.")
+  return nparray.ctypes.data, 0, [stride // itemsize for stride in strides]
+
+
+def has_identity_layout(nparray):
+  """Returns whether the memref viewing `nparray` can be passed to a callee
+  taking a memref with the identity layout (e.g. `memref<4x8xf32>`), i.e.
+  whether `nparray` is C-contiguous."""
+  return nparray.flags.c_contiguous
+
+
 def get_ranked_memref_descriptor(nparray):
-  """Returns a ranked memref descriptor for the given numpy array."""
+  """Returns a ranked memref descriptor for the given numpy array. The
+  descriptor views the array in place, whatever its strides (see
+  `get_memref_layout`), so slices and broadcasts need not be copied for
+  callees with a strided layout."""
   ctp = as_ctype(nparray.dtype)
+  base, offset, strides = get_memref_layout(nparray)
   if nparray.ndim == 0:
     x = make_zero_d_memref_descriptor(ctp)()
-    x.allocated = nparray.ctypes.data
-    x.aligned = nparray.ctypes.data_as(ctypes.POINTER(ctp))
-    x.offset = ctypes.c_longlong(0)
-    return x
-
-  x = make_nd_memref_descriptor(nparray.ndim, ctp)()
-  x.allocated = nparray.ctypes.data
-  x.aligned = nparray.ctypes.data_as(ctypes.POINTER(ctp))
-  x.offset = ctypes.c_longlong(0)
-  x.shape = nparray.ctypes.shape
-
-  # Numpy uses byte quantities to express strides, MLIR OTOH uses the
-  # torch abstraction which specifies strides in terms of elements.
-  strides_ctype_t = ctypes.c_longlong * nparray.ndim
-  x.strides = strides_ctype_t(*[x // nparray.itemsize for x in nparray.strides])
+  else:
+    x = make_nd_memref_descriptor(nparray.ndim, ctp)()
+  x.allocated = base
+  x.aligned = ctypes.cast(base, ctypes.POINTER(ctp))
+  x.offset = ctypes.c_longlong(offset)
+  if nparray.ndim:
+    x.shape = nparray.ctypes.shape
+    # Numpy uses byte quantities to express strides, MLIR OTOH uses the
+    # torch abstraction which specifies strides in terms of elements.
+    x.strides[:] = strides
   return x
 
 
@@ -112,27 +142,121 @@ def get_unranked_memref_descriptor(nparray):
   return d
 
 
+class _PooledDescriptor:
+  """A ranked descriptor, its unranked wrapper and int64 views of its fields.
+
+  All of a descriptor's fields are 64 bits wide, so the descriptor can be
+  viewed as an int64 array [allocated, aligned, offset, shape..., strides...]
+  and patched with NumPy ops instead of by creating ctypes objects.
+  """
+
+  def __init__(self, rank, ctp):
+    if rank == 0:
+      self.ranked = make_zero_d_memref_descriptor(ctp)()
+    else:
+      self.ranked = make_nd_memref_descriptor(rank, ctp)()
+    words = np.ctypeslib.as_array(
+        (ctypes.c_longlong * (3 + 2 * rank)).from_buffer(self.ranked))
+    self.pointers = words[0:2]
+    self.offset = words[2:3]
+    self.shape = words[3:3 + rank]
+    self.strides = words[3 + rank:]
+    self.unranked = UnrankedMemRefDescriptor()
+    self.unranked.rank = rank
+    self.unranked.descriptor = ctypes.addressof(self.ranked)
+    self.ranked_arg = ctypes.pointer(ctypes.pointer(self.ranked))
+    self.unranked_arg = ctypes.pointer(ctypes.pointer(self.unranked))
+    self.array = None
+
+  def update(self, nparray):
+    # Keep the array alive for as long as the descriptor points into it.
+    self.array = nparray
+    base, offset, strides = get_memref_layout(nparray)
+    self.pointers[:] = base
+    self.offset[0] = offset
+    if nparray.ndim:
+      self.shape[:] = nparray.shape
+      self.strides[:] = strides
+
+
+class MemRefDescriptorPool:
+  """A pool of reusable memref descriptors, one per argument slot.
+
+  The first call for a given slot, rank and dtype creates the descriptor;
+  subsequent calls for arrays of the same rank and dtype only patch the
+  pointer, offset, shape and stride fields of that descriptor in place, so no
+  new ctypes objects are created. The returned descriptors (and pointers to
+  them) stay valid until the slot is reused by a later call.
+  """
+
+  def __init__(self):
+    self._descriptors = {}
+
+  def _get(self, nparray, slot):
+    ctp = as_ctype(nparray.dtype)
+    key = (slot, nparray.ndim, ctp)
+    descriptor = self._descriptors.get(key)
+    if descriptor is None:
+      descriptor = self._descriptors[key] = _PooledDescriptor(nparray.ndim, ctp)
+    descriptor.update(nparray)
+    return descriptor
+
+  def get_ranked(self, nparray, slot=0):
+    """Returns a pooled ranked memref descriptor for the given numpy array."""
+    return self._get(nparray, slot).ranked
+
+  def get_unranked(self, nparray, slot=0):
+    """Returns a pooled unranked memref descriptor for the given numpy array."""
+    return self._get(nparray, slot).unranked
+
+  def get_ranked_arg(self, nparray, slot=0):
+    """Returns a pooled pointer to a pointer to a ranked memref descriptor,
+    i.e. an argument ready to be passed to `ExecutionEngine.invoke`."""
+    return self._get(nparray, slot).ranked_arg
+
+  def get_unranked_arg(self, nparray, slot=0):
+    """Returns a pooled pointer to a pointer to an unranked memref
+    descriptor, i.e. an argument ready to be passed to
+    `ExecutionEngine.invoke`."""
+    return self._get(nparray, slot).unranked_arg
+
+
+def _strided_memref_to_numpy(descriptor, ctp, shape, strides):
+  """Returns a view of the memory described by a ranked memref descriptor,
+  honouring its offset and (possibly negative or zero) strides."""
+  if 0 in shape:
+    return to_numpy(np.empty(shape, dtype=np.dtype(ctp)))
+  itemsize = ctypes.sizeof(ctp)
+  # Extent of the view, in elements, relative to element [0, ..., 0].
+  lo = sum(min(0, (size - 1) * stride) for size, stride in zip(shape, strides))
+  hi = sum(max(0, (size - 1) * stride) for size, stride in zip(shape, strides))
+  aligned = ctypes.cast(descriptor.aligned, ctypes.c_void_p).value
+  start = aligned + (descriptor.offset + lo) * itemsize
+  np_arr = np.ctypeslib.as_array(
+      ctypes.cast(start, ctypes.POINTER(ctp)), shape=(hi - lo + 1,))
+  strided_arr = np.lib.stride_tricks.as_strided(
+      np_arr[-lo:], shape, [stride * itemsize for stride in strides])
+  return to_numpy(strided_arr)
+
+
 def unranked_memref_to_numpy(unranked_memref, np_dtype):
   """Converts unranked memrefs to numpy arrays."""
   ctp = as_ctype(np_dtype)
-  descriptor = make_nd_memref_descriptor(unranked_memref[0].rank, ctp)
+  rank = unranked_memref[0].rank
+  if rank == 0:
+    descriptor = make_zero_d_memref_descriptor(ctp)
+  else:
+    descriptor = make_nd_memref_descriptor(rank, ctp)
   val = ctypes.cast(unranked_memref[0].descriptor, ctypes.POINTER(descriptor))
-  np_arr = np.ctypeslib.as_array(val[0].aligned, shape=val[0].shape)
-  strided_arr = np.lib.stride_tricks.as_strided(
-      np_arr,
-      np.ctypeslib.as_array(val[0].shape),
-      np.ctypeslib.as_array(val[0].strides) * np_arr.itemsize,
-  )
-  return to_numpy(strided_arr)
+  return ranked_memref_to_numpy(val)
 
 
 def ranked_memref_to_numpy(ranked_memref):
-  """Converts ranked memrefs to numpy arrays."""
-  np_arr = np.ctypeslib.as_array(
-      ranked_memref[0].aligned, shape=ranked_memref[0].shape)
-  strided_arr = np.lib.stride_tricks.as_strided(
-      np_arr,
-      np.ctypeslib.as_array(ranked_memref[0].shape),
-      np.ctypeslib.as_array(ranked_memref[0].strides) * np_arr.itemsize,
-  )
-  return to_numpy(strided_arr)
+  """Converts ranked memrefs to numpy arrays, viewing the memref's memory
+  from its offset with its strides."""
+  descriptor = ranked_memref[0]
+  ctp = dict(descriptor._fields_)["aligned"]._type_
+  if not hasattr(descriptor, "shape"):
+    return _strided_memref_to_numpy(descriptor, ctp, (), ())
+  return _strided_memref_to_numpy(descriptor, ctp, tuple(descriptor.shape),
+                                  tuple(descriptor.strides))
@@ -0,0 +1,194 @@
+"""Ahead-of-time export of modules lowered by the RefBackend to standalone
+shared libraries, which `aot_loader.AotModule` loads with ctypes alone, i.e.
+without LLVM codegen at load time and without the MLIR Python bindings:
+
+    lowered = RefBackendLinalgOnTensorsBackend.compile(module)
+    export_shared_library(lowered, "matmul.so")
+    # ... in the serving process:
+    AotModule("matmul.so").matmul(a, b)
+
+The object file is generated by `compile_to_object_file` like the JIT would,
+so it also contains the `_mlir__mlir_ciface_*` packed wrappers of the exported
+functions, but as position independent code. The
+`refbackend_consume_func_return_*` callbacks, which the JIT resolves to Python
+callbacks, are provided by a small C shim as trampolines to function pointers
+that the loader sets. A JSON manifest next to the library
+lists the exported functions and the callbacks.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+from mlir._mlir_libs._mlir.ir import Context, Module
+
+from mlir.execution_engine import compile_to_object_file, resolve_target_options
+
+from compile_cache import CompilationCache
+from config import LLVM_VERSION
+from refbackend import (
+    get_return_funcs,
+    get_strided_args,
+    object_cache_key,
+    runtime_shared_libs,
+)
+from aot_loader import CALLBACK_PREFIX
+from refbackend_abi import get_ctype_func, memref_type_to_np_dtype
+
+CIFACE_PREFIX = "_mlir_ciface_"
+
+# MLIR types of the consume-return arguments -> C types of the trampolines.
+elemental_type_to_c_type = {
+    "i1": "bool",
+    "i8": "int8_t",
+    "i64": "int64_t",
+    "f32": "float",
+    "f64": "double",
+}
+
+
+def get_exported_funcs(module):
+    """Returns name -> number of arguments of the functions of the lowered
+    `module` that have a C interface, i.e. that can be called through their
+    packed wrapper."""
+    funcs = {}
+    with module.context:
+        for op in module.body:
+            if op.operation.name != "llvm.func":
+                continue
+            name = str(op.attributes["sym_name"]).replace('"', "")
+            # Declarations (e.g. of the consume-return callbacks) have no body.
+            if not name.startswith(CIFACE_PREFIX) or not len(op.regions[0].blocks):
+                continue
+            funcs[name[len(CIFACE_PREFIX) :]] = len(op.regions[0].blocks[0].arguments)
+    return funcs
+
+
+def emit_callback_shim(return_funcs):
+    """Returns C source defining `_mlir_ciface_<return func>` as trampolines
+    to the exported function pointers `aot_callback_<return func>`."""
+    lines = ["#include <stdbool.h>", "#include <stdint.h>", ""]
+    for ret_func in return_funcs:
+        _, ret_types = get_ctype_func(ret_func)
+        params = [
+            f"void *a{i}"
+            if t in memref_type_to_np_dtype
+            else f"{elemental_type_to_c_type[t]} a{i}"
+            for i, t in enumerate(ret_types)
+        ]
+        args = ", ".join(f"a{i}" for i in range(len(ret_types)))
+        param_list = ", ".join(params) or "void"
+        lines += [
+            f"void (*{CALLBACK_PREFIX}{ret_func})({param_list});",
+            f"void {CIFACE_PREFIX}{ret_func}({param_list}) {{",
+            f"  {CALLBACK_PREFIX}{ret_func}({args});",
+            "}",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def link_shared_library(output, object_file, shim_file, shared_libs, cc=None):
+    """Links the (position independent) object file and the shim into
+    `output`."""
+    cc = cc or os.environ.get("CC", "cc")
+    command = [cc, "-shared", "-fPIC", "-O2", "-o", str(output), object_file, shim_file]
+    for lib in shared_libs:
+        command += [lib, f"-Wl,-rpath,{Path(lib).parent}"]
+    command.append("-Wl,-rpath,$ORIGIN")
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"linking {output} failed:\n$ {' '.join(command)}\n{result.stderr}"
+        )
+
+
+def export_shared_library(
+    module,
+    output,
+    opt_level=2,
+    shared_libs=None,
+    bundle_shared_libs=False,
+    cache: CompilationCache = None,
+    cc=None,
+    **target_options,
+):
+    """Compiles the lowered `module` to the shared library `output` and writes
+    its manifest to `output` + ".json". Returns the manifest.
+
+    `shared_libs` (by default the MLIR runner utils, and the async runtime for
+    modules compiled with `parallel=True`) are linked in; with
+    `bundle_shared_libs` they are copied next to `output`, which then only
+    needs to be deployed with them. With a `cache`, the object file is looked
+    up (see `object_cache_key`) and only generated on a miss. The JIT's own
+    objects aren't position independent, so they aren't shared with
+    `RefBackendLinalgOnTensorsBackend.load`. `target_options` (`target_cpu`,
+    `target_features`, ...) select the target as for `ExecutionEngine`; the
+    library only runs on machines supporting it.
+    """
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    shared_libs = runtime_shared_libs(module) if shared_libs is None else shared_libs
+    if bundle_shared_libs:
+        for lib in shared_libs:
+            shutil.copy(lib, output.parent)
+        shared_libs = [str(output.parent / Path(lib).name) for lib in shared_libs]
+
+    return_funcs = get_return_funcs(module)
+    with tempfile.TemporaryDirectory() as tmp:
+        object_file = None
+        if cache is not None:
+            key = object_cache_key(
+                cache, module, opt_level, target_options, position_independent=True
+            )
+            object_file = cache.lookup(key, ".o")
+        if object_file is None:
+            object_file = os.path.join(tmp, "kernel.o")
+            compile_to_object_file(module, object_file, opt_level, **target_options)
+            if cache is not None:
+                cache.store_file(key, ".o", lambda path: shutil.copy(object_file, path))
+        shim_file = os.path.join(tmp, "callbacks.c")
+        Path(shim_file).write_text(emit_callback_shim(return_funcs))
+        link_shared_library(output, str(object_file), shim_file, shared_libs, cc)
+
+    manifest = {
+        "llvm_version": LLVM_VERSION,
+        "opt_level": opt_level,
+        "target": resolve_target_options(**target_options),
+        "functions": get_exported_funcs(module),
+        "return_funcs": return_funcs,
+        "strided_args": get_strided_args(module),
+        "shared_libs": [Path(lib).name for lib in shared_libs],
+    }
+    Path(str(output) + ".json").write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Export a lowered module to a shared library")
+    parser.add_argument("input", help="Module lowered by the RefBackend (.mlir)")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("-O", "--opt-level", default=2, type=int)
+    parser.add_argument("--bundle-shared-libs", action="store_true")
+    parser.add_argument("--target-triple")
+    parser.add_argument("--target-cpu", help='CPU name, or "native"')
+    parser.add_argument("--target-features", help='e.g. "+avx2,+fma"')
+    parser.add_argument("--prefer-vector-width", type=int)
+    args = parser.parse_args()
+
+    with Context():
+        module = Module.parse(Path(args.input).read_text())
+        manifest = export_shared_library(
+            module,
+            args.output,
+            args.opt_level,
+            bundle_shared_libs=args.bundle_shared_libs,
+            target_triple=args.target_triple,
+            target_cpu=args.target_cpu,
+            target_features=args.target_features,
+            prefer_vector_width=args.prefer_vector_width,
+        )
+    print(f"exported {', '.join(manifest['functions'])} to {args.output}")
@@ -0,0 +1,126 @@
+"""Loads shared libraries exported by `aot.export_shared_library` and calls
+their functions with NumPy arrays. Only needs ctypes, NumPy and the
+(pure Python) `mlir.runtime` descriptor marshalling, so serving processes
+neither link the MLIR runtime nor pay for LLVM codegen at startup.
+"""
+import ctypes
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from mlir.runtime import MemRefDescriptorPool, UnrankedMemRefDescriptor
+
+from refbackend_abi import (
+    as_memref_args,
+    get_ctype_func,
+    make_consume_return_callback,
+    memref_arg_pointers,
+)
+
+PACKED_PREFIX = "_mlir__mlir_ciface_"
+CALLBACK_PREFIX = "aot_callback_"
+
+_unranked_arg_t = ctypes.POINTER(ctypes.POINTER(UnrankedMemRefDescriptor))
+
+
+class AotModule:
+    """The exported functions of an AOT compiled library, invoked like
+    `RefBackendInvoker` invokes them (thread-safe; `owned_results` and `out=`
+    have the same meaning)."""
+
+    def __init__(self, path, owned_results=False):
+        path = Path(path).absolute()
+        self.manifest = json.loads(Path(str(path) + ".json").read_text())
+        self.lib = ctypes.CDLL(str(path))
+        self.owned_results = owned_results
+        self._local = threading.local()
+
+        # Point the callback trampolines of the library at the Python
+        # consume-return functions; the ctypes callbacks must stay alive.
+        self._callbacks = []
+        for ret_func in self.manifest["return_funcs"]:
+            ctype_wrapper, ret_types = get_ctype_func(ret_func)
+            callback = ctype_wrapper(
+                make_consume_return_callback(ret_types, self._local, owned_results)
+            )
+            self._callbacks.append(callback)
+            ctypes.c_void_p.in_dll(self.lib, CALLBACK_PREFIX + ret_func).value = (
+                ctypes.cast(callback, ctypes.c_void_p).value
+            )
+
+        self._functions = {}
+        for name in self.manifest["functions"]:
+            func = self.lib[PACKED_PREFIX + name]
+            func.argtypes = [ctypes.c_void_p]
+            func.restype = None
+            self._functions[name] = func
+
+    def _thread_state(self):
+        local = self._local
+        if not hasattr(local, "descriptor_pool"):
+            local.descriptor_pool = MemRefDescriptorPool()
+            local.packed_args = {}
+            local.result = None
+        return local
+
+    def _packed_args(self, local, function_name, num_args):
+        """Returns the (per-thread) packed argument array of `function_name`,
+        laid out as the `void **` its packed wrapper expects."""
+        packed_args = local.packed_args.get(function_name)
+        if packed_args is None:
+            expected = self.manifest["functions"][function_name]
+            if num_args != expected:
+                raise TypeError(
+                    f"{function_name} expects {expected} arguments, got {num_args}"
+                )
+            packed_args_t = type(
+                "PackedArgs",
+                (ctypes.Structure,),
+                {"_fields_": [(f"arg{i}", _unranked_arg_t) for i in range(num_args)]},
+            )
+            packed_args = local.packed_args[function_name] = packed_args_t()
+        return packed_args
+
+    def invoke(self, function_name, *args, out=None):
+        if function_name not in self._functions:
+            raise AttributeError(f"Unknown function {function_name}")
+        outs = () if out is None else out if isinstance(out, tuple) else (out,)
+        args = as_memref_args(
+            args + outs, self.manifest.get("strided_args", {}).get(function_name)
+        )
+        local = self._thread_state()
+        packed_args = self._packed_args(local, function_name, len(args))
+        for i, arg in enumerate(args):
+            setattr(
+                packed_args,
+                f"arg{i}",
+                local.descriptor_pool.get_unranked_arg(arg, slot=i),
+            )
+        if self.owned_results:
+            local.arg_pointers = memref_arg_pointers(args)
+
+        self._functions[function_name](ctypes.addressof(packed_args))
+        result = local.result
+        assert result is not None, "Invocation didn't produce a result"
+        local.result = None
+        return result if out is None else out
+
+    def invoke_batch(self, function_name, list_of_arg_tuples, workers=None):
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            return list(
+                pool.map(
+                    lambda args: self.invoke(function_name, *args),
+                    list_of_arg_tuples,
+                )
+            )
+
+    def __getattr__(self, function_name: str):
+        if function_name.startswith("_"):
+            raise AttributeError(function_name)
+
+        def invoke(*args, out=None):
+            return self.invoke(function_name, *args, out=out)
+
+        return invoke
@@ -0,0 +1,159 @@
+"""Autotunes the affine tiling and unrolling parameters and the JIT opt level
+used by `linalg_tut.lower_matmul` for a given matmul shape and dtype.
+
+Candidate configurations are sampled from the search space and compiled in a
+process pool; the compiled candidates are then raced with successive halving
+(every round measures the survivors with a growing time budget and keeps the
+best third), so poor candidates are dropped after a short measurement. The
+winner is stored in the tuning database, where `lower_matmul` picks it up:
+
+    python autotune.py --shape 64x64x64 --dtype f32 -n 40 -j 8
+"""
+import argparse
+import random
+
+import numpy as np
+
+import benchmark
+from compiler_utils import compile_many, mark_arguments_read_only
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
+from linalg_tut import ELEMENT_TYPES, build_matmul, matmul_pipeline
+from tuning_db import TuningDatabase
+
+TILE_SIZES = [2, 4, 8, 16, 32]
+UNROLL_FACTORS = [0, 2, 4, 8]
+UNROLL_JAM_FACTORS = [0, 2, 4]
+OPT_LEVELS = [2, 3]
+
+
+def sample_configs(shape, num_candidates, seed=0):
+    """Samples up to `num_candidates` distinct configurations; the untiled and
+    not unrolled baseline is always included."""
+    rng = random.Random(seed)
+    configs = {
+        (None, 0, 0, 2),
+    }
+    tile_choices = [[t for t in TILE_SIZES if t <= dim] or [1] for dim in shape]
+    for _ in range(num_candidates * 10):
+        if len(configs) >= num_candidates:
+            break
+        configs.add(
+            (
+                tuple(rng.choice(choices) for choices in tile_choices),
+                rng.choice(UNROLL_FACTORS),
+                rng.choice(UNROLL_JAM_FACTORS),
+                rng.choice(OPT_LEVELS),
+            )
+        )
+    return [
+        {
+            "tile_sizes": list(tile_sizes) if tile_sizes else None,
+            "unroll_factor": unroll_factor,
+            "unroll_jam_factor": unroll_jam_factor,
+            "opt_level": opt_level,
+        }
+        for tile_sizes, unroll_factor, unroll_jam_factor, opt_level in sorted(
+            configs, key=str
+        )
+    ]
+
+
+def compile_candidates(wrapped_module, configs, workers=None):
+    """Lowers the benchmark-wrapped module once per config in a process pool
+    and returns (config, lowered module) for the configs that lower."""
+    pipelines = [
+        matmul_pipeline(
+            tile_sizes=config["tile_sizes"],
+            unroll_factor=config["unroll_factor"],
+            unroll_jam_factor=config["unroll_jam_factor"],
+        )
+        for config in configs
+    ]
+    lowered = compile_many(
+        [wrapped_module] * len(configs),
+        pipelines,
+        workers,
+        return_exceptions=True,
+    )
+    return [
+        (config, module)
+        for config, module in zip(configs, lowered)
+        if not isinstance(module, Exception)
+    ]
+
+
+def successive_halving(bench, candidates, args, eta=3, budget_s=0.2):
+    """Races `candidates`, a list of (config, engine), and returns
+    (config, stats) of the fastest."""
+    survivors = candidates
+    while True:
+        scored = []
+        for config, engine in survivors:
+            stats = bench.measure(engine, args, rel_ci=0.02, max_time_s=budget_s)
+            scored.append((stats["mean"], config, engine, stats))
+        scored.sort(key=lambda s: s[0])
+        if len(scored) == 1:
+            _, config, _, stats = scored[0]
+            return config, stats
+        survivors = [(c, e) for _, c, e, _ in scored[: max(1, len(scored) // eta)]]
+        budget_s *= eta
+
+
+def autotune(
+    shape,
+    dtype,
+    num_candidates=30,
+    workers=None,
+    tuning_db=None,
+    seed=0,
+):
+    """Returns the best config for a matmul of `shape` and `dtype` and its
+    stats, and records it in `tuning_db`."""
+    bench = benchmark.Benchmark(
+        c_runner_utils_fp=MLIR_C_RUNNER_UTILS, runner_utils_fp=MLIR_RUNNER_UTILS
+    )
+    wrapped_module = bench.wrap(build_matmul(*shape, dtype=dtype), "matmul")
+    mark_arguments_read_only(wrapped_module)
+    configs = sample_configs(shape, num_candidates, seed)
+    compiled = compile_candidates(wrapped_module, configs, workers)
+
+    m, n, k = shape
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    args = [
+        np.random.uniform(size=(m, n)).astype(np_dtype),
+        np.random.uniform(size=(n, k)).astype(np_dtype),
+    ]
+    candidates = [
+        (config, bench.load(module, config["opt_level"]))
+        for config, module in compiled
+    ]
+    best_config, stats = successive_halving(bench, candidates, args)
+
+    tuning_db = tuning_db or TuningDatabase()
+    if tuning_db.record("matmul", shape, dtype, best_config, stats["mean"]):
+        tuning_db.save()
+    return best_config, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Autotune matmul tiling and unrolling")
+    parser.add_argument(
+        "--shape",
+        default="32x32x32",
+        type=lambda s: tuple(int(d) for d in s.split("x")),
+        help="MxNxK",
+    )
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f64")
+    parser.add_argument("-n", "--num-candidates", default=30, type=int)
+    parser.add_argument("-j", "--workers", default=None, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    config, stats = autotune(
+        args.shape,
+        args.dtype,
+        args.num_candidates,
+        args.workers,
+        seed=args.seed,
+    )
+    print(f"best config {config}: {stats['mean']:.2f}±{stats['ci']:.2f} ns")
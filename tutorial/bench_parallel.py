@@ -0,0 +1,140 @@
+"""Measures how the named matmul and conv ops scale with the number of
+workers of `PARALLEL_PIPELINE`, from 1 to N cores, against the sequential
+lowering. Every measurement runs in a new process restricted to as many
+cores as workers (one for the sequential lowering), since the thread pool of
+the async runtime has a thread per core the process may run on, whatever the
+number of workers the kernel was compiled for.
+
+    python bench_parallel.py --dtype f32
+    python bench_parallel.py --kernels matmul --workers 1 2 4 8
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import benchmark
+from compiler_utils import mark_arguments_read_only, run_pipeline_with_repro_report
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
+from linalg_tut import ELEMENT_TYPES, build_conv_2d_nhwc_hwcf, build_matmul
+from refbackend import (
+    BUFFERIZATION_PIPELINE,
+    LOWER_LLVM_PIPELINE,
+    PARALLEL_PIPELINE,
+    available_cores,
+)
+
+# Kernel name -> (builder, shapes of the arguments).
+KERNELS = {
+    "matmul": (
+        lambda dtype: build_matmul(256, 256, 256, dtype=dtype),
+        [(256, 256), (256, 256)],
+    ),
+    "conv_2d_nhwc_hwcf": (
+        lambda dtype: build_conv_2d_nhwc_hwcf(4, 66, 66, 32, 3, 3, 32, dtype=dtype),
+        [(4, 66, 66, 32), (3, 3, 32, 32)],
+    ),
+}
+
+
+def lower(module, num_workers=0):
+    """Lowers `module` sequentially if `num_workers` is 0 and with
+    `PARALLEL_PIPELINE` otherwise."""
+    mark_arguments_read_only(module)
+    pipeline = BUFFERIZATION_PIPELINE()
+    if num_workers:
+        pipeline += PARALLEL_PIPELINE(num_workers)
+    run_pipeline_with_repro_report(
+        module,
+        pipeline + LOWER_LLVM_PIPELINE,
+        "Lowering the benchmark to LLVM",
+    )
+    return module
+
+
+def restrict_to_cores(num_cores):
+    """Restricts the process to the first `num_cores` of the cores it may run
+    on, before the async runtime (and its thread pool) is loaded."""
+    os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:num_cores])
+
+
+def measure_kernel(kernel, num_workers, dtype, opt_level, measure_kwargs):
+    """Returns the stats of `kernel` lowered for `num_workers` workers (0 for
+    the sequential lowering), measured on as many cores."""
+    restrict_to_cores(max(1, num_workers))
+    bench = benchmark.Benchmark(
+        c_runner_utils_fp=MLIR_C_RUNNER_UTILS,
+        runner_utils_fp=MLIR_RUNNER_UTILS,
+        num_iterations=10,
+    )
+    build, arg_shapes = KERNELS[kernel]
+    rng = np.random.default_rng(0)
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    args = [rng.uniform(size=shape).astype(np_dtype) for shape in arg_shapes]
+    lowered = lower(bench.wrap(build(dtype), kernel), num_workers)
+    return bench.measure(bench.load(lowered, opt_level), args, **measure_kwargs)
+
+
+def bench_parallel(kernels, workers, dtype, opt_level=3, **measure_kwargs):
+    """Returns {(kernel, num workers): stats}, where 0 workers is the
+    sequential lowering."""
+    # A process per measurement, so that every one loads the async runtime
+    # anew with the thread pool sized by its own affinity; spawned, since
+    # MLIR contexts own thread pools, which don't survive a fork.
+    mp_context = multiprocessing.get_context("spawn")
+    results = {}
+    for kernel in kernels:
+        for num_workers in [0, *workers]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as pool:
+                stats = pool.submit(
+                    measure_kernel,
+                    kernel,
+                    num_workers,
+                    dtype,
+                    opt_level,
+                    measure_kwargs,
+                ).result()
+            results[(kernel, num_workers)] = stats
+            print(
+                f"{kernel} {dtype} {num_workers} workers: "
+                f"{stats['mean']:.2f}±{stats['ci']:.2f} ns",
+                file=sys.stderr,
+            )
+    return results
+
+
+def default_workers():
+    """1, 2, 4, ... up to the number of available cores."""
+    cores = available_cores()
+    workers = [1 << i for i in range(cores.bit_length()) if 1 << i < cores]
+    return workers + [cores]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the scaling of parallel kernels")
+    parser.add_argument(
+        "--kernels", nargs="+", choices=list(KERNELS), default=list(KERNELS)
+    )
+    parser.add_argument("--workers", nargs="+", type=int, default=default_workers())
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f32")
+    parser.add_argument("-O", "--opt-level", default=3, type=int)
+    parser.add_argument("--max-time", type=float, default=10.0)
+    args = parser.parse_args()
+
+    results = bench_parallel(
+        args.kernels, args.workers, args.dtype, args.opt_level, max_time_s=args.max_time
+    )
+    for kernel in args.kernels:
+        sequential = results[(kernel, 0)]["mean"]
+        one_worker = results[(kernel, args.workers[0])]["mean"]
+        for num_workers in [0, *args.workers]:
+            mean = results[(kernel, num_workers)]["mean"]
+            name = f"{num_workers} workers" if num_workers else "sequential"
+            print(
+                f"{kernel:18} {name:12} {mean / 1e3:12.2f} us"
+                f" {sequential / mean:6.2f}x vs sequential"
+                f" {one_worker / mean:6.2f}x vs {args.workers[0]} workers"
+            )
@@ -0,0 +1,82 @@
+"""Compares transform schedules (see `schedule.py`) of `linalg.matmul`: none
+(scalar loops), tiling, tiling and vectorization, and tiling with the loop
+over the columns peeled and the reduction loop unrolled.
+
+    python bench_schedule.py --shape 128x128x128 --dtype f32
+"""
+import argparse
+import sys
+
+import numpy as np
+
+import benchmark
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
+from linalg_tut import ELEMENT_TYPES, build_matmul
+from refbackend import RefBackendLinalgOnTensorsBackend
+from schedule import Schedule
+
+# Name -> schedules.
+SCHEDULES = {
+    "none": [],
+    "tile": [Schedule("linalg.matmul").tile([8, 16, 8])],
+    "tile+vectorize": [Schedule("linalg.matmul").tile([8, 16, 8]).vectorize()],
+    "tile+peel+unroll": [
+        Schedule("linalg.matmul").tile([8, 16, 8]).peel(1).unroll(2, loop=2)
+    ],
+}
+
+
+def bench_schedules(shape, dtype, names, opt_level=3, **measure_kwargs):
+    """Returns {name: stats} of a matmul of `shape` compiled with each of the
+    schedules `names`."""
+    bench = benchmark.Benchmark(
+        c_runner_utils_fp=MLIR_C_RUNNER_UTILS, runner_utils_fp=MLIR_RUNNER_UTILS
+    )
+    m, n, k = shape
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    args = [
+        np.random.uniform(size=(m, n)).astype(np_dtype),
+        np.random.uniform(size=(n, k)).astype(np_dtype),
+    ]
+    results = {}
+    for name in names:
+        lowered = RefBackendLinalgOnTensorsBackend.compile(
+            bench.wrap(build_matmul(m, n, k, dtype=dtype), "matmul"),
+            schedules=SCHEDULES[name],
+        )
+        stats = bench.measure(bench.load(lowered, opt_level), args, **measure_kwargs)
+        results[name] = stats
+        print(f"{name}: {stats['mean']:.2f}±{stats['ci']:.2f} ns", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark transform schedules of a matmul")
+    parser.add_argument(
+        "--shape",
+        default="128x128x128",
+        type=lambda s: tuple(int(d) for d in s.split("x")),
+        help="MxNxK",
+    )
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f32")
+    parser.add_argument(
+        "--schedules", nargs="+", choices=list(SCHEDULES), default=list(SCHEDULES)
+    )
+    parser.add_argument("-O", "--opt-level", default=3, type=int)
+    parser.add_argument("--max-time", type=float, default=5.0)
+    args = parser.parse_args()
+
+    results = bench_schedules(
+        args.shape,
+        args.dtype,
+        args.schedules,
+        args.opt_level,
+        max_time_s=args.max_time,
+    )
+    baseline = results[args.schedules[0]]["mean"]
+    for name in args.schedules:
+        mean = results[name]["mean"]
+        print(
+            f"{name:18} {mean / 1e3:12.2f} us"
+            f" {baseline / mean:6.2f}x vs {args.schedules[0]}"
+        )
@@ -0,0 +1,182 @@
+"""A benchmark suite built on `benchmark.Benchmark`: sweeps kernels over
+shapes, dtypes and lowering-pipeline variants, measures each configuration
+until its mean time is known to a given precision, stores the results as JSON
+and compares two result files for regressions.
+
+    python bench_suite.py run -o baseline.json
+    python bench_suite.py run -o candidate.json
+    python bench_suite.py compare baseline.json candidate.json
+
+`compare` exits with a non-zero status if any configuration regressed, so it
+can gate upgrades of the lowering pipelines.
+"""
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+import benchmark
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS, LLVM_VERSION
+from linalg_tut import ELEMENT_TYPES, build_matmul, lower_matmul
+
+# Pipeline variants: name -> function lowering a (wrapped) module in place.
+PIPELINES = {
+    "scalar": lambda module: lower_matmul(module, tile_size=0),
+    "tile-2": lambda module: lower_matmul(module, tile_size=2),
+    "tile-4": lambda module: lower_matmul(module, tile_size=4),
+}
+
+KERNELS = {
+    "matmul": lambda shape, dtype: build_matmul(*shape, dtype=dtype),
+}
+
+
+def make_args(kernel, shape, dtype):
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    if kernel == "matmul":
+        m, n, k = shape
+        return [
+            np.random.uniform(size=(m, n)).astype(np_dtype),
+            np.random.uniform(size=(n, k)).astype(np_dtype),
+        ]
+    raise ValueError(f"unknown kernel {kernel}")
+
+
+def sweep(kernels, shapes, dtypes, pipelines, **measure_kwargs):
+    """Measures every (kernel, shape, dtype, pipeline) combination and
+    returns one result record per combination."""
+    bench = benchmark.Benchmark(
+        c_runner_utils_fp=MLIR_C_RUNNER_UTILS, runner_utils_fp=MLIR_RUNNER_UTILS
+    )
+    results = []
+    for kernel, shape, dtype, pipeline in itertools.product(
+        kernels, shapes, dtypes, pipelines
+    ):
+        module = KERNELS[kernel](shape, dtype)
+        lowered = PIPELINES[pipeline](bench.wrap(module, kernel))
+        stats = bench.measure(
+            bench.load(lowered), make_args(kernel, shape, dtype), **measure_kwargs
+        )
+        results.append(
+            {
+                "kernel": kernel,
+                "shape": list(shape),
+                "dtype": dtype,
+                "pipeline": pipeline,
+                **stats,
+            }
+        )
+        print(
+            f"{kernel} {'x'.join(map(str, shape))} {dtype} {pipeline}: "
+            f"{stats['mean']:.2f}±{stats['ci']:.2f} ns"
+            + ("" if stats["converged"] else " (not converged)"),
+            file=sys.stderr,
+        )
+    return results
+
+
+def save_results(path, results):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "metadata": {
+                    "timestamp": time.time(),
+                    "llvm_version": LLVM_VERSION,
+                    "machine": platform.machine(),
+                    "processor": platform.processor(),
+                    "python": platform.python_version(),
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def result_key(result):
+    return (
+        result["kernel"],
+        tuple(result["shape"]),
+        result["dtype"],
+        result["pipeline"],
+    )
+
+
+def compare(baseline, candidate, threshold=0.05):
+    """Compares two lists of result records. A configuration regressed if its
+    mean time grew by more than `threshold` (relative) and the confidence
+    intervals of the two means do not overlap. Returns (regressions,
+    improvements) as lists of (key, baseline mean, candidate mean)."""
+    baseline = {result_key(r): r for r in baseline}
+    regressions, improvements = [], []
+    for cand in candidate:
+        key = result_key(cand)
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        change = (cand["mean"] - base["mean"]) / base["mean"]
+        overlap = abs(cand["mean"] - base["mean"]) <= cand["ci"] + base["ci"]
+        if overlap or abs(change) <= threshold:
+            continue
+        entry = (key, base["mean"], cand["mean"])
+        (regressions if change > 0 else improvements).append(entry)
+    return regressions, improvements
+
+
+def parse_shape(s):
+    return tuple(int(d) for d in s.split("x"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark suite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("-o", "--output", required=True)
+    run_parser.add_argument("--kernels", nargs="+", default=list(KERNELS))
+    run_parser.add_argument(
+        "--shapes", nargs="+", type=parse_shape, default=[(32, 32, 32), (64, 64, 64)]
+    )
+    run_parser.add_argument(
+        "--dtypes", nargs="+", choices=list(ELEMENT_TYPES), default=["f32", "f64"]
+    )
+    run_parser.add_argument("--pipelines", nargs="+", default=list(PIPELINES))
+    run_parser.add_argument("--rel-ci", type=float, default=0.01)
+    run_parser.add_argument("--max-time", type=float, default=10.0)
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.05)
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = sweep(
+            args.kernels,
+            args.shapes,
+            args.dtypes,
+            args.pipelines,
+            rel_ci=args.rel_ci,
+            max_time_s=args.max_time,
+        )
+        save_results(args.output, results)
+    elif args.command == "compare":
+        regressions, improvements = compare(
+            load_results(args.baseline),
+            load_results(args.candidate),
+            args.threshold,
+        )
+        for label, entries in [("regression", regressions), ("improvement", improvements)]:
+            for key, base, cand in entries:
+                print(f"{label}: {key}: {base:.2f} ns -> {cand:.2f} ns")
+        sys.exit(1 if regressions else 0)
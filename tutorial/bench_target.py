@@ -0,0 +1,102 @@
+"""Measures the named matmul and conv ops compiled for different targets:
+the JIT's default, the host CPU ("native"), the host CPU preferring 512-bit
+vectors (which LLVM avoids by default on AVX-512 parts, to limit frequency
+throttling) and a generic x86-64 baseline without AVX.
+
+    python bench_target.py --dtype f32
+    python bench_target.py --targets default native native-512
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+import benchmark
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
+from compiler_utils import mark_arguments_read_only, run_pipeline_with_repro_report
+from linalg_tut import ELEMENT_TYPES, affine_pipeline, build_conv_2d, build_matmul
+from mlir.execution_engine import host_target
+from refbackend import BUFFERIZATION_PIPELINE, LOWER_LLVM_PIPELINE
+
+# Target name -> ExecutionEngine target options.
+TARGETS = {
+    "default": {},
+    "native": {"target_cpu": "native"},
+    "native-256": {"target_cpu": "native", "prefer_vector_width": 256},
+    "native-512": {"target_cpu": "native", "prefer_vector_width": 512},
+    "x86-64": {"target_cpu": "x86-64"},
+}
+
+# Kernel name -> (builder, shapes of the arguments).
+KERNELS = {
+    "matmul": (
+        lambda dtype: build_matmul(128, 128, 128, dtype=dtype),
+        [(128, 128), (128, 128)],
+    ),
+    "conv_2d": (
+        lambda dtype: build_conv_2d(1, 16, 64, 64, 16, 3, 3, dtype=dtype),
+        [(1, 16, 64, 64), (16, 16, 3, 3)],
+    ),
+}
+
+
+def lower(module, tile_size=0):
+    mark_arguments_read_only(module)
+    run_pipeline_with_repro_report(
+        module,
+        BUFFERIZATION_PIPELINE() + affine_pipeline(tile_size) + LOWER_LLVM_PIPELINE,
+        "Lowering the benchmark to LLVM",
+    )
+    return module
+
+
+def bench_targets(kernels, targets, dtype, opt_level=3, **measure_kwargs):
+    """Returns {(kernel, target): stats}; every kernel is lowered once and
+    JIT compiled for each target."""
+    bench = benchmark.Benchmark(
+        c_runner_utils_fp=MLIR_C_RUNNER_UTILS, runner_utils_fp=MLIR_RUNNER_UTILS
+    )
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    results = {}
+    for kernel in kernels:
+        build, arg_shapes = KERNELS[kernel]
+        lowered = lower(bench.wrap(build(dtype), kernel))
+        args = [np.random.uniform(size=shape).astype(np_dtype) for shape in arg_shapes]
+        for target in targets:
+            engine = bench.load(lowered, opt_level, **TARGETS[target])
+            stats = bench.measure(engine, args, **measure_kwargs)
+            results[(kernel, target)] = stats
+            print(
+                f"{kernel} {dtype} {target}: {stats['mean']:.2f}±{stats['ci']:.2f} ns",
+                file=sys.stderr,
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark code generated for different targets")
+    parser.add_argument(
+        "--kernels", nargs="+", choices=list(KERNELS), default=list(KERNELS)
+    )
+    parser.add_argument(
+        "--targets", nargs="+", choices=list(TARGETS), default=list(TARGETS)
+    )
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f32")
+    parser.add_argument("-O", "--opt-level", default=3, type=int)
+    parser.add_argument("--max-time", type=float, default=5.0)
+    args = parser.parse_args()
+
+    host = host_target()
+    print(f"host: {host['triple']} {host['cpu']}")
+    results = bench_targets(
+        args.kernels, args.targets, args.dtype, args.opt_level, max_time_s=args.max_time
+    )
+    for kernel in args.kernels:
+        baseline = results[(kernel, args.targets[0])]["mean"]
+        for target in args.targets:
+            mean = results[(kernel, target)]["mean"]
+            print(
+                f"{kernel:10} {target:12} {mean / 1e3:12.2f} us"
+                f" {baseline / mean:6.2f}x vs {args.targets[0]}"
+            )
@@ -0,0 +1,122 @@
+"""Compares the vectorizing lowering pipeline (`VECTORIZE_PIPELINE`) with the
+scalar one, which lowers every linalg op to scalar loops and leaves
+vectorization to LLVM, on `linalg.matmul`, `linalg.conv_2d_nhwc_hwcf` and
+`linalg.elemwise_binary`, for several vector widths.
+
+    python bench_vectorize.py --dtype f32
+    python bench_vectorize.py --kernels matmul --vector-widths 4 8 16
+"""
+import argparse
+import sys
+
+import numpy as np
+
+import benchmark
+from compiler_utils import mark_arguments_read_only, run_pipeline_with_repro_report
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
+from linalg_tut import ELEMENT_TYPES, build_conv_2d_nhwc_hwcf, build_matmul
+from refbackend import (
+    BUFFERIZATION_PIPELINE,
+    LOWER_LLVM_PIPELINE,
+    VECTORIZE_PIPELINE,
+    with_vector_to_llvm,
+)
+from streaming import build_add
+
+# Kernel name -> (builder, shapes of the arguments).
+KERNELS = {
+    "matmul": (
+        lambda dtype: build_matmul(128, 128, 128, dtype=dtype),
+        [(128, 128), (128, 128)],
+    ),
+    "conv_2d_nhwc_hwcf": (
+        lambda dtype: build_conv_2d_nhwc_hwcf(1, 66, 66, 16, 3, 3, 32, dtype=dtype),
+        [(1, 66, 66, 16), (3, 3, 16, 32)],
+    ),
+    "elemwise_binary": (
+        lambda dtype: build_add(512, 512, dtype),
+        [(512, 512), (512, 512)],
+    ),
+}
+
+
+def lower(module, vector_width=0, contraction_lowering="outerproduct"):
+    """Lowers `module` with the scalar pipeline if `vector_width` is 0 and
+    with the vectorizing one otherwise."""
+    mark_arguments_read_only(module)
+    pipeline = BUFFERIZATION_PIPELINE()
+    if vector_width:
+        pipeline += VECTORIZE_PIPELINE(
+            vector_width, contraction_lowering
+        ) + with_vector_to_llvm(LOWER_LLVM_PIPELINE)
+    else:
+        pipeline += LOWER_LLVM_PIPELINE
+    run_pipeline_with_repro_report(module, pipeline, "Lowering the benchmark to LLVM")
+    return module
+
+
+def bench_vectorize(
+    kernels,
+    vector_widths,
+    dtype,
+    contraction_lowering="outerproduct",
+    opt_level=3,
+    **measure_kwargs,
+):
+    """Returns {(kernel, vector width): stats}, where vector width 0 is the
+    scalar pipeline."""
+    bench = benchmark.Benchmark(
+        c_runner_utils_fp=MLIR_C_RUNNER_UTILS, runner_utils_fp=MLIR_RUNNER_UTILS
+    )
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    results = {}
+    for kernel in kernels:
+        build, arg_shapes = KERNELS[kernel]
+        args = [np.random.uniform(size=shape).astype(np_dtype) for shape in arg_shapes]
+        for vector_width in [0, *vector_widths]:
+            lowered = lower(
+                bench.wrap(build(dtype), kernel), vector_width, contraction_lowering
+            )
+            stats = bench.measure(bench.load(lowered, opt_level), args, **measure_kwargs)
+            results[(kernel, vector_width)] = stats
+            print(
+                f"{kernel} {dtype} vector width {vector_width}: "
+                f"{stats['mean']:.2f}±{stats['ci']:.2f} ns",
+                file=sys.stderr,
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark the vectorizing pipeline")
+    parser.add_argument(
+        "--kernels", nargs="+", choices=list(KERNELS), default=list(KERNELS)
+    )
+    parser.add_argument("--vector-widths", nargs="+", type=int, default=[4, 8, 16])
+    parser.add_argument(
+        "--contraction-lowering",
+        choices=["outerproduct", "dot", "matmul", "parallelarith"],
+        default="outerproduct",
+    )
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f32")
+    parser.add_argument("-O", "--opt-level", default=3, type=int)
+    parser.add_argument("--max-time", type=float, default=5.0)
+    args = parser.parse_args()
+
+    results = bench_vectorize(
+        args.kernels,
+        args.vector_widths,
+        args.dtype,
+        args.contraction_lowering,
+        args.opt_level,
+        max_time_s=args.max_time,
+    )
+    for kernel in args.kernels:
+        scalar = results[(kernel, 0)]["mean"]
+        for vector_width in [0, *args.vector_widths]:
+            mean = results[(kernel, vector_width)]["mean"]
+            name = f"vector<{vector_width}>" if vector_width else "scalar"
+            print(
+                f"{kernel:18} {name:12} {mean / 1e3:12.2f} us"
+                f" {scalar / mean:6.2f}x vs scalar"
+            )
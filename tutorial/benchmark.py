@@ -3,7 +3,10 @@ contains benchmarks for both mlir sparse tensor dialect and numpy so that they
 can be compared against each other.
 """
 import ctypes
+import inspect
 import os
+import statistics
+import time
 
 import numpy as np
 
@@ -11,8 +14,9 @@ from mlir import ir
 from mlir.dialects import func, arith, memref, scf
 from mlir.execution_engine import ExecutionEngine
 from mlir.runtime import get_ranked_memref_descriptor
-from refbackend import assert_arg_type_is_supported
-from config import DEBUG
+from refbackend import tuned_opt_level, uses_async_runtime
+from refbackend_abi import as_memref_array
+from config import DEBUG, MLIR_ASYNC_RUNTIME
 
 
 def emit_timer_func() -> func.FuncOp:
@@ -124,17 +128,44 @@ class Benchmark:
 
         return main_module_with_benchmark
 
-    def run(self, main_module_with_benchmark, compiled_program_args: list):
-        engine = ExecutionEngine(
+    def load(self, main_module_with_benchmark, opt_level=None, **engine_kwargs):
+        """JIT compiles a wrapped and lowered module at `opt_level` (by default
+        the one it was tuned for, see `refbackend.tuned_opt_level`, or 3), so
+        that it can be `run` (or `measure`d) many times without recompiling.
+        `engine_kwargs` are
+        passed on to the `ExecutionEngine`, e.g. `perf_map=True` to attribute
+        the samples of `perf record` to the kernel. Modules lowered with
+        `PARALLEL_PIPELINE` are also linked with the async runtime."""
+        if opt_level is None:
+            opt_level = tuned_opt_level(main_module_with_benchmark, 3)
+        shared_libs = [self.c_runner_utils, self.runner_utils]
+        if uses_async_runtime(main_module_with_benchmark):
+            shared_libs.append(MLIR_ASYNC_RUNTIME)
+        return ExecutionEngine(
             main_module_with_benchmark,
-            3,
-            shared_libs=[self.c_runner_utils, self.runner_utils],
+            opt_level,
+            shared_libs=shared_libs,
+            **engine_kwargs,
         )
+
+    def run(
+        self, main_module_with_benchmark, compiled_program_args: list, **engine_kwargs
+    ):
+        """Runs the wrapped kernel `num_iterations` times and returns the
+        per-iteration times in ns. Accepts either a lowered module or an
+        ExecutionEngine returned by `load`; `engine_kwargs` are passed to
+        `load` in the former case. The arguments may be any objects
+        supporting the buffer protocol (see `as_memref_array`), e.g. arrays
+        memory-mapped from large files, and are not copied."""
+        engine = main_module_with_benchmark
+        if not isinstance(engine, ExecutionEngine):
+            engine = self.load(main_module_with_benchmark, **engine_kwargs)
         ffi_args = []
         for arg in compiled_program_args:
-            assert_arg_type_is_supported(arg.dtype)
             ffi_args.append(
-                ctypes.pointer(ctypes.pointer(get_ranked_memref_descriptor(arg)))
+                ctypes.pointer(
+                    ctypes.pointer(get_ranked_memref_descriptor(as_memref_array(arg)))
+                )
             )
         np_timers_ns = np.zeros(self.num_iterations, dtype=np.int64)
         ffi_args.append(
@@ -142,3 +173,107 @@ class Benchmark:
         )
         engine.invoke("main", *ffi_args)
         return np_timers_ns
+
+    def measure(self, main_module_with_benchmark, compiled_program_args, **kwargs):
+        """Runs the wrapped kernel until its mean time is known to the
+        requested precision; see `measure`, whose options (`rel_ci`,
+        `max_time_s`, ...) are taken from `kwargs`. Accepts either a lowered
+        module or an ExecutionEngine returned by `load`; the other `kwargs`
+        (`opt_level` and the engine options, e.g. `perf_map=True`) are passed
+        to `load` in the former case."""
+        measure_kwargs = {k: v for k, v in kwargs.items() if k in MEASURE_OPTIONS}
+        load_kwargs = {k: v for k, v in kwargs.items() if k not in MEASURE_OPTIONS}
+        engine = main_module_with_benchmark
+        if not isinstance(engine, ExecutionEngine):
+            engine = self.load(main_module_with_benchmark, **load_kwargs)
+        elif load_kwargs:
+            raise TypeError(
+                f"{', '.join(load_kwargs)} can't be applied to a loaded engine"
+            )
+        return measure(
+            lambda: self.run(engine, compiled_program_args), **measure_kwargs
+        )
+
+
+def reject_outliers(data, m=2.0):
+    """Drops samples further than `m` median absolute deviations from the
+    median."""
+    d = np.abs(data - np.median(data))
+    mdev = np.median(d)
+    s = d / mdev if mdev else np.zeros_like(d)
+    return data[s < m]
+
+
+def detect_warmup(samples, window=10, tolerance=0.1):
+    """Returns the number of leading samples taken before the timings reached
+    steady state: the start of the first `window` whose mean is within
+    `tolerance` (relative) of the median of the second half of `samples`."""
+    samples = np.asarray(samples)
+    if len(samples) < 2 * window:
+        return 0
+    steady = np.median(samples[len(samples) // 2 :])
+    for i in range(len(samples) - window + 1):
+        if abs(np.mean(samples[i : i + window]) - steady) <= tolerance * steady:
+            return i
+    return 0
+
+
+def confidence_interval(samples, confidence=0.95):
+    """Returns the half-width of the (normal approximation) confidence
+    interval of the mean of `samples`."""
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    return z * np.std(samples, ddof=1) / np.sqrt(len(samples))
+
+
+def measure(
+    sample_batch,
+    confidence=0.95,
+    rel_ci=0.01,
+    min_samples=100,
+    max_samples=100_000,
+    max_time_s=10.0,
+    outlier_mads=5.0,
+):
+    """Collects timing samples from `sample_batch()` (which returns an array of
+    times, e.g. `Benchmark.run`) until the confidence interval of the mean is
+    within `rel_ci` of the mean, or `max_samples`/`max_time_s` is exhausted.
+
+    Warmup samples at the start of the first batch are detected and dropped,
+    and samples more than `outlier_mads` median absolute deviations from the
+    median are rejected before computing the statistics. Returns a dict
+    of summary statistics (in the unit of the samples).
+    """
+    start = time.perf_counter()
+    samples = np.asarray(sample_batch())
+    warmup = detect_warmup(samples)
+    samples = samples[warmup:]
+    while True:
+        steady = reject_outliers(samples, outlier_mads)
+        mean = float(np.mean(steady))
+        ci = float(confidence_interval(steady, confidence)) if len(steady) > 1 else 0.0
+        converged = len(steady) >= min_samples and ci <= rel_ci * mean
+        if (
+            converged
+            or len(samples) >= max_samples
+            or time.perf_counter() - start >= max_time_s
+        ):
+            break
+        samples = np.concatenate([samples, sample_batch()])
+
+    return {
+        "mean": mean,
+        "ci": ci,
+        "confidence": confidence,
+        "median": float(np.median(steady)),
+        "std": float(np.std(steady)),
+        "min": float(np.min(steady)),
+        "num_samples": len(steady),
+        "num_outliers": len(samples) - len(steady),
+        "warmup": int(warmup),
+        "converged": bool(converged),
+    }
+
+
+# The options of `measure`, which `Benchmark.measure` tells apart from those of
+# `Benchmark.load`.
+MEASURE_OPTIONS = tuple(inspect.signature(measure).parameters)[1:]
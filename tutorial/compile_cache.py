@@ -0,0 +1,106 @@
+"""A content-addressed, on-disk cache for compilation artifacts (lowered
+modules, object files). Entries are files named by the SHA-256 of everything
+that determines their content; the least recently used entries are evicted
+once the cache grows past its size limit.
+"""
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from config import COMPILE_CACHE_DIR, LLVM_VERSION
+
+
+class CompilationCache:
+    def __init__(self, cache_dir=COMPILE_CACHE_DIR, max_size_bytes=1 << 30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Returns the content address for `parts`. The LLVM version is always
+        mixed in, since artifacts are not portable across LLVM versions."""
+        h = hashlib.sha256()
+        for part in (LLVM_VERSION,) + parts:
+            h.update(part if isinstance(part, bytes) else str(part).encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def path(self, key, suffix):
+        return self.cache_dir / (key + suffix)
+
+    def lookup(self, key, suffix):
+        """Returns the path of the entry, or None on a miss. A hit marks the
+        entry as most recently used."""
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def store(self, key, suffix, data: bytes):
+        return self.store_file(key, suffix, lambda fp: Path(fp).write_bytes(data))
+
+    def store_file(self, key, suffix, write):
+        """Stores the file produced by `write(path)` (e.g.
+        `ExecutionEngine.dump_to_object_file`) under `key`. The file is written
+        to a temporary name first so that concurrent readers never see a
+        partial entry."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(tmp_path)
+            path = self.path(key, suffix)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+        return path
+
+    def entries(self):
+        return [p for p in self.cache_dir.iterdir() if p.suffix != ".tmp"]
+
+    def stat_entries(self):
+        """Returns (stat, path) of the entries, skipping those that another
+        process evicted concurrently."""
+        entries = []
+        for p in self.entries():
+            try:
+                entries.append((p.stat(), p))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def size(self):
+        return sum(st.st_size for st, _ in self.stat_entries())
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in
+        `max_size_bytes`."""
+        entries = self.stat_entries()
+        entries.sort(key=lambda e: e[0].st_mtime)
+        total = sum(st.st_size for st, _ in entries)
+        for st, p in entries:
+            if total <= self.max_size_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+
+    def clear(self):
+        for p in self.entries():
+            p.unlink(missing_ok=True)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries()),
+            "size_bytes": self.size(),
+        }
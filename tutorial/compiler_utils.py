@@ -3,28 +3,70 @@
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 # Also available under a BSD-style license. See LICENSE.
 import ast
+import multiprocessing
 import os
+import re
+import resource
 import sys
 import tempfile
-from io import StringIO
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List
 
 from mlir._mlir_libs._mlir.ir import (
+    ArrayAttr,
+    BoolAttr,
+    Context,
+    DictAttr,
+    MemRefType,
+    Module,
     Operation,
     IntegerType,
+    RankedTensorType,
+    StringAttr,
+    UnrankedTensorType,
 )
 from mlir._mlir_libs._mlir.passmanager import PassManager
 
 from mlir.dialects import arith
+from pipeline import Pass, Pipeline, get_pass_manager, nest_func
 
-ONE_SHOT_BUFFERIZATION_PIPELINE = [
-    "func.func(linalg-init-tensor-to-alloc-tensor)",
+# Bufferizes the whole module at once, function signatures included, writing
+# in place wherever the analysis proves it safe. Buffers are not freed (see
+# `BUFFER_DEALLOCATION_PIPELINE`), and function results are allocated by the
+# callee, with identity layouts. Function arguments are considered writable,
+# so a kernel using an argument as `outs` writes into the caller's array,
+# unless they are marked otherwise (see `mark_arguments_read_only`).
+ONE_SHOT_BUFFERIZATION_PIPELINE = Pipeline(
+    nest_func("linalg-init-tensor-to-alloc-tensor"),
+    Pass(
+        "one-shot-bufferize",
+        bufferize_function_boundaries=True,
+        function_boundary_type_conversion="identity-layout-map",
+        allow_return_allocs=True,
+        create_deallocs=False,
+    ),
+    nest_func("canonicalize"),
+)
+
+# Same, but the function arguments get a fully dynamic strided layout, so that
+# the kernels read any view (slices, transposes, negative and zero strides) in
+# place. The strides and offset are then only known at run time, which costs
+# address computations and gets in the way of vectorization.
+STRIDED_ARGS_ONE_SHOT_BUFFERIZATION_PIPELINE = ONE_SHOT_BUFFERIZATION_PIPELINE.replace(
     "one-shot-bufferize",
-    "func-bufferize",
-    "arith-bufferize",
-    "func.func(finalizing-bufferize)",
-]
+    lambda p: p.with_options(function_boundary_type_conversion="infer-layout-map"),
+)
 
-LOWERING_PIPELINE = [
+# Moves allocations out of loops and as far up as their operands allow, then
+# frees every buffer that does not escape its function after its last use.
+BUFFER_DEALLOCATION_PIPELINE = Pipeline(
+    nest_func("buffer-hoisting", "buffer-loop-hoisting", "buffer-deallocation")
+)
+
+LOWERING_PIPELINE = Pipeline(
     # Lower to LLVM
     "convert-scf-to-cf",
     # "func.func(refback-expand-ops-for-llvm)",
@@ -33,44 +75,259 @@ LOWERING_PIPELINE = [
     # Handle some complex mlir::math ops (e.g. atan2)
     "convert-math-to-libm",
     "convert-linalg-to-llvm",
+    # `bufferization.clone`s inserted by `buffer-deallocation`.
+    "func.func(convert-bufferization-to-memref)",
     "convert-memref-to-llvm",
     "func.func(convert-arith-to-llvm)",
     "convert-func-to-llvm",
     "convert-cf-to-llvm",
     "reconcile-unrealized-casts",
-]
+)
+
+
+def mark_arguments_read_only(module):
+    """Marks the tensor arguments of the functions of `module` as not
+    writable (`bufferization.writable = false`), so that one-shot
+    bufferization copies them instead of writing into them, i.e. into the
+    arrays the caller passes."""
+    with module.context:
+        for op in module.body.operations:
+            op = op.operation
+            if op.name != "func.func" or not len(op.regions[0].blocks):
+                continue
+            arg_attrs = (
+                ArrayAttr(op.attributes["arg_attrs"])
+                if "arg_attrs" in op.attributes
+                else None
+            )
+            new_arg_attrs = []
+            for i, arg in enumerate(op.regions[0].blocks[0].arguments):
+                attrs = {}
+                if arg_attrs is not None:
+                    old = DictAttr(arg_attrs[i])
+                    attrs = {old[j].name: old[j].attr for j in range(len(old))}
+                if RankedTensorType.isinstance(
+                    arg.type
+                ) or UnrankedTensorType.isinstance(arg.type):
+                    attrs["bufferization.writable"] = BoolAttr.get(False)
+                new_arg_attrs.append(DictAttr.get(attrs))
+            op.attributes["arg_attrs"] = ArrayAttr.get(new_arg_attrs)
+    return module
+
+
+def repro_report(
+    description, diagnostics, pipeline, asm_for_error_report, filename=None
+):
+    """Writes the asm of a module that failed to compile to `filename` (by
+    default a temp file) and returns a message explaining how to reproduce the
+    failure."""
+    filename = filename or os.path.join(tempfile.gettempdir(), "tmp.mlir")
+    with open(filename, "w") as f:
+        f.write(asm_for_error_report)
+    debug_options = "-mlir-print-ir-after-all -mlir-disable-threading"
+    description = description or f"tmp compile"
+
+    message = f"""\
+        {description} failed with the following diagnostics:
+        {diagnostics}
+
+        For MLIR developers, the error can be reproduced with:
+        $ mlir-opt -pass-pipeline='{pipeline}' {filename}
+        Add '{debug_options}' to get the IR dump for debugging purpose.
+        """
+    return "\n".join([m.lstrip() for m in message.split("\n")])
+
+
+@dataclass
+class PassReport:
+    pipeline: str
+    wall_time_s: float
+    # High-water mark of the process RSS after the pass ran (it is never
+    # lowered by a later, smaller pass).
+    peak_rss_bytes: int
+
+
+@dataclass
+class PipelineReport:
+    pipeline: str
+    wall_time_s: float
+    peak_rss_bytes: int
+    passes: List[PassReport] = field(default_factory=list)
+    # `PassManager.get_pass_timings()` records, see `timing`.
+    pass_timings: List[dict] = field(default_factory=list)
+
+
+def peak_rss_bytes():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def run_pipeline_with_repro_report(
+    module,
+    pipeline,
+    description: str = None,
+    repro: str = "snapshot",
+    repro_path: str = None,
+    per_pass: bool = False,
+    timing: bool = False,
+) -> PipelineReport:
+    """Lowers `module` in place with `pipeline` (a `Pipeline`, or anything it
+    is built from, e.g. a pipeline string) and returns a `PipelineReport`. The
+    pass managers are reused while the modules share a context (see
+    `PassManagerCache`).
+
+    `repro` picks how the input asm for the repro report is captured:
+      * "snapshot": the module is cloned before running the pipeline and the
+        clone is only printed on failure (attributes, e.g. large constants,
+        are uniqued in the context, so the clone doesn't copy them);
+      * "on_failure": nothing is captured upfront and the module is printed
+        as the failing pipeline left it;
+      * "eager": the asm is printed before running the pipeline.
+    The repro is written to `repro_path` (by default a temp file).
+
+    With `per_pass`, the top-level passes of `pipeline` are run one at a time
+    and timed individually. With `timing`, the pass manager records the time
+    and statistics of every (nested) pass into `PipelineReport.pass_timings`.
+
+    Diagnostics are captured with a context diagnostic handler that only
+    claims diagnostics emitted on the calling thread, so several threads can
+    run pipelines concurrently (even in a shared context).
+    """
+    if repro not in {"snapshot", "on_failure", "eager"}:
+        raise ValueError(f"unknown repro mode {repro}")
+    context = module.context
+    thread_id = threading.get_ident()
+    diagnostics = []
+
+    def handler(diagnostic):
+        if threading.get_ident() != thread_id:
+            return False
+        diagnostics.append(f"{diagnostic.location}: {diagnostic.message}")
+        return True
+
+    def asm_of(m):
+        return m.operation.get_asm(large_elements_limit=10, enable_debug_info=True)
 
+    snapshot = asm_for_error_report = None
+    if repro == "snapshot":
+        snapshot = module.operation.clone(ip=False)
+    elif repro == "eager":
+        asm_for_error_report = asm_of(module)
 
-def run_pipeline_with_repro_report(module, pipeline: str, description: str = None):
+    pipeline = Pipeline(pipeline)
+    report = PipelineReport(str(pipeline), 0.0, 0)
+    stages = [Pipeline(item) for item in pipeline.items] if per_pass else [pipeline]
+    diagnostic_handler = context.attach_diagnostic_handler(handler)
     try:
-        original_stderr = sys.stderr
-        sys.stderr = StringIO()
-        asm_for_error_report = module.operation.get_asm(
-            large_elements_limit=10, enable_debug_info=True
-        )
         # Lower module in place to make it ready for compiler backends.
-        with module.context:
-            pm = PassManager.parse(pipeline)
-            pm.run(module)
+        with context:
+            for stage in stages:
+                start = time.perf_counter()
+                if timing:
+                    # Timing instruments the pass manager for good, so it
+                    # gets a fresh one.
+                    pm = PassManager.parse(str(stage))
+                    pm.enable_timing()
+                else:
+                    pm = get_pass_manager(stage, context)
+                pm.run(module)
+                if timing:
+                    report.pass_timings.extend(pm.get_pass_timings())
+                wall_time_s = time.perf_counter() - start
+                report.wall_time_s += wall_time_s
+                if per_pass:
+                    report.passes.append(
+                        PassReport(str(stage), wall_time_s, peak_rss_bytes())
+                    )
     except Exception as e:
-        filename = os.path.join(tempfile.gettempdir(), "tmp.mlir")
-        with open(filename, "w") as f:
-            f.write(asm_for_error_report)
-        debug_options = "-mlir-print-ir-after-all -mlir-disable-threading"
-        description = description or f"tmp compile"
-
-        message = f"""\
-            {description} failed with the following diagnostics:
-            {sys.stderr.getvalue()}
-
-            For MLIR developers, the error can be reproduced with:
-            $ mlir-opt -pass-pipeline='{pipeline}' {filename}
-            Add '{debug_options}' to get the IR dump for debugging purpose.
-            """
-        trimmed_message = "\n".join([m.lstrip() for m in message.split("\n")])
+        if snapshot is not None:
+            asm_for_error_report = asm_of(snapshot)
+        elif asm_for_error_report is None:
+            asm_for_error_report = asm_of(module)
+        trimmed_message = repro_report(
+            description,
+            "\n".join(diagnostics + [str(e)]),
+            str(pipeline),
+            asm_for_error_report,
+            repro_path,
+        )
         raise Exception(trimmed_message) from None
     finally:
-        sys.stderr = original_stderr
+        diagnostic_handler.detach()
+        if snapshot is not None:
+            snapshot.operation.erase()
+    report.peak_rss_bytes = peak_rss_bytes()
+    return report
+
+
+def _run_pipeline_in_worker(asm, pipeline):
+    """Parses `asm` and runs `pipeline` on it. Runs in a worker process of
+    `compile_many`; returns (lowered asm, None) or (None, diagnostics)."""
+    diagnostics = []
+
+    def handler(diagnostic):
+        diagnostics.append(f"{diagnostic.location}: {diagnostic.message}")
+        return True
+
+    with Context() as context:
+        context.attach_diagnostic_handler(handler)
+        try:
+            module = Module.parse(asm)
+            pm = PassManager.parse(pipeline)
+            pm.run(module)
+        except Exception as e:
+            return None, "\n".join(diagnostics + [str(e)])
+        return module.operation.get_asm(), None
+
+
+def compile_many(
+    modules,
+    pipeline,
+    workers=None,
+    description: str = None,
+    return_exceptions=False,
+):
+    """Runs a pass pipeline on each of `modules` in a pool of `workers`
+    processes and returns the lowered modules (parsed back into the context of
+    the corresponding input module; the inputs are left untouched).
+
+    `pipeline` is a `Pipeline` or pipeline string, or a list with one
+    pipeline per module (a ValueError is raised if the lengths differ).
+    The modules travel to the workers as asm, which also serves as the repro
+    on failure, so no repro asm is produced for modules that lower fine. On
+    failure an Exception with a repro report is raised, or, with
+    `return_exceptions`, returned in place of the failed module.
+    """
+    if isinstance(pipeline, (str, Pipeline)):
+        pipeline = [pipeline] * len(modules)
+    pipelines = [str(p) for p in pipeline]
+    if len(pipelines) != len(modules):
+        raise ValueError(
+            f"{len(pipelines)} pipelines given for {len(modules)} modules"
+        )
+    asms = [module.operation.get_asm(enable_debug_info=True) for module in modules]
+    # MLIR contexts own thread pools, which don't survive a fork.
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        outcomes = list(pool.map(_run_pipeline_in_worker, asms, pipelines))
+
+    lowered = []
+    for module, asm, pipeline, (lowered_asm, diagnostics) in zip(
+        modules, asms, pipelines, outcomes
+    ):
+        if lowered_asm is None:
+            fd, filename = tempfile.mkstemp(suffix=".mlir")
+            os.close(fd)
+            error = Exception(
+                repro_report(description, diagnostics, pipeline, asm, filename)
+            )
+            if not return_exceptions:
+                raise error
+            lowered.append(error)
+        else:
+            lowered.append(Module.parse(lowered_asm, module.context))
+    return lowered
 
 
 def traverse_op_region_block_iterators(op, handler):
@@ -85,6 +342,78 @@ def traverse_op_region_block_iterators(op, handler):
                     return res
 
 
+def memref_type_bytes(memref_type):
+    """Returns the size in bytes of a statically shaped memref type, else
+    None."""
+    memref_type = MemRefType(memref_type)
+    if not memref_type.has_static_shape:
+        return None
+    name = str(memref_type.element_type)
+    if name == "index":
+        bits = 64
+    else:
+        bits = int(re.findall(r"\d+", name)[-1])
+        if name.startswith("complex"):
+            bits *= 2
+    num_elements = 1
+    for dim in memref_type.shape:
+        num_elements *= dim
+    return num_elements * max(bits // 8, 1)
+
+
+# Memory operation -> (count key, bytes key) in `memory_report`.
+MEMORY_OPS = {
+    "memref.alloc": ("allocs", "alloc_bytes"),
+    "memref.alloca": ("allocas", "alloca_bytes"),
+    "memref.copy": ("copies", "copy_bytes"),
+}
+
+
+def memory_report(module):
+    """Returns {function name: counts} of the memory operations of the
+    bufferized `module`: the allocations (`allocs`, heap, and `allocas`,
+    stack) with their static sizes in bytes, the `deallocs`, and the
+    `memref.copy`s with the bytes they copy. Sizes of dynamically shaped
+    buffers are not known and counted in `dynamic`. Counts are of operations,
+    not of executions: an operation in a loop is counted once."""
+    report = {}
+    with module.context:
+        for func in module.body:
+            if func.operation.name != "func.func" or not func.regions[0].blocks:
+                continue
+            counts = {
+                "allocs": 0,
+                "alloc_bytes": 0,
+                "allocas": 0,
+                "alloca_bytes": 0,
+                "deallocs": 0,
+                "copies": 0,
+                "copy_bytes": 0,
+                "dynamic": 0,
+            }
+
+            def handler(op):
+                name = op.operation.name
+                if name == "memref.dealloc":
+                    counts["deallocs"] += 1
+                if name not in MEMORY_OPS:
+                    return
+                count_key, bytes_key = MEMORY_OPS[name]
+                counts[count_key] += 1
+                # The size of a copy is that of its source.
+                size = memref_type_bytes(
+                    op.operands[0].type if name == "memref.copy" else op.results[0].type
+                )
+                if size is None:
+                    counts["dynamic"] += 1
+                else:
+                    counts[bytes_key] += size
+
+            traverse_op_region_block_iterators(func.operation, handler)
+            report[StringAttr(func.attributes["sym_name"]).value] = counts
+    return report
+
+
 def parse_attrs_to_dict(attrs):
     d = {}
     for named_attr in attrs:
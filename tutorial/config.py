@@ -2,6 +2,8 @@ import os
 import platform
 from pathlib import Path
 
+from mlir.execution_engine import llvm_version
+
 shlib_ext = "dylib" if platform.system() == "Darwin" else "so"
 
 MLIR_C_RUNNER_UTILS = os.getenv(
@@ -24,5 +26,29 @@ MLIR_RUNNER_UTILS = os.getenv(
     ),
 )
 assert os.path.exists(MLIR_RUNNER_UTILS), "Runner utils not found"
+# Only needed by modules compiled with `parallel=True`.
+MLIR_ASYNC_RUNTIME = os.getenv(
+    "MLIR_ASYNC_RUNTIME",
+    str(
+        (
+            Path(__file__).parent.parent
+            / f"llvm_install/lib/libmlir_async_runtime.{shlib_ext}"
+        ).absolute()
+    ),
+)
 
 DEBUG = False
+
+# Version of the LLVM/MLIR the loaded bindings are built against; part of every
+# compilation cache key.
+LLVM_VERSION = llvm_version()
+COMPILE_CACHE_DIR = os.getenv(
+    "MLIR_COMPILE_CACHE_DIR",
+    str(Path.home() / ".cache" / "mlir_python_bindings"),
+)
+TUNING_DB_PATH = os.getenv(
+    "MLIR_TUNING_DB", str(Path(COMPILE_CACHE_DIR) / "tuning_db.json")
+)
+# Whether `lower_matmul` looks its parameters up in the tuning database by
+# default; set MLIR_USE_TUNING_DB=0 for builds that mustn't depend on it.
+USE_TUNING_DB = os.getenv("MLIR_USE_TUNING_DB", "1") != "0"
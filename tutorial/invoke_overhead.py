@@ -0,0 +1,72 @@
+"""Measures the per-call Python overhead of calling a JIT'd function through
+`ExecutionEngine.invoke`, a `BoundFunction` from `ExecutionEngine.get_callable`
+and `ExecutionEngine.invoke_arrays` (which marshals NumPy arrays natively). The
+kernel does nothing, so the measured time
+is (almost) entirely lookup, prototype creation and argument packing.
+"""
+import argparse
+import ctypes
+import time
+
+import numpy as np
+from mlir._mlir_libs._mlir.ir import Context, Module
+
+from compiler_utils import run_pipeline_with_repro_report
+from mlir.execution_engine import ExecutionEngine
+from mlir.runtime import get_ranked_memref_descriptor
+from refbackend import LOWER_LLVM_PIPELINE
+
+NOOP = """
+func.func @noop(%arg0: memref<16xf32>) attributes {llvm.emit_c_interface} {
+  return
+}
+"""
+
+
+def build_engine():
+    with Context():
+        module = Module.parse(NOOP)
+        run_pipeline_with_repro_report(module, LOWER_LLVM_PIPELINE)
+        return ExecutionEngine(module, opt_level=3)
+
+
+def time_per_call(fn, num_calls):
+    start = time.perf_counter_ns()
+    for _ in range(num_calls):
+        fn()
+    return (time.perf_counter_ns() - start) / num_calls
+
+
+def benchmark_invoke_overhead(num_calls):
+    engine = build_engine()
+    array = np.zeros(16, dtype=np.float32)
+    arg = ctypes.pointer(ctypes.pointer(get_ranked_memref_descriptor(array)))
+    bound = engine.get_callable("noop", [type(arg)])
+    bound.bind(arg)
+
+    invoke_ns = time_per_call(lambda: engine.invoke("noop", arg), num_calls)
+    rebind_ns = time_per_call(lambda: bound(arg), num_calls)
+    prebound_ns = time_per_call(bound, num_calls)
+    # Includes building the descriptor from the array, unlike the above.
+    arrays_ns = time_per_call(lambda: engine.invoke_arrays("noop", array), num_calls)
+    return invoke_ns, rebind_ns, prebound_ns, arrays_ns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Per-call overhead of ExecutionEngine calls")
+    parser.add_argument(
+        "-n",
+        "--num-calls",
+        default=100_000,
+        type=int,
+        help="Number of calls to average over",
+    )
+    args = parser.parse_args()
+
+    invoke_ns, rebind_ns, prebound_ns, arrays_ns = benchmark_invoke_overhead(
+        args.num_calls
+    )
+    print(f"ExecutionEngine.invoke:         {invoke_ns:.2f} ns/call")
+    print(f"BoundFunction(arg):             {rebind_ns:.2f} ns/call")
+    print(f"BoundFunction() (pre-bound):    {prebound_ns:.2f} ns/call")
+    print(f"invoke_arrays(array):           {arrays_ns:.2f} ns/call")
@@ -7,71 +7,192 @@ from mlir._mlir_libs._mlir.ir import (
     Module,
     InsertionPoint,
     RankedTensorType,
+    F32Type,
     F64Type,
 )
 
 import benchmark
-from compiler_utils import run_pipeline_with_repro_report
+from compiler_utils import (
+    mark_arguments_read_only,
+    run_pipeline_with_repro_report,
+    traverse_op_region_block_iterators,
+)
 from mlir.dialects import func, linalg
+from passes import unrolling_pipeline
+from pipeline import Pass, Pipeline, nest_func
 from refbackend import (
     RefBackendLinalgOnTensorsBackend,
     BUFFERIZATION_PIPELINE,
     LOWER_LLVM_PIPELINE,
+    set_tuned_opt_level,
 )
-from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS, DEBUG
+from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS, DEBUG, USE_TUNING_DB
+from tuning_db import TuningDatabase
 
 M = 32
 N = 32
 K = 32
 
 
-def build_matmul():
+ELEMENT_TYPES = {
+    "f32": (F32Type, np.float32),
+    "f64": (F64Type, np.float64),
+}
+
+
+def build_matmul(m=M, n=N, k=K, dtype="f64"):
     with Context(), Location.unknown():
         module = Module.create()
-        f64 = F64Type.get()
+        elem_type = ELEMENT_TYPES[dtype][0].get()
         with InsertionPoint(module.body):
 
             @func.FuncOp.from_py_func(
-                RankedTensorType.get((M, N), f64),
-                RankedTensorType.get((N, K), f64),
+                RankedTensorType.get((m, n), elem_type),
+                RankedTensorType.get((n, k), elem_type),
             )
             def matmul(lhs, rhs):
-                out = linalg.InitTensorOp([M, K], f64)
+                out = linalg.InitTensorOp([m, k], elem_type)
                 return linalg.matmul(lhs, rhs, outs=[out])
 
     return module
 
 
-def lower_matmul(module, tile_size=2, munge=False):
-    run_pipeline_with_repro_report(
-        module,
-        ",".join(BUFFERIZATION_PIPELINE(munge)),
-    )
-    if DEBUG:
-        print(module)
-    run_pipeline_with_repro_report(
-        module,
-        ",".join(
-            list(
-                filter(
-                    None,
-                    [
-                        "func.func(convert-linalg-to-affine-loops)",
-                        # f"func.func(affine-loop-unroll{{unroll-factor={unroll_factor} unroll-up-to-factor=1}})"
-                        f"func.func(affine-loop-tile{{tile-size={tile_size}}})"
-                        if tile_size > 0
-                        else None,
-                    ],
+def build_conv_2d(n=1, c=8, h=32, w=32, f=8, kh=3, kw=3, dtype="f64"):
+    """A `linalg.conv_2d_nchw_fchw` of an NCHW input with an FCHW filter
+    (unit strides and dilations, no padding)."""
+    with Context(), Location.unknown():
+        module = Module.create()
+        elem_type = ELEMENT_TYPES[dtype][0].get()
+        with InsertionPoint(module.body):
+
+            @func.FuncOp.from_py_func(
+                RankedTensorType.get((n, c, h, w), elem_type),
+                RankedTensorType.get((f, c, kh, kw), elem_type),
+            )
+            def conv_2d(input, filter):
+                out = linalg.InitTensorOp([n, f, h - kh + 1, w - kw + 1], elem_type)
+                return linalg.conv_2d_nchw_fchw(
+                    input, filter, outs=[out], strides=[1, 1], dilations=[1, 1]
                 )
+
+    return module
+
+
+def build_conv_2d_nhwc_hwcf(n=1, h=32, w=32, c=8, kh=3, kw=3, f=8, dtype="f64"):
+    """A `linalg.conv_2d_nhwc_hwcf` of an NHWC input with an HWCF filter
+    (unit strides and dilations, no padding), the layout the linalg
+    vectorizer handles."""
+    with Context(), Location.unknown():
+        module = Module.create()
+        elem_type = ELEMENT_TYPES[dtype][0].get()
+        with InsertionPoint(module.body):
+
+            @func.FuncOp.from_py_func(
+                RankedTensorType.get((n, h, w, c), elem_type),
+                RankedTensorType.get((kh, kw, c, f), elem_type),
             )
+            def conv_2d_nhwc_hwcf(input, filter):
+                out = linalg.InitTensorOp([n, h - kh + 1, w - kw + 1, f], elem_type)
+                return linalg.conv_2d_nhwc_hwcf(
+                    input, filter, outs=[out], strides=[1, 1], dilations=[1, 1]
+                )
+
+    return module
+
+
+def matmul_signature(module):
+    """Returns the (m, n, k) shape and the dtype of the first `linalg.matmul`
+    in `module`, or (None, None) if it has none."""
+    found = []
+
+    def handler(op):
+        if op.operation.name == "linalg.matmul":
+            lhs = RankedTensorType(op.operands[0].type)
+            rhs = RankedTensorType(op.operands[1].type)
+            found.append(
+                ((*lhs.shape, rhs.shape[1]), str(lhs.element_type))
+            )
+            return Exception("found")
+
+    with module.context:
+        traverse_op_region_block_iterators(module.operation, handler)
+    return found[0] if found else (None, None)
+
+
+def affine_pipeline(tile_size=0, tile_sizes=None, unroll_factor=0, unroll_jam_factor=0):
+    return Pipeline(
+        nest_func(
+            "convert-linalg-to-affine-loops",
+            Pass("affine-loop-tile", tile_sizes=tile_sizes)
+            if tile_sizes
+            else Pass("affine-loop-tile", tile_size=tile_size)
+            if tile_size > 0
+            else None,
+            Pass("affine-loop-unroll-jam", unroll_jam_factor=unroll_jam_factor)
+            if unroll_jam_factor > 1
+            else None,
         ),
+        unrolling_pipeline(unroll_factor) if unroll_factor > 1 else None,
+    )
+
+
+def matmul_pipeline(
+    tile_size=0, tile_sizes=None, unroll_factor=0, unroll_jam_factor=0, munge=False
+):
+    """The whole `lower_matmul` lowering as a single pipeline, for modules
+    whose arguments are marked read-only (see `mark_arguments_read_only`)."""
+    return (
+        BUFFERIZATION_PIPELINE(munge)
+        + affine_pipeline(tile_size, tile_sizes, unroll_factor, unroll_jam_factor)
+        + LOWER_LLVM_PIPELINE
     )
+
+
+def lower_matmul(
+    module,
+    tile_size=None,
+    munge=False,
+    tile_sizes=None,
+    unroll_factor=0,
+    unroll_jam_factor=0,
+    tuning_db=None,
+    use_tuning_db=USE_TUNING_DB,
+):
+    """Lowers a matmul module to LLVM. If neither `tile_size` nor `tile_sizes`
+    is given, the tiling and unrolling parameters come from the entry of
+    `tuning_db` (by default the one `autotune.py` writes) for the matmul's
+    shape and dtype, and default to a tile size of 2 if there is none. The
+    tuned JIT opt level is recorded on the module (see
+    `refbackend.tuned_opt_level`), so that loading it uses it. Deterministic
+    builds opt out of the lookup with `use_tuning_db=False` (or
+    MLIR_USE_TUNING_DB=0).
+    """
+    if tile_size is None and tile_sizes is None:
+        tile_size = 2
+        shape, dtype = matmul_signature(module)
+        config = None
+        if use_tuning_db and shape is not None:
+            config = (tuning_db or TuningDatabase()).lookup("matmul", shape, dtype)
+        if config is not None:
+            tile_size = 0
+            tile_sizes = config["tile_sizes"]
+            unroll_factor = config["unroll_factor"]
+            unroll_jam_factor = config["unroll_jam_factor"]
+            # Entries written before the opt level was tuned don't have one.
+            if "opt_level" in config:
+                set_tuned_opt_level(module, config["opt_level"])
+
+    mark_arguments_read_only(module)
+    run_pipeline_with_repro_report(module, BUFFERIZATION_PIPELINE(munge))
     if DEBUG:
         print(module)
     run_pipeline_with_repro_report(
         module,
-        ",".join(LOWER_LLVM_PIPELINE),
+        affine_pipeline(tile_size or 0, tile_sizes, unroll_factor, unroll_jam_factor),
     )
+    if DEBUG:
+        print(module)
+    run_pipeline_with_repro_report(module, LOWER_LLVM_PIPELINE)
     if DEBUG:
         print(module)
     return module
@@ -98,13 +219,6 @@ def test_matmul():
     run_matmul(module)
 
 
-def reject_outliers(data, m=2.0):
-    d = np.abs(data - np.median(data))
-    mdev = np.median(d)
-    s = d / mdev if mdev else 0.0
-    return data[s < m]
-
-
 def benchmark_matmul(tile_size):
     module = build_matmul()
     bench = benchmark.Benchmark(
@@ -114,9 +228,8 @@ def benchmark_matmul(tile_size):
     lowered_module = lower_matmul(main_module_with_benchmark, tile_size)
     mat1 = np.round(np.random.uniform(low=0.0, high=5, size=(M, N)))
     mat2 = np.round(np.random.uniform(low=0.0, high=5, size=(N, K)))
-    times = reject_outliers(bench.run(lowered_module, [mat1, mat2]))
-    # don't count the first/JIT warmup run
-    return np.mean(times[10:]), np.std(times[10:])
+    stats = bench.measure(lowered_module, [mat1, mat2])
+    return stats["mean"], stats["std"]
 
 
 if __name__ == "__main__":
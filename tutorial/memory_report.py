@@ -0,0 +1,122 @@
+"""Reports the memory traffic of kernels bufferized with the legacy
+per-dialect passes and with one-shot bufferization (see
+`RefBackendLinalgOnTensorsBackend.compile`): per kernel, the allocations,
+deallocations and copies left in the bufferized IR, with their sizes, and,
+with `--run`, the allocations made by one invocation, counted by an
+`Allocator`.
+
+    python memory_report.py
+    python memory_report.py --kernels matmul --out-params --run
+"""
+import argparse
+
+import numpy as np
+
+from compiler_utils import (
+    mark_arguments_read_only,
+    memory_report,
+    run_pipeline_with_repro_report,
+)
+from linalg_tut import ELEMENT_TYPES, build_conv_2d_nhwc_hwcf, build_matmul
+from mlir.execution_engine import Allocator
+from refbackend import BUFFERIZATION_PIPELINE, RefBackendLinalgOnTensorsBackend
+from refbackend_abi import OwnedMemRef
+from streaming import build_add
+
+MODES = {"legacy": False, "one-shot": True}
+
+# Kernel name -> (builder, shapes of the arguments, shape of the result).
+KERNELS = {
+    "matmul": (
+        lambda dtype: build_matmul(64, 64, 64, dtype=dtype),
+        [(64, 64), (64, 64)],
+        (64, 64),
+    ),
+    "conv_2d_nhwc_hwcf": (
+        lambda dtype: build_conv_2d_nhwc_hwcf(1, 34, 34, 8, 3, 3, 16, dtype=dtype),
+        [(1, 34, 34, 8), (3, 3, 8, 16)],
+        (1, 32, 32, 16),
+    ),
+    "elemwise_binary": (
+        lambda dtype: build_add(256, 256, dtype),
+        [(256, 256), (256, 256)],
+        (256, 256),
+    ),
+}
+
+
+def static_report(module, kernel, one_shot, out_params=False):
+    """Returns the `memory_report` counts of `kernel` in `module` bufferized
+    as `compile` bufferizes it in the given mode (with one-shot
+    bufferization, the arguments are read-only)."""
+    if one_shot:
+        mark_arguments_read_only(module)
+    run_pipeline_with_repro_report(
+        module,
+        BUFFERIZATION_PIPELINE(out_params=out_params, one_shot=one_shot),
+        "Bufferizing the kernel",
+    )
+    return memory_report(module)[kernel]
+
+
+def runtime_report(module, kernel, args, out, one_shot):
+    """Invokes `kernel` once, compiled in the given mode with generic
+    allocation (and out params if `out` is given), and returns the stats of
+    the allocator it allocated from."""
+    allocator = Allocator.malloc()
+    invoker = RefBackendLinalgOnTensorsBackend.load(
+        RefBackendLinalgOnTensorsBackend.compile(
+            module,
+            out_params=out is not None,
+            generic_allocation=True,
+            one_shot=one_shot,
+        ),
+        owned_results=True,
+        allocator=allocator,
+    )
+    result = invoker.invoke(kernel, *args, out=out)
+    if isinstance(result, OwnedMemRef):
+        result.free()
+    return allocator.stats()
+
+
+def report(kernels, dtype, out_params=False, run=False):
+    """Returns {(kernel, mode): counts}; with `run`, the counts include the
+    `runtime_allocations` and `runtime_bytes` of one invocation, and the
+    `runtime_leaked_bytes` still allocated after the result was freed."""
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    results = {}
+    for kernel in kernels:
+        build, arg_shapes, result_shape = KERNELS[kernel]
+        args = [np.random.uniform(size=shape).astype(np_dtype) for shape in arg_shapes]
+        for mode, one_shot in MODES.items():
+            counts = static_report(build(dtype), kernel, one_shot, out_params)
+            if run:
+                out = np.empty(result_shape, np_dtype) if out_params else None
+                stats = runtime_report(build(dtype), kernel, args, out, one_shot)
+                counts["runtime_allocations"] = stats["num_allocations"]
+                counts["runtime_bytes"] = stats["total_bytes"]
+                counts["runtime_leaked_bytes"] = stats["live_bytes"]
+            results[(kernel, mode)] = counts
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Report the memory traffic of bufferization")
+    parser.add_argument(
+        "--kernels", nargs="+", choices=list(KERNELS), default=list(KERNELS)
+    )
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f32")
+    parser.add_argument("--out-params", action="store_true")
+    parser.add_argument(
+        "--run", action="store_true", help="Also count the allocations at runtime"
+    )
+    args = parser.parse_args()
+
+    results = report(args.kernels, args.dtype, args.out_params, args.run)
+    columns = list(next(iter(results.values())))
+    print(f"{'kernel':18} {'mode':9} " + " ".join(f"{c:>12}" for c in columns))
+    for (kernel, mode), counts in results.items():
+        print(
+            f"{kernel:18} {mode:9} " + " ".join(f"{counts[c]:>12}" for c in columns)
+        )
@@ -4,6 +4,7 @@ from mlir._mlir_libs._mlir.ir import Type, Context, InsertionPoint, Location
 
 from mlir.dialects import memref
 from compiler_utils import add_dummy_value, traverse_op_region_block_iterators
+from pipeline import Pass, Pipeline, nest_func
 
 
 def promote_alloc(module):
@@ -81,11 +82,15 @@ def affine_store_load_forwarding(module):
 
 
 def unrolling_pipeline(unroll_factor):
-    return [
-        # f"func.func(affine-loop-unroll{{unroll-full unroll-full-threshold={unroll_factor}}})",
-        f"func.func(affine-loop-unroll{{unroll-factor={unroll_factor} unroll-up-to-factor=1}})"
-        if unroll_factor < 100
-        else f"func.func(affine-loop-unroll{{unroll-full unroll-full-threshold={unroll_factor}}})",
-        # f"func.func(affine-loop-unroll{{unroll-factor={unroll_factor} unroll-up-to-factor=0}})",
-        # f"func.func(affine-loop-unroll-jam{{unroll-jam-factor={unroll_factor}}})",
-    ]
+    return Pipeline(
+        nest_func(
+            # Pass("affine-loop-unroll", unroll_full=True, unroll_full_threshold=unroll_factor),
+            Pass("affine-loop-unroll", unroll_factor=unroll_factor, unroll_up_to_factor=True)
+            if unroll_factor < 100
+            else Pass(
+                "affine-loop-unroll", unroll_full=True, unroll_full_threshold=unroll_factor
+            ),
+            # Pass("affine-loop-unroll", unroll_factor=unroll_factor, unroll_up_to_factor=False),
+            # Pass("affine-loop-unroll-jam", unroll_jam_factor=unroll_factor),
+        )
+    )
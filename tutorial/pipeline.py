@@ -0,0 +1,314 @@
+"""Pass pipelines as objects rather than joined strings: `Pass`es with typed
+options, `Nest`s running a pipeline on nested operations (`func.func(...)`)
+and `Pipeline`s composing them with `+`:
+
+    tile = lambda sizes: nest_func(Pass("affine-loop-tile", tile_sizes=sizes))
+    pipeline = BUFFERIZATION_PIPELINE() + tile([4, 4]) + LOWER_LLVM_PIPELINE
+
+Strings and lists of strings in the textual syntax are accepted wherever a
+pipeline is, and parsed into objects. `str(pipeline)` is canonical (options
+sorted, adjacent nests on the same operation merged, as the pass manager
+merges them), so equal pipelines print the same and the string can key
+caches. `PassManagerCache` keeps the parsed `PassManager`s by pipeline, so
+compiling many kernels in one context parses each pipeline once.
+"""
+import threading
+from collections import OrderedDict
+
+from mlir._mlir_libs._mlir.ir import Context
+from mlir._mlir_libs._mlir.passmanager import PassManager
+
+
+def split_pipeline(pipeline: str):
+    """Splits a pipeline string at its top-level commas, e.g.
+    "a,func.func(b,c),d{x=1,2}" -> ["a", "func.func(b,c)", "d{x=1,2}"]."""
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(pipeline):
+        if c in "({":
+            depth += 1
+        elif c in ")}":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(pipeline[start:i].strip())
+            start = i + 1
+    parts.append(pipeline[start:].strip())
+    return [p for p in parts if p]
+
+
+def _split_options(options: str):
+    """Splits the options of a pass, e.g. "a=1 b={x=2} c" -> ["a=1", "b={x=2}",
+    "c"]."""
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(options):
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+        elif c == " " and depth == 0:
+            parts.append(options[start:i])
+            start = i + 1
+    parts.append(options[start:])
+    return [p for p in parts if p]
+
+
+def _format_option(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (list, tuple)):
+        return ",".join(_format_option(v) for v in value)
+    return str(value)
+
+
+class Pass:
+    """A pass and its options. Options are given as keyword arguments, with
+    `_` for `-` in their names; lists are comma separated, bools are 1/0 and
+    None leaves an option at its default:
+
+        Pass("affine-loop-tile", tile_sizes=[4, 4])
+        Pass("convert-memref-to-llvm", use_generic_functions=True)
+    """
+
+    def __init__(self, name, **options):
+        self.name = name
+        self.options = {
+            key.replace("_", "-"): _format_option(value)
+            for key, value in options.items()
+            if value is not None
+        }
+
+    @staticmethod
+    def parse(text):
+        """Parses "name" or "name{key=value ...}"; a key without a value
+        (a flag) is set to 1."""
+        name, _, options = text.strip().partition("{")
+        if options and not options.endswith("}"):
+            raise ValueError(f"malformed pass {text!r}")
+        parsed = {}
+        for option in _split_options(options[:-1]):
+            key, sep, value = option.partition("=")
+            parsed[key] = value if sep else True
+        return Pass(name.strip(), **parsed)
+
+    def with_options(self, **options):
+        """Returns a copy of the pass with `options` changed; None resets an
+        option to its default."""
+        copy = Pass(self.name)
+        copy.options = dict(self.options)
+        for key, value in options.items():
+            key = key.replace("_", "-")
+            if value is None:
+                copy.options.pop(key, None)
+            else:
+                copy.options[key] = _format_option(value)
+        return copy
+
+    def __str__(self):
+        if not self.options:
+            return self.name
+        options = " ".join(f"{k}={v}" for k, v in sorted(self.options.items()))
+        return f"{self.name}{{{options}}}"
+
+    def __repr__(self):
+        return f"Pass({str(self)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Pass) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class Nest:
+    """Runs `passes` (anything `Pipeline` accepts) on the operations named
+    `anchor` nested in the operation the enclosing pipeline runs on, e.g.
+    `Nest("func.func", "canonicalize")`."""
+
+    def __init__(self, anchor, *passes):
+        self.anchor = anchor
+        self.pipeline = Pipeline(*passes)
+
+    def __str__(self):
+        return f"{self.anchor}({self.pipeline})"
+
+    def __repr__(self):
+        return f"Nest({str(self)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Nest) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+def nest_func(*passes):
+    """Runs `passes` on every `func.func` of the module."""
+    return Nest("func.func", *passes)
+
+
+def _parse_item(text):
+    text = text.strip()
+    paren = text.find("(")
+    brace = text.find("{")
+    if paren != -1 and (brace == -1 or paren < brace):
+        if not text.endswith(")"):
+            raise ValueError(f"malformed nested pipeline {text!r}")
+        return Nest(text[:paren].strip(), text[paren + 1 : -1])
+    return Pass.parse(text)
+
+
+class Pipeline:
+    """A sequence of `Pass`es and `Nest`s. Built from any number of passes,
+    nests, pipelines, pipeline strings and lists of those, which are
+    flattened in order. Pipelines are immutable; `+` (with a pipeline or
+    anything it is built from, on either side) returns a new one.
+
+    Iterating yields the top-level items as strings, so pipelines can still be
+    joined and concatenated like the lists of pass strings they replace.
+    """
+
+    def __init__(self, *items):
+        self.items = ()
+        for item in items:
+            self._extend(item)
+
+    def _append(self, item):
+        last = self.items[-1] if self.items else None
+        if isinstance(item, Nest) and isinstance(last, Nest):
+            if item.anchor == last.anchor:
+                merged = Nest(last.anchor, last.pipeline, item.pipeline)
+                self.items = self.items[:-1] + (merged,)
+                return
+        self.items += (item,)
+
+    def _extend(self, item):
+        if isinstance(item, Pipeline):
+            for i in item.items:
+                self._append(i)
+        elif isinstance(item, (Pass, Nest)):
+            self._append(item)
+        elif isinstance(item, str):
+            for part in split_pipeline(item):
+                self._append(_parse_item(part))
+        elif item is None:
+            return
+        else:
+            for i in item:
+                self._extend(i)
+
+    def __add__(self, other):
+        return Pipeline(self, other)
+
+    def __radd__(self, other):
+        return Pipeline(other, self)
+
+    def __iter__(self):
+        return (str(item) for item in self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def __str__(self):
+        return ",".join(str(item) for item in self.items)
+
+    def __repr__(self):
+        return f"Pipeline({str(self)!r})"
+
+    def __eq__(self, other):
+        if isinstance(other, (str, list, tuple)):
+            other = Pipeline(other)
+        return isinstance(other, Pipeline) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def passes(self):
+        """Returns the `Pass`es of the pipeline, nested ones included, in
+        order."""
+        passes = []
+        for item in self.items:
+            if isinstance(item, Nest):
+                passes.extend(item.pipeline.passes())
+            else:
+                passes.append(item)
+        return passes
+
+    def replace(self, name, replacement):
+        """Returns the pipeline with every pass named `name`, nested ones
+        included, replaced by `replacement`: a pipeline (or anything it is
+        built from), or a function of the pass returning one."""
+        items = []
+        for item in self.items:
+            if isinstance(item, Nest):
+                items.append(Nest(item.anchor, item.pipeline.replace(name, replacement)))
+            elif item.name == name:
+                items.append(replacement(item) if callable(replacement) else replacement)
+            else:
+                items.append(item)
+        return Pipeline(*items)
+
+
+class PassManagerCache:
+    """Caches the `PassManager`s parsed from pipelines by canonical pipeline
+    string, so that running the same pipeline again skips parsing it (and
+    building its passes).
+
+    A pass manager lives in the context it was parsed in, and only the pass
+    managers of the last context used are kept: getting a pipeline in another
+    context parses it again and drops the pass managers of the previous one
+    (releasing that context). Compiling many kernels therefore only hits the
+    cache if their modules share a context, which the `build_*` helpers,
+    creating a context per module, don't.
+
+    A pass manager must not run on several threads at once, so every thread
+    has its own cache, of at most `max_pipelines` pipelines, the least
+    recently used being evicted.
+    """
+
+    def __init__(self, max_pipelines=64):
+        self.max_pipelines = max_pipelines
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    def _pass_managers(self, context):
+        """Returns {pipeline: PassManager} of `context` on this thread."""
+        local = self._local
+        if getattr(local, "context", None) is not context:
+            # Destroy the pass managers before the context they live in.
+            local.pass_managers = OrderedDict()
+            local.context = context
+        return local.pass_managers
+
+    def get(self, pipeline, context=None):
+        """Returns the pass manager of `pipeline` (a `Pipeline` or anything it
+        is built from) in `context`, by default the current one."""
+        context = context or Context.current
+        pipeline = str(Pipeline(pipeline))
+        pass_managers = self._pass_managers(context)
+        pm = pass_managers.get(pipeline)
+        if pm is not None:
+            self.hits += 1
+            pass_managers.move_to_end(pipeline)
+            return pm
+        self.misses += 1
+        pm = PassManager.parse(pipeline, context=context)
+        pass_managers[pipeline] = pm
+        if len(pass_managers) > self.max_pipelines:
+            pass_managers.popitem(last=False)
+        return pm
+
+    def clear(self):
+        """Drops the pass managers (and the context) cached on this thread."""
+        self._local.pass_managers = OrderedDict()
+        self._local.context = None
+
+
+PASS_MANAGER_CACHE = PassManagerCache()
+
+
+def get_pass_manager(pipeline, context=None):
+    """Returns the pass manager of `pipeline` from `PASS_MANAGER_CACHE`."""
+    return PASS_MANAGER_CACHE.get(pipeline, context)
@@ -0,0 +1,68 @@
+"""Profiles the RefBackend pipelines per pass on the matmul from `linalg_tut`,
+using the pass timing instrumentation of the PassManager:
+
+    python profile_pipelines.py --shape 128x128x128 --top 10
+    python profile_pipelines.py --json timings.json
+"""
+import argparse
+import json
+
+from compiler_utils import mark_arguments_read_only, run_pipeline_with_repro_report
+from linalg_tut import ELEMENT_TYPES, build_matmul
+from refbackend import BUFFERIZATION_PIPELINE, LOWER_LLVM_PIPELINE
+
+PIPELINES = {
+    "bufferization": lambda: BUFFERIZATION_PIPELINE(munge=True),
+    "lower-llvm": lambda: LOWER_LLVM_PIPELINE,
+}
+
+
+def profile(shape, dtype, disable_threading=False):
+    """Returns pipeline name -> pass timings of lowering a matmul through the
+    RefBackend pipelines in order."""
+    module = mark_arguments_read_only(build_matmul(*shape, dtype=dtype))
+    # The CPU time is per process, so it is only attributable to a pass when
+    # passes don't run concurrently.
+    module.context.enable_multithreading(not disable_threading)
+    timings = {}
+    for name, pipeline in PIPELINES.items():
+        report = run_pipeline_with_repro_report(
+            module, pipeline(), f"Profiling {name}", timing=True
+        )
+        timings[name] = report.pass_timings
+    return timings
+
+
+def print_timings(name, timings, top=None):
+    total = sum(t["wall_time"] for t in timings if t["parent"] is None)
+    print(f"{name}: {total * 1e3:.3f} ms")
+    rows = sorted(timings, key=lambda t: t["wall_time"], reverse=True)[:top]
+    for t in rows:
+        counters = ", ".join(f"{k}={v}" for k, v in t["statistics"].items())
+        print(
+            f"  {t['wall_time'] * 1e3:9.3f} ms {t['cpu_time'] * 1e3:9.3f} ms cpu "
+            f"{'  ' * t['depth']}{t['argument'] or t['name']} on {t['op']} "
+            f"(x{t['count']}){' ' + counters if counters else ''}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Per-pass profile of the RefBackend pipelines")
+    parser.add_argument(
+        "--shape",
+        default="32x32x32",
+        type=lambda s: tuple(int(d) for d in s.split("x")),
+        help="MxNxK",
+    )
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f64")
+    parser.add_argument("--top", default=None, type=int)
+    parser.add_argument("--disable-threading", action="store_true")
+    parser.add_argument("--json", default=None, help="Write the timings here")
+    args = parser.parse_args()
+
+    timings = profile(args.shape, args.dtype, args.disable_threading)
+    for name, pipeline_timings in timings.items():
+        print_timings(name, pipeline_timings, args.top)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(timings, f, indent=2)
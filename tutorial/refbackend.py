@@ -3,60 +3,74 @@
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 # Also available under a BSD-style license. See LICENSE.
 
-import ctypes
-
-import numpy as np
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 __all__ = [
     "RefBackendLinalgOnTensorsBackend",
 ]
 
-from mlir._mlir_libs._mlir.ir import Module
+from mlir._mlir_libs._mlir.ir import (
+    ArrayAttr,
+    BoolAttr,
+    IntegerAttr,
+    IntegerType,
+    Module,
+    StringAttr,
+)
 
-from mlir.execution_engine import ExecutionEngine
+from mlir.execution_engine import (
+    ExecutionEngine,
+    allocator_free,
+    host_target,
+    resolve_target_options,
+)
 
-from mlir.runtime import (
-    UnrankedMemRefDescriptor,
-    unranked_memref_to_numpy,
-    get_unranked_memref_descriptor,
+from compile_cache import CompilationCache
+from compiler_utils import (
+    BUFFER_DEALLOCATION_PIPELINE,
+    ONE_SHOT_BUFFERIZATION_PIPELINE,
+    STRIDED_ARGS_ONE_SHOT_BUFFERIZATION_PIPELINE,
+    mark_arguments_read_only,
+    run_pipeline_with_repro_report,
 )
+from pipeline import Pass, Pipeline, nest_func
+from config import MLIR_ASYNC_RUNTIME, MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
+from schedule import TRANSFORM_INTERPRETER_PIPELINE, build_transform_script
+from refbackend_abi import (
+    CONSUME_RETURN_FUNC_PREFIX,
+    OwnedMemRef,
+    as_memref_args,
+    assert_arg_type_is_supported,
+    get_ctype_func,
+    make_consume_return_callback,
+    make_result_slots,
+    memref_arg_pointers,
+    read_result_slots,
+)
+
+
+# Module attribute with the JIT opt level a module was tuned for (see
+# `linalg_tut.lower_matmul`), used when loading it without an opt level.
+TUNED_OPT_LEVEL_ATTR = "refback.opt_level"
+
+
+def set_tuned_opt_level(module, opt_level):
+    with module.context:
+        module.operation.attributes[TUNED_OPT_LEVEL_ATTR] = IntegerAttr.get(
+            IntegerType.get_signless(64), opt_level
+        )
 
-from compiler_utils import run_pipeline_with_repro_report
-from config import MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS
-
-
-def assert_arg_type_is_supported(ty):
-    SUPPORTED = [
-        np.float32,
-        np.float64,
-        np.uint8,
-        np.int8,
-        np.int32,
-        np.int64,
-        np.bool_,
-    ]
-    assert (
-        ty in SUPPORTED
-    ), f"Only numpy arrays with dtypes in {SUPPORTED} are supported"
-
-
-memref_type_to_np_dtype = {
-    "mrf32": np.float32,
-    "mrf64": np.float64,
-    "mri1": np.bool_,
-    "mri8": np.int8,
-    "mri32": np.int32,
-    "mri64": np.int64,
-}
-elemental_type_to_ctype = {
-    "i1": ctypes.c_bool,
-    "i8": ctypes.c_byte,
-    "i64": ctypes.c_int,
-    "f32": ctypes.c_float,
-    "f64": ctypes.c_double,
-}
-
-CONSUME_RETURN_FUNC_PREFIX = "refbackend_consume_func_return_"
+
+def tuned_opt_level(module, default):
+    """Returns the opt level `module` was tuned for, or `default`."""
+    attributes = module.operation.attributes
+    if TUNED_OPT_LEVEL_ATTR not in attributes:
+        return default
+    return IntegerAttr(attributes[TUNED_OPT_LEVEL_ATTR]).value
 
 
 def get_return_funcs(module):
@@ -66,100 +80,372 @@ def get_return_funcs(module):
         for func in module.body:
             # Returns strings of the form `"refbackend.."` so `"` is deleted.
             func_name = str(func.attributes["sym_name"]).replace('"', "")
-            if func_name[:return_prefix_len] == CONSUME_RETURN_FUNC_PREFIX:
+            # Functions without results (e.g. compiled with out params) call
+            # the consume function with no type suffix.
+            if (
+                func_name[:return_prefix_len] == CONSUME_RETURN_FUNC_PREFIX
+                or func_name == CONSUME_RETURN_FUNC_PREFIX[:-1]
+            ):
                 return_funcs.append(func_name)
 
     return return_funcs
 
 
-def get_ctype_func(func_name):
-    return_prefix_len = len(CONSUME_RETURN_FUNC_PREFIX)
-    ret_types = func_name[return_prefix_len:].split("_")
-    ctypes_arg = [None]
-    for type in ret_types:
-        if type in elemental_type_to_ctype:
-            ctypes_arg.append(elemental_type_to_ctype[type])
-        elif type in memref_type_to_np_dtype:
-            ctypes_arg.append(ctypes.POINTER(UnrankedMemRefDescriptor))
-        else:
-            assert False, f"Not supported type: {type}"
+def get_strided_args(module):
+    """Returns function name -> [whether the argument takes views with any
+    strides], for the functions munged with arguments of a strided layout;
+    the arguments of the others must be C-contiguous."""
+    strided_args = {}
+    with module.context:
+        for func in module.body:
+            attributes = func.attributes
+            if "refback.strided_args" not in attributes:
+                continue
+            func_name = StringAttr(attributes["sym_name"]).value
+            # The C interface wrapper inherits the attributes.
+            if func_name.startswith("_mlir_ciface_"):
+                continue
+            strided_args[func_name] = [
+                BoolAttr(strided).value
+                for strided in ArrayAttr(attributes["refback.strided_args"])
+            ]
+    return strided_args
+
+
+def get_result_specs(module):
+    """Returns function name -> [(type token, rank)] of its results, for the
+    functions munged with `results-as-out-args`."""
+    specs = {}
+    with module.context:
+        for func in module.body:
+            attributes = func.attributes
+            if "refback.result_types" not in attributes:
+                continue
+            func_name = StringAttr(attributes["sym_name"]).value
+            # The C interface wrapper inherits the attributes.
+            if func_name.startswith("_mlir_ciface_"):
+                continue
+            specs[func_name] = [
+                (StringAttr(token).value, IntegerAttr(rank).value)
+                for token, rank in zip(
+                    ArrayAttr(attributes["refback.result_types"]),
+                    ArrayAttr(attributes["refback.result_ranks"]),
+                )
+            ]
+    return specs
 
-    return ctypes.CFUNCTYPE(*ctypes_arg), ret_types
 
+# Called instead of malloc/aligned_alloc/free by code lowered with
+# `convert-memref-to-llvm{use-generic-functions=1}`.
+GENERIC_ALLOCATION_FUNCS = {"_mlir_alloc", "_mlir_aligned_alloc", "_mlir_free"}
 
-class RefBackendInvoker:
-    def __init__(self, module):
-        shared_libs = [
-            MLIR_C_RUNNER_UTILS,
-            MLIR_RUNNER_UTILS,
-        ]
-        self.ee = ExecutionEngine(module, shared_libs=shared_libs)
-        self.result = None
 
+# The `ExecutionEngine` options that change the generated code.
+TARGET_OPTIONS = (
+    "target_triple",
+    "target_cpu",
+    "target_features",
+    "prefer_vector_width",
+)
+
+
+def object_cache_key(
+    cache, module, opt_level, engine_kwargs=None, position_independent=False
+):
+    """Returns the cache key of the object file the JIT generates for the
+    lowered `module`, or with `position_independent` of the one
+    `compile_to_object_file` generates for a shared library. Besides the module
+    and `opt_level`, it depends on the target options in `engine_kwargs` (with
+    "native" resolved) and on the host, whose CPU the code is generated for by
+    default."""
+    target_options = resolve_target_options(
+        **{k: v for k, v in (engine_kwargs or {}).items() if k in TARGET_OPTIONS}
+    )
+    return cache.key(
+        module.operation.get_asm(),
+        opt_level,
+        sorted(target_options.items()),
+        sorted(host_target().items()),
+        position_independent,
+    )
+
+
+def uses_generic_allocation(module):
+    with module.context:
+        return any(
+            StringAttr(op.attributes["sym_name"]).value in GENERIC_ALLOCATION_FUNCS
+            for op in module.body
+            if "sym_name" in op.attributes
+        )
+
+
+# Prefix of the functions of the async runtime called by code lowered with
+# `convert-async-to-llvm`.
+ASYNC_RUNTIME_FUNC_PREFIX = "mlirAsyncRuntime"
+
+
+def uses_async_runtime(module):
+    with module.context:
+        return any(
+            StringAttr(op.attributes["sym_name"]).value.startswith(
+                ASYNC_RUNTIME_FUNC_PREFIX
+            )
+            for op in module.body
+            if "sym_name" in op.attributes
+        )
+
+
+def runtime_shared_libs(module):
+    """Returns the runtime libraries the lowered `module` must be loaded
+    with: the runner utils and, for modules compiled with `parallel=True`,
+    the async runtime."""
+    shared_libs = [MLIR_C_RUNNER_UTILS, MLIR_RUNNER_UTILS]
+    if uses_async_runtime(module):
+        if not os.path.exists(MLIR_ASYNC_RUNTIME):
+            raise FileNotFoundError(
+                f"{MLIR_ASYNC_RUNTIME} does not exist. Please pass a valid value"
+                f" for the MLIR_ASYNC_RUNTIME environment variable."
+            )
+        shared_libs.append(MLIR_ASYNC_RUNTIME)
+    return shared_libs
+
+
+class RefBackendInvoker:
+    """Invokes the functions of a module lowered by the RefBackend.
+
+    Invocations are thread-safe: results are handed back through a
+    thread-local slot (the consume-return callbacks run on the invoking
+    thread) and the memref descriptors of the arguments are built natively,
+    per call, by `ExecutionEngine.invoke_arrays`, which also releases the GIL
+    for the duration of the call, so invocations from several threads run in
+    parallel.
+
+    Memref results are zero-copy views of buffers allocated by the kernel.
+    With `owned_results=True` they are returned as `OwnedMemRef`s, which free
+    those buffers deterministically; otherwise the buffers are never freed.
+    Modules compiled with `out_params=True` instead write their results into
+    arrays the caller passes as `out=`. Modules compiled with
+    `results_as_out_args=True` store their results to slots the invoker
+    passes as extra arguments, which are decoded after the call, so no Python
+    callback runs inside the kernel.
+
+    Modules compiled with `generic_allocation=True` allocate from the
+    `allocator` given here (an `mlir.execution_engine.Allocator`, e.g. a
+    pool reused across calls), or else from the default allocator. An arena
+    can only be `reset()` once all its allocations are freed, so use it with
+    `owned_results=True` and free the results first.
+
+    `engine_kwargs` are passed on to the `ExecutionEngine`, e.g.
+    `perf_map=True` to profile the kernels with perf.
+    """
+
+    def __init__(
+        self,
+        module,
+        opt_level=2,
+        owned_results=False,
+        allocator=None,
+        **engine_kwargs,
+    ):
+        shared_libs = runtime_shared_libs(module)
+        self.ee = ExecutionEngine(
+            module, opt_level, shared_libs=shared_libs, **engine_kwargs
+        )
+        self._local = threading.local()
+        self.owned_results = owned_results
+        self.allocator = allocator
+        free_fn = None
+        if uses_generic_allocation(module):
+            self.ee.enable_allocator_hooks()
+            free_fn = allocator_free
+
+        self._free_fn = free_fn
+        self._result_specs = get_result_specs(module)
+        self._strided_args = get_strided_args(module)
         return_funcs = get_return_funcs(module)
 
         for ret_func in return_funcs:
             ctype_wrapper, ret_types = get_ctype_func(ret_func)
+            consume_return_funcs = make_consume_return_callback(
+                ret_types, self._local, owned_results, free_fn
+            )
+            self.ee.register_runtime(ret_func, ctype_wrapper(consume_return_funcs))
 
-            def consume_return_funcs(*args):
-                self.result = tuple(
-                    [
-                        arg
-                        if type in elemental_type_to_ctype
-                        else unranked_memref_to_numpy(
-                            arg, memref_type_to_np_dtype[type]
-                        )
-                        for arg, type in zip(args, ret_types)
-                    ]
+    def _thread_state(self):
+        local = self._local
+        if not hasattr(local, "result"):
+            local.result = None
+        return local
+
+    def _call(self, function_name, args):
+        if self.allocator is None:
+            self.ee.invoke_arrays(function_name, *args, unranked=True)
+            return
+        with self.allocator:
+            self.ee.invoke_arrays(function_name, *args, unranked=True)
+
+    def invoke(self, function_name, *args, out=None):
+        """Invokes `function_name` on `args`, arrays or other objects
+        supporting the buffer protocol (see `as_memref_array`), which are
+        passed without copying. For a module compiled with `out_params=True`,
+        the results are written into the `out` array (or tuple of arrays),
+        which is also returned.
+        """
+        outs = () if out is None else out if isinstance(out, tuple) else (out,)
+        args = as_memref_args(args + outs, self._strided_args.get(function_name))
+        local = self._thread_state()
+        arg_pointers = None
+        if self.owned_results:
+            arg_pointers = local.arg_pointers = memref_arg_pointers(args)
+
+        result_specs = self._result_specs.get(function_name)
+        if result_specs is not None:
+            slots = make_result_slots(result_specs)
+            self._call(function_name, args + tuple(slots))
+            if not slots:
+                return out
+            result = read_result_slots(
+                slots, result_specs, arg_pointers, self._free_fn
+            )
+            return result if out is None else out
+
+        self._call(function_name, args)
+        result = local.result
+        assert result is not None, "Invocation didn't produce a result"
+        local.result = None
+        return result if out is None else out
+
+    def invoke_batch(self, function_name, list_of_arg_tuples, workers=None):
+        """Invokes `function_name` once per tuple of arguments, fanning the
+        calls out over a pool of `workers` threads (default: one per core).
+        Returns the results in the order of `list_of_arg_tuples`.
+        """
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            return list(
+                pool.map(
+                    lambda args: self.invoke(function_name, *args),
+                    list_of_arg_tuples,
                 )
-                if len(self.result) == 1:
-                    self.result = self.result[0]
-
-            self.ee.register_runtime(ret_func, ctype_wrapper(consume_return_funcs))
+            )
 
     def __getattr__(self, function_name: str):
-        def invoke(*args):
-            ffi_args = []
-            for arg in args:
-                assert_arg_type_is_supported(arg.dtype)
-                ffi_args.append(
-                    ctypes.pointer(ctypes.pointer(get_unranked_memref_descriptor(arg)))
-                )
+        def invoke(*args, out=None):
+            return self.invoke(function_name, *args, out=out)
+
+        return invoke
+
+
+class AsyncRefBackendInvoker:
+    """Awaitable counterpart of `RefBackendInvoker`:
+
+        invoker = AsyncRefBackendInvoker(RefBackendInvoker(module))
+        result = await invoker.forward(a, b)
+
+    Every call runs `RefBackendInvoker.invoke` (thread-safe, GIL released in
+    the kernel) on `executor`, by default a thread pool of `max_concurrency`
+    workers (one per core). At most `max_concurrency` calls are in flight;
+    further callers wait, so a busy event loop gets backpressure instead of an
+    unbounded executor queue. Use the invoker from a single event loop.
 
-            self.ee.invoke(function_name, *ffi_args)
-            result = self.result
-            assert result is not None, "Invocation didn't produce a result"
-            self.result = None
-            return result
+    The default thread pool is shut down by `close` (or on leaving a `with`
+    block); a caller supplied `executor` is left to the caller.
+    """
+
+    def __init__(self, invoker, executor=None, max_concurrency=None):
+        self.invoker = invoker
+        self.max_concurrency = max_concurrency or os.cpu_count()
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=self.max_concurrency
+        )
+        # Created on first use, to bind it to the running loop.
+        self._semaphore = None
+
+    def close(self, wait=True):
+        """Shuts down the invoker's own thread pool, waiting for the calls in
+        flight with `wait`."""
+        if self._owns_executor:
+            self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def invoke(self, function_name, *args, out=None):
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(self.invoker.invoke, function_name, *args, out=out),
+            )
+
+    async def invoke_batch(self, function_name, list_of_arg_tuples):
+        """Invokes `function_name` once per tuple of arguments, concurrently,
+        and returns the results in order."""
+        return await asyncio.gather(
+            *[self.invoke(function_name, *args) for args in list_of_arg_tuples]
+        )
+
+    def __getattr__(self, function_name: str):
+        async def invoke(*args, out=None):
+            return await self.invoke(function_name, *args, out=out)
 
         return invoke
 
 
-BUFFERIZATION_PIPELINE = lambda munge=False: list(
-    filter(
-        None,
-        [
-            # "func.func(refback-generalize-tensor-pad)",
-            # Bufferize.
-            "func.func(linalg-init-tensor-to-alloc-tensor)",
-            "func.func(scf-bufferize)",
-            # "func.func(tm-tensor-bufferize)",
-            # "func.func(empty-tensor-to-alloc-tensor)",
-            "func.func(linalg-bufferize)",
-            "func-bufferize",
-            "arith-bufferize",
-            "func.func(tensor-bufferize)",
-            "func.func(finalizing-bufferize)",
-            "refback-munge-calling-conventions" if munge else None,
-            "func.func(refback-munge-memref-copy)" if munge else None,
-            # Insert global variable and instruction sequence for getting the next
-            # global seed used in stateful rng.
-            # "refback-insert-rng-globals",
-        ],
+LEGACY_BUFFERIZATION_PIPELINE = Pipeline(
+    # "func.func(refback-generalize-tensor-pad)",
+    # Bufferize.
+    nest_func(
+        "linalg-init-tensor-to-alloc-tensor",
+        "scf-bufferize",
+        # "tm-tensor-bufferize",
+        # "empty-tensor-to-alloc-tensor",
+        "linalg-bufferize",
+    ),
+    "func-bufferize",
+    "arith-bufferize",
+    nest_func("tensor-bufferize", "finalizing-bufferize"),
+)
+
+# With `one_shot` (the default, as for `compile`), the tensor arguments of the
+# module must be marked read-only first (`mark_arguments_read_only`), or the
+# kernels may write into the caller's arrays. With `strided_args` (one-shot
+# only), the arguments take views with any strides (see
+# `STRIDED_ARGS_ONE_SHOT_BUFFERIZATION_PIPELINE`).
+BUFFERIZATION_PIPELINE = lambda munge=False, out_params=False, results_as_out_args=False, one_shot=True, strided_args=False: Pipeline(
+    (
+        STRIDED_ARGS_ONE_SHOT_BUFFERIZATION_PIPELINE
+        if strided_args
+        else ONE_SHOT_BUFFERIZATION_PIPELINE
     )
+    if one_shot
+    else LEGACY_BUFFERIZATION_PIPELINE,
+    # Turn returned buffers into caller-provided out params and let
+    # the kernel compute directly into them.
+    "buffer-results-to-out-params" if out_params else None,
+    nest_func("refback-forward-out-params") if out_params else None,
+    nest_func("buffer-deallocation") if out_params and not one_shot else None,
+    # Free the buffers that do not escape; must run before the
+    # calling conventions are munged, which hides the returned ones.
+    BUFFER_DEALLOCATION_PIPELINE if one_shot else None,
+    Pass(
+        "refback-munge-calling-conventions",
+        results_as_out_args=results_as_out_args or None,
+    )
+    if munge
+    else None,
+    nest_func("refback-munge-memref-copy") if munge else None,
+    # Insert global variable and instruction sequence for getting the next
+    # global seed used in stateful rng.
+    # "refback-insert-rng-globals",
 )
 
-LOWER_LLVM_PIPELINE = [
+LOWER_LLVM_PIPELINE = Pipeline(
     # Lower to LLVM
     # "func.func(tm-tensor-to-loops)",
     "func.func(convert-linalg-to-loops)",
@@ -171,12 +457,99 @@ LOWER_LLVM_PIPELINE = [
     # Handle some complex mlir::math ops (e.g. atan2)
     "convert-math-to-libm",
     "convert-linalg-to-llvm",
+    # `bufferization.clone`s inserted by `buffer-deallocation`, e.g. for
+    # buffers carried through loops.
+    "func.func(convert-bufferization-to-memref)",
     "convert-memref-to-llvm",
     "func.func(convert-arith-to-llvm)",
     "convert-func-to-llvm",
     "convert-cf-to-llvm",
     "reconcile-unrealized-casts",
-]
+)
+
+# Allocates through `_mlir_alloc`/`_mlir_free`, i.e. the `Allocator` of the
+# RefBackendInvoker, instead of malloc/free.
+GENERIC_ALLOCATION_LOWER_LLVM_PIPELINE = LOWER_LLVM_PIPELINE.replace(
+    "convert-memref-to-llvm",
+    Pass("convert-memref-to-llvm", use_generic_functions=True),
+)
+
+# Tiles the linalg ops on buffers to tiles of a few vectors of `vector_width`
+# elements, vectorizes them and lowers the vector ops to loops of 1-D vector
+# ops; runs before `LOWER_LLVM_PIPELINE`, whose `convert-linalg-to-loops` then
+# only sees the ops that could not be vectorized. `contraction_lowering` is
+# one of "outerproduct", "dot", "matmul" (LLVM matrix intrinsics) or
+# "parallelarith".
+VECTORIZE_PIPELINE = lambda vector_width=8, contraction_lowering="outerproduct": Pipeline(
+    nest_func(
+        Pass(
+            "refback-vectorize-linalg",
+            vector_width=vector_width,
+            contraction_lowering=contraction_lowering,
+        ),
+        "canonicalize",
+        Pass("convert-vector-to-scf", full_unroll=True),
+    )
+)
+
+# Lowers the vector ops left by vectorization outside of the RefBackend, e.g.
+# by the `vectorize` of a transform schedule, like `VECTORIZE_PIPELINE` does
+# but without tiling and vectorizing the linalg ops first.
+LOWER_VECTOR_PIPELINE = lambda contraction_lowering="outerproduct": Pipeline(
+    nest_func(
+        Pass(
+            "refback-vectorize-linalg",
+            vectorize=False,
+            contraction_lowering=contraction_lowering,
+        ),
+        "canonicalize",
+        Pass("convert-vector-to-scf", full_unroll=True),
+    )
+)
+
+
+def available_cores():
+    """Returns the number of cores the process may run on, which is also the
+    number of threads of the async runtime loaded by the process (LLVM sizes
+    its thread pools by the CPU affinity of the process)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+# Lowers the parallel loops of the linalg ops on buffers to `scf.parallel`,
+# splits their iteration spaces into blocks and runs the blocks as tasks of
+# the MLIR async runtime; the reduction loops stay sequential within a block.
+# `num_workers` (by default, the available cores) is the number of workers
+# `async-parallel-for` splits the work for: it makes up to `num_workers`
+# times an oversharding factor blocks, but doesn't limit the threads. Those
+# are the runtime's thread pool, one thread per core the process may run on
+# (see `available_cores`), so restrict the affinity of the process to run on
+# fewer. The lowered module must be loaded with the async runtime (see
+# `runtime_shared_libs`).
+PARALLEL_PIPELINE = lambda num_workers=None, min_task_size=1000: Pipeline(
+    nest_func("convert-linalg-to-parallel-loops"),
+    Pass(
+        "async-parallel-for",
+        async_dispatch=True,
+        num_workers=num_workers or available_cores(),
+        min_task_size=min_task_size,
+    ),
+    nest_func("canonicalize"),
+    "async-to-async-runtime",
+    "async-runtime-ref-counting",
+    "async-runtime-ref-counting-opt",
+    nest_func("arith-expand"),
+    "convert-async-to-llvm",
+)
+
+
+def with_vector_to_llvm(lower_llvm_pipeline):
+    """Returns `lower_llvm_pipeline` lowering the vector dialect as well."""
+    return Pipeline(lower_llvm_pipeline).replace(
+        "convert-memref-to-llvm",
+        lambda p: Pipeline("convert-vector-to-llvm", p),
+    )
 
 
 class RefBackendLinalgOnTensorsBackend:
@@ -186,15 +559,129 @@ class RefBackendLinalgOnTensorsBackend:
         super().__init__()
 
     @staticmethod
-    def compile(imported_module: Module):
+    def compile(
+        imported_module: Module,
+        cache: CompilationCache = None,
+        out_params=False,
+        results_as_out_args=False,
+        generic_allocation=False,
+        vectorize=False,
+        vector_width=8,
+        contraction_lowering="outerproduct",
+        parallel=False,
+        num_workers=None,
+        one_shot=True,
+        schedules=None,
+        strided_args=False,
+    ):
+        """Lowers `imported_module` to the LLVM dialect. With a `cache`, the
+        lowered module is looked up by the input asm and pipeline first and the
+        pass pipeline only runs on a miss; note that on a hit a new module is
+        returned instead of `imported_module` being lowered in place. With
+        `out_params`, functions take their results as trailing arguments
+        (destination-passing style) instead of returning them. With
+        `results_as_out_args`, functions store their results to slots passed as
+        trailing arguments, which `RefBackendInvoker` allocates and decodes,
+        instead of passing them to the consume-return callbacks. With
+        `generic_allocation`, buffers are allocated from the allocator of the
+        `RefBackendInvoker` instead of with malloc. With `vectorize`, linalg
+        ops are tiled and vectorized to vectors of `vector_width` elements
+        (see `VECTORIZE_PIPELINE`) instead of being lowered to scalar loops.
+        With `parallel`, the parallel loops of linalg ops are split into blocks
+        for `num_workers` workers (by default, one per available core) and
+        run on the thread pool of the async runtime, which has a thread per
+        core the process may run on (see `PARALLEL_PIPELINE`); with
+        `vectorize` too, only the ops that weren't vectorized run in parallel,
+        as the tile loops of vectorized ops stay sequential. With `one_shot`
+        (the default), the module is bufferized with one-shot bufferization,
+        which writes in place where it can, except into the tensor arguments,
+        which `mark_arguments_read_only` marks so that the caller's arrays are
+        never written to, and buffers that are not returned are freed;
+        otherwise with the legacy per-dialect passes, which copy more and free
+        buffers only with `out_params`. With `schedules` (see
+        `schedule.Schedule`), the linalg ops on tensors are first transformed
+        by the transform script of the schedules, which is added to
+        `imported_module`. With `strided_args` (one-shot only), the functions
+        take views with any strides and offset, e.g. `a[::2, ::-1]` or
+        broadcasts, in place, instead of only C-contiguous arrays, at the cost
+        of dynamic address computations, which get in the way of
+        vectorization.
+        """
+        if strided_args and not one_shot:
+            raise ValueError("strided_args requires one_shot bufferization")
+        lower_llvm_pipeline = (
+            GENERIC_ALLOCATION_LOWER_LLVM_PIPELINE
+            if generic_allocation
+            else LOWER_LLVM_PIPELINE
+        )
+        pipeline = BUFFERIZATION_PIPELINE(
+            munge=True,
+            out_params=out_params,
+            results_as_out_args=results_as_out_args,
+            one_shot=one_shot,
+            strided_args=strided_args,
+        )
+        if schedules:
+            pipeline = TRANSFORM_INTERPRETER_PIPELINE + pipeline
+        if vectorize:
+            pipeline += VECTORIZE_PIPELINE(vector_width, contraction_lowering)
+            lower_llvm_pipeline = with_vector_to_llvm(lower_llvm_pipeline)
+        elif schedules:
+            pipeline += LOWER_VECTOR_PIPELINE(contraction_lowering)
+            lower_llvm_pipeline = with_vector_to_llvm(lower_llvm_pipeline)
+        # After vectorization: `convert-linalg-to-parallel-loops` lowers every
+        # linalg op, which would leave none to vectorize.
+        if parallel:
+            pipeline += PARALLEL_PIPELINE(num_workers)
+        pipeline += lower_llvm_pipeline
+        if cache is not None:
+            # Keyed by the module as given, which is only modified on a miss.
+            key = cache.key(
+                imported_module.operation.get_asm(),
+                str(pipeline),
+                [repr(schedule) for schedule in schedules or []],
+            )
+            cached = cache.lookup(key, ".mlir")
+            if cached is not None:
+                return Module.parse(cached.read_text(), imported_module.context)
+
+        if one_shot:
+            mark_arguments_read_only(imported_module)
+        if schedules:
+            build_transform_script(imported_module, schedules)
         run_pipeline_with_repro_report(
             imported_module,
-            ",".join(BUFFERIZATION_PIPELINE(munge=True) + LOWER_LLVM_PIPELINE),
+            pipeline,
             "Lowering Linalg-on-Tensors IR to LLVM with RefBackend",
         )
+        if cache is not None:
+            cache.store(key, ".mlir", imported_module.operation.get_asm().encode())
         return imported_module
 
     @staticmethod
-    def load(module) -> RefBackendInvoker:
-        """Loads a compiled artifact into the runtime."""
-        return RefBackendInvoker(module)
+    def load(
+        module,
+        opt_level=None,
+        cache: CompilationCache = None,
+        owned_results=False,
+        allocator=None,
+        **engine_kwargs,
+    ) -> RefBackendInvoker:
+        """Loads a compiled artifact into the runtime, JIT compiled at
+        `opt_level`, by default the one the module was tuned for (see
+        `tuned_opt_level`) or 2. With a `cache`, the object file generated by
+        the JIT is also stored, keyed by the lowered module, `opt_level` and
+        the target (see `object_cache_key`), for ahead-of-time loading. `engine_kwargs` are passed on to the
+        `ExecutionEngine`, e.g. `target_cpu="native"` and
+        `prefer_vector_width=512` to use the AVX-512 units of the host.
+        """
+        if opt_level is None:
+            opt_level = tuned_opt_level(module, 2)
+        invoker = RefBackendInvoker(
+            module, opt_level, owned_results, allocator, **engine_kwargs
+        )
+        if cache is not None:
+            key = object_cache_key(cache, module, opt_level, engine_kwargs)
+            if cache.lookup(key, ".o") is None:
+                cache.store_file(key, ".o", invoker.ee.dump_to_object_file)
+        return invoker
@@ -0,0 +1,322 @@
+"""The calling convention of modules lowered by the RefBackend, in plain
+ctypes: kernels hand their results to `refbackend_consume_func_return_*`
+callbacks, which are implemented here in Python. This module doesn't depend on
+the MLIR native libraries, so it is shared by the JIT (`refbackend`) and by
+the loader of ahead-of-time compiled kernels (`aot_loader`).
+"""
+import ctypes
+import ctypes.util
+
+import numpy as np
+
+from mlir.runtime import (
+    UnrankedMemRefDescriptor,
+    get_memref_layout,
+    has_identity_layout,
+    unranked_memref_to_numpy,
+)
+
+
+# The element types of the memref arguments that
+# `refback-munge-calling-conventions` accepts (see `isArgMemRefTypeValid`).
+SUPPORTED_ARG_DTYPES = [np.float32, np.float64, np.int32, np.int64, np.bool_]
+
+
+def assert_arg_type_is_supported(ty):
+    # Nothing checks the dtype against the kernel's signature, so this must
+    # reject what no kernel can take rather than have it reinterpreted.
+    assert any(
+        np.dtype(ty) == np.dtype(supported) for supported in SUPPORTED_ARG_DTYPES
+    ), f"Only numpy arrays with dtypes in {SUPPORTED_ARG_DTYPES} are supported"
+
+
+def assert_arg_layout_is_supported(array):
+    """Raises a ValueError unless `array` is C-contiguous: the functions
+    munged by the RefBackend cast their arguments to memrefs of the layout
+    they were bufferized with, which is the identity layout unless compiled
+    with `strided_args=True`; it ignores the strides (and offset) of the
+    descriptor, so they would silently read the wrong elements of other
+    views."""
+    if not has_identity_layout(array):
+        raise ValueError(
+            f"Only C-contiguous arrays can be passed to this argument, got one "
+            f"with shape {array.shape} and strides {array.strides}; copy it "
+            f"with np.ascontiguousarray first or compile with strided_args=True"
+        )
+
+
+def as_memref_array(obj, dtype=None, shape=None, offset=0, strided=False):
+    """Returns a NumPy view of `obj`, any object supporting the buffer
+    protocol (an `np.ndarray` or `np.memmap`, `memoryview`, `mmap.mmap`,
+    `bytearray`, `array.array`, ...), to pass as a memref argument. Nothing is
+    copied: a kernel run over an `mmap.mmap` reads the mapped file, paging it
+    in on demand.
+
+    Without `dtype`, the elements are those of the buffer's format (bytes for
+    `mmap.mmap` and `bytearray`, which no kernel takes). With `dtype`, the (contiguous) buffer is
+    reinterpreted as elements of `dtype` starting `offset` bytes in, e.g. to
+    skip a file header; `shape` then defaults to as many elements as fit.
+    Unless the argument is `strided` (see `as_memref_args`), the view must be
+    C-contiguous, as the kernels take identity-layout memrefs; slices along
+    the first dimension are, transposes aren't.
+    """
+    if dtype is None and not offset:
+        array = obj if isinstance(obj, np.ndarray) else np.asarray(memoryview(obj))
+    else:
+        buffer = memoryview(obj)
+        if not buffer.c_contiguous:
+            raise ValueError("Only contiguous buffers can be reinterpreted")
+        count = -1 if shape is None else int(np.prod(shape))
+        array = np.frombuffer(
+            buffer.cast("B"), dtype=dtype or np.uint8, count=count, offset=offset
+        )
+    if shape is not None:
+        reshaped = array.reshape(shape)
+        if not np.may_share_memory(reshaped, array):
+            raise ValueError(
+                f"Can't view the buffer as shape {shape} without copying"
+            )
+        array = reshaped
+    assert_arg_type_is_supported(array.dtype)
+    if not strided:
+        assert_arg_layout_is_supported(array)
+    return array
+
+
+def as_memref_args(args, strided_args=None):
+    """Returns the `as_memref_array` views of the arguments `args` of a
+    function; `strided_args` (see `refbackend.get_strided_args`) are the
+    flags of the arguments that take views with any strides, all of them
+    contiguous-only if None."""
+    strided_args = list(strided_args or [])
+    strided_args += [False] * (len(args) - len(strided_args))
+    return tuple(
+        as_memref_array(arg, strided=strided)
+        for arg, strided in zip(args, strided_args)
+    )
+
+
+def memref_arg_pointers(args):
+    """Returns the allocated pointers of the memrefs passed for the arrays
+    `args`, to recognize results that alias an argument."""
+    return {get_memref_layout(arg)[0] for arg in args}
+
+
+memref_type_to_np_dtype = {
+    "mrf32": np.float32,
+    "mrf64": np.float64,
+    "mri1": np.bool_,
+    "mri8": np.int8,
+    "mri32": np.int32,
+    "mri64": np.int64,
+}
+elemental_type_to_ctype = {
+    "i1": ctypes.c_bool,
+    "i8": ctypes.c_byte,
+    "i64": ctypes.c_int,
+    "f32": ctypes.c_float,
+    "f64": ctypes.c_double,
+}
+
+CONSUME_RETURN_FUNC_PREFIX = "refbackend_consume_func_return_"
+
+
+def get_ctype_func(func_name):
+    return_prefix_len = len(CONSUME_RETURN_FUNC_PREFIX)
+    ret_types = (
+        func_name[return_prefix_len:].split("_")
+        if len(func_name) > return_prefix_len
+        else []
+    )
+    ctypes_arg = [None]
+    for type in ret_types:
+        if type in elemental_type_to_ctype:
+            ctypes_arg.append(elemental_type_to_ctype[type])
+        elif type in memref_type_to_np_dtype:
+            ctypes_arg.append(ctypes.POINTER(UnrankedMemRefDescriptor))
+        else:
+            assert False, f"Not supported type: {type}"
+
+    return ctypes.CFUNCTYPE(*ctypes_arg), ret_types
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"))
+_libc.free.argtypes = [ctypes.c_void_p]
+_libc.free.restype = None
+
+
+class OwnedMemRef:
+    """A kernel result that owns the buffer the JIT'd code allocated for it.
+
+    `array` is a zero-copy view of the buffer; the buffer is released by
+    `free()`, on leaving a `with` block, or (as a fallback) when the
+    OwnedMemRef is garbage collected. Views of `array` must not outlive it.
+    The buffer is released with `free_fn`, by default libc `free`. A result
+    aliasing the buffer of another result of the same call has that one as
+    its `owner`, which it keeps alive, and frees nothing itself.
+    """
+
+    def __init__(self, array, allocated, free_fn=None, owner=None):
+        self._array = array
+        self._allocated = allocated
+        self._free_fn = free_fn or _libc.free
+        # The result that frees the buffer, if this one aliases it.
+        self._owner = owner
+
+    @property
+    def array(self):
+        if self._array is None:
+            raise ValueError("OwnedMemRef has already been freed")
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self.array, dtype=dtype, copy=copy)
+
+    def free(self):
+        if self._array is not None:
+            self._array = None
+            self._owner = None
+            if self._allocated:
+                self._free_fn(self._allocated)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.free()
+
+    def __del__(self):
+        self.free()
+
+
+# The allocated pointer of memrefs lowered from `memref.get_global`, which
+# are constants of the module rather than heap buffers.
+GLOBAL_MEMREF_ALLOCATED = 0xDEADBEEF
+
+
+def owned_result(array, allocated, arg_pointers, owners, free_fn=None):
+    """Wraps the result view `array` of the buffer `allocated` in an
+    `OwnedMemRef`. `owners` maps the buffers of the results of the call
+    converted so far to their `OwnedMemRef`, so that only the first result
+    of a buffer frees it."""
+    # A result that aliases an argument or a global is not the kernel's to
+    # give away.
+    if allocated in arg_pointers or allocated == GLOBAL_MEMREF_ALLOCATED:
+        return OwnedMemRef(array, None, free_fn)
+    owner = owners.get(allocated)
+    if owner is not None:
+        return OwnedMemRef(array, None, free_fn, owner)
+    owners[allocated] = result = OwnedMemRef(array, allocated, free_fn)
+    return result
+
+
+def memref_result(
+    unranked_memref, np_dtype, arg_pointers=None, free_fn=None, owners=None
+):
+    """Converts a memref result to a NumPy view of it. With `arg_pointers`
+    (the data pointers of the arguments of the call), the view is wrapped in
+    an `OwnedMemRef` that frees the buffer (see `owned_result`, to which
+    `owners` is passed)."""
+    array = unranked_memref_to_numpy(unranked_memref, np_dtype)
+    if arg_pointers is None:
+        return array
+    # `allocated` is the first field of the ranked descriptor.
+    allocated = ctypes.c_void_p.from_address(unranked_memref[0].descriptor).value
+    return owned_result(
+        array, allocated, arg_pointers, {} if owners is None else owners, free_fn
+    )
+
+
+def make_consume_return_callback(ret_types, local, owned_results=False, free_fn=None):
+    """Returns the Python implementation of a consume-return function for
+    results of `ret_types`. The converted results are stored in
+    `local.result`, a thread-local slot, since the callback runs on the thread
+    that invoked the kernel."""
+
+    def consume_return_funcs(*args):
+        arg_pointers = local.arg_pointers if owned_results else None
+        owners = {}
+        result = tuple(
+            [
+                arg
+                if type in elemental_type_to_ctype
+                else memref_result(
+                    arg, memref_type_to_np_dtype[type], arg_pointers, free_fn, owners
+                )
+                for arg, type in zip(args, ret_types)
+            ]
+        )
+        if len(result) == 1:
+            result = result[0]
+        local.result = result
+
+    return consume_return_funcs
+
+
+# Results stored to out arguments (`refback-munge-calling-conventions` with
+# `results-as-out-args`).
+
+scalar_type_to_np_dtype = {
+    "i1": np.bool_,
+    "i8": np.int8,
+    "i32": np.int32,
+    "i64": np.int64,
+    "f32": np.float32,
+    "f64": np.float64,
+}
+
+
+def make_result_slots(result_specs):
+    """Returns the out arguments for results of `result_specs`, a list of
+    (type token, rank): a one-element array of the scalar type, or, for a
+    memref, a one-element array holding its ranked descriptor
+    [allocated, aligned, offset, sizes..., strides...]."""
+    return [
+        np.zeros(1, dtype=[("descriptor", np.int64, (3 + 2 * rank,))])
+        if token in memref_type_to_np_dtype
+        else np.zeros(1, dtype=scalar_type_to_np_dtype[token])
+        for token, rank in result_specs
+    ]
+
+
+def descriptor_words_to_numpy(words, rank, np_dtype):
+    """Returns a NumPy view of the memref described by `words`, the fields of
+    a ranked descriptor as int64s."""
+    aligned, offset = int(words[1]), int(words[2])
+    shape = tuple(int(s) for s in words[3 : 3 + rank])
+    strides = tuple(int(s) for s in words[3 + rank :])
+    if 0 in shape:
+        return np.empty(shape, dtype=np_dtype)
+    # Extent of the strided view, in elements, relative to element 0.
+    lo = sum(min(0, (size - 1) * stride) for size, stride in zip(shape, strides))
+    hi = sum(max(0, (size - 1) * stride) for size, stride in zip(shape, strides))
+    itemsize = np.dtype(np_dtype).itemsize
+    buffer = (ctypes.c_char * ((hi - lo + 1) * itemsize)).from_address(
+        aligned + (offset + lo) * itemsize
+    )
+    base = np.frombuffer(buffer, dtype=np_dtype)
+    return np.lib.stride_tricks.as_strided(
+        base[-lo:], shape, tuple(stride * itemsize for stride in strides)
+    )
+
+
+def read_result_slots(slots, result_specs, arg_pointers=None, free_fn=None):
+    """Converts the results stored to `slots` (see `make_result_slots`), like
+    the consume-return callbacks do: memrefs become NumPy views, wrapped in
+    `OwnedMemRef`s if `arg_pointers` is given."""
+    result = []
+    owners = {}
+    for slot, (token, rank) in zip(slots, result_specs):
+        if token not in memref_type_to_np_dtype:
+            result.append(slot[0].item())
+            continue
+        words = slot["descriptor"][0]
+        array = descriptor_words_to_numpy(
+            words, rank, memref_type_to_np_dtype[token]
+        )
+        if arg_pointers is not None:
+            array = owned_result(
+                array, int(words[0]), arg_pointers, owners, free_fn
+            )
+        result.append(array)
+    return result[0] if len(result) == 1 else tuple(result)
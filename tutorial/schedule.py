@@ -0,0 +1,223 @@
+"""Schedules for the structured (linalg) ops of a module, written with the
+transform dialect instead of fixed pass pipelines. A `Schedule` records the
+transformations of the ops of one name (tile, interchange, pad, vectorize,
+and peel, unroll or pipeline the tile loops); `build_transform_script`
+emits the schedules as a transform script into the payload module and
+`TRANSFORM_INTERPRETER_PIPELINE` applies it, after which the module is
+lowered by the RefBackend like any other:
+
+    schedule = Schedule("linalg.matmul").tile([8, 16, 0]).peel(1).unroll(2)
+    RefBackendLinalgOnTensorsBackend.compile(module, schedules=[schedule])
+
+The ops are matched with PDL patterns (`transform.with_pdl_patterns` and
+`transform.pdl_match`), and the script is run by the
+`refback-transform-interpreter` pass, which erases it afterwards.
+
+See `bench_schedule.py` for a comparison of a few matmul schedules.
+"""
+from mlir._mlir_libs._mlir.ir import (
+    ArrayAttr,
+    Attribute,
+    InsertionPoint,
+    Location,
+)
+
+from mlir.dialects import pdl, transform
+from mlir.dialects.transform import loop, structured
+
+from compiler_utils import run_pipeline_with_repro_report
+from pipeline import Pass, Pipeline, nest_func
+
+# Applies the transform script of the module and cleans up after the
+# transformations (e.g. the index computations of peeled loops).
+TRANSFORM_INTERPRETER_PIPELINE = Pipeline(
+    Pass("refback-transform-interpreter"), nest_func("canonicalize", "cse")
+)
+
+
+class Schedule:
+    """The transformations of the ops named `op_name` (e.g. "linalg.matmul"),
+    applied in the order they are added to every op of that name. The methods
+    return the schedule, so that they can be chained.
+
+    The loop transformations apply to the loops produced by the last `tile`,
+    outermost first (`loop=-1` is the innermost); dimensions with a tile size
+    of 0 are not tiled and produce no loop. After `vectorize` the ops are gone,
+    so only loop transformations can follow it.
+    """
+
+    def __init__(self, op_name):
+        self.op_name = op_name
+        self.steps = []
+
+    def _add(self, name, **kwargs):
+        self.steps.append((name, kwargs))
+        return self
+
+    def tile(self, sizes, interchange=None):
+        """Tiles the ops to `sizes` (one per loop of the op, 0 for untiled),
+        the tile loops being ordered by `interchange`."""
+        return self._add("tile", sizes=list(sizes), interchange=interchange)
+
+    def generalize(self):
+        """Rewrites the named ops (e.g. `linalg.matmul`) to `linalg.generic`."""
+        return self._add("generalize")
+
+    def interchange(self, permutation):
+        """Permutes the loops of the ops, which must be generic (see
+        `generalize`)."""
+        return self._add("interchange", permutation=list(permutation))
+
+    def decompose(self):
+        """Rewrites 2-D convolutions with a size 1 window dimension to 1-D
+        ones, which vectorize."""
+        return self._add("decompose")
+
+    def pad(
+        self,
+        padding_values,
+        padding_dimensions,
+        pack_paddings=None,
+        hoist_paddings=None,
+        transpose_paddings=None,
+    ):
+        """Pads the operands of the ops (tiles, usually) to static shapes with
+        `padding_values`, one attribute (or its text, e.g. "0.0 : f32") per
+        operand, along `padding_dimensions`."""
+        return self._add(
+            "pad",
+            padding_values=list(padding_values),
+            padding_dimensions=list(padding_dimensions),
+            pack_paddings=pack_paddings,
+            hoist_paddings=hoist_paddings,
+            transpose_paddings=transpose_paddings,
+        )
+
+    def vectorize(self, vectorize_padding=False):
+        """Vectorizes the ops with static shapes (and, with
+        `vectorize_padding`, the pads) of the functions containing them."""
+        return self._add("vectorize", vectorize_padding=vectorize_padding)
+
+    def peel(self, loop=-1):
+        """Peels the last, partial iteration off tile loop `loop`, so that the
+        main loop has full tiles only."""
+        return self._add("peel", loop=loop)
+
+    def unroll(self, factor, loop=-1):
+        """Unrolls tile loop `loop` by `factor`. The loop handle is consumed,
+        so loops of the tile can't be transformed after their unrolling."""
+        return self._add("unroll", factor=factor, loop=loop)
+
+    def pipeline(self, loop=-1, iteration_interval=1, read_latency=10):
+        """Software-pipelines tile loop `loop`, overlapping the loads of an
+        iteration with the computation of the previous ones."""
+        return self._add(
+            "pipeline",
+            loop=loop,
+            iteration_interval=iteration_interval,
+            read_latency=read_latency,
+        )
+
+    def emit(self, target):
+        """Emits the transform ops of the schedule at the current insertion
+        point, for the ops matched by the handle `target`."""
+        loops = []
+        for name, kwargs in self.steps:
+            if name in ("peel", "unroll", "pipeline"):
+                if not loops:
+                    raise ValueError(f"{name} of {self.op_name} before a tile")
+                index = kwargs["loop"]
+                if loops[index] is None:
+                    raise ValueError(f"{name} of an unrolled loop of {self.op_name}")
+                if name == "peel":
+                    loops[index] = loop.LoopPeelOp(loops[index]).transformed
+                elif name == "unroll":
+                    loop.LoopUnrollOp(loops[index], factor=kwargs["factor"])
+                    loops[index] = None
+                else:
+                    loops[index] = loop.LoopPipelineOp(
+                        loops[index],
+                        iteration_interval=kwargs["iteration_interval"],
+                        read_latency=kwargs["read_latency"],
+                    ).transformed
+                continue
+            if target is None:
+                raise ValueError(f"{name} of {self.op_name} after vectorize")
+            if name == "tile":
+                tiled = structured.TileOp(
+                    target, sizes=kwargs["sizes"], interchange=kwargs["interchange"]
+                )
+                target, loops = tiled.tiled_linalg_op, list(tiled.loops)
+            elif name == "generalize":
+                target = structured.GeneralizeOp(target).transformed
+            elif name == "interchange":
+                target = structured.InterchangeOp(
+                    target, iterator_interchange=kwargs["permutation"]
+                ).transformed
+            elif name == "decompose":
+                target = structured.DecomposeOp(target).transformed
+            elif name == "pad":
+                target = structured.PadOp(
+                    target,
+                    padding_values=ArrayAttr.get(
+                        [
+                            Attribute.parse(v) if isinstance(v, str) else v
+                            for v in kwargs["padding_values"]
+                        ]
+                    ),
+                    padding_dimensions=kwargs["padding_dimensions"],
+                    pack_paddings=kwargs["pack_paddings"],
+                    hoist_paddings=kwargs["hoist_paddings"],
+                    transpose_paddings=kwargs["transpose_paddings"],
+                ).transformed
+            elif name == "vectorize":
+                structured.VectorizeOp(
+                    transform.GetClosestIsolatedParentOp(target),
+                    vectorize_padding=kwargs["vectorize_padding"],
+                )
+                target = None
+
+    def __repr__(self):
+        steps = ", ".join(
+            f"{name}({', '.join(f'{k}={v}' for k, v in kwargs.items())})"
+            for name, kwargs in self.steps
+        )
+        return f"Schedule({self.op_name!r}: {steps})"
+
+
+def build_transform_script(module, schedules):
+    """Appends to `module` the transform script applying `schedules`: a
+    pattern matching the ops of every schedule and a sequence transforming
+    the matched ops."""
+    with module.context, Location.unknown(), InsertionPoint(module.body):
+        with_patterns = transform.WithPDLPatternsOp()
+        with InsertionPoint(with_patterns.body):
+            for i, schedule in enumerate(schedules):
+                pattern = pdl.PatternOp(1, f"refback_schedule_{i}")
+                with InsertionPoint(pattern.body):
+                    operands = pdl.OperandsOp()
+                    types = pdl.TypesOp()
+                    op = pdl.OperationOp(
+                        schedule.op_name, args=[operands], types=[types]
+                    )
+                    pdl.RewriteOp(op, "transform.dialect")
+            sequence = transform.SequenceOp(with_patterns.bodyTarget)
+            with InsertionPoint(sequence.body):
+                for i, schedule in enumerate(schedules):
+                    schedule.emit(
+                        transform.PDLMatchOp(
+                            sequence.bodyTarget, f"refback_schedule_{i}"
+                        ).matched
+                    )
+                transform.YieldOp([])
+    return module
+
+
+def apply_schedules(module, *schedules):
+    """Transforms `module` in place with `schedules`."""
+    build_transform_script(module, schedules)
+    run_pipeline_with_repro_report(
+        module, TRANSFORM_INTERPRETER_PIPELINE, "Applying the transform schedules"
+    )
+    return module
+
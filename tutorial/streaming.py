@@ -0,0 +1,357 @@
+"""Out-of-core execution of kernels compiled for a fixed tile shape over
+arrays too large for memory, e.g. `np.memmap`s of multi-GB files.
+
+`StreamingExecutor` splits the leading dimension of the inputs into tiles of
+`tile_rows` rows and invokes the kernel once per tile. Full tiles are passed
+as zero-copy views, based at the first element of the tile, so the inputs
+must be C-contiguous (see `as_memref_array`); the last, partial tile is copied into a staging buffer
+padded with `pad_value`. While a tile is computed, the pages of the next
+`prefetch` tiles are faulted in on a background thread (the kernel releases
+the GIL), so reading the file overlaps with computing. Elementwise kernels
+write their output tiles into an output array, by default a memmap;
+reduction kernels produce partial results which are combined.
+
+    python streaming.py --rows 1000000 --cols 256 --tile-rows 4096
+
+checks both against NumPy over several tiles, then measures their throughput
+against a single call over the whole array.
+"""
+import argparse
+import mmap
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from mlir._mlir_libs._mlir.ir import (
+    Context,
+    InsertionPoint,
+    Location,
+    Module,
+    RankedTensorType,
+)
+
+from mlir.dialects import arith, func, linalg
+from mlir.dialects.linalg.opdsl.lang import (
+    D,
+    S,
+    T,
+    TensorDef,
+    domain,
+    linalg_structured_op,
+)
+
+from linalg_tut import ELEMENT_TYPES
+from refbackend import RefBackendLinalgOnTensorsBackend
+from refbackend_abi import OwnedMemRef, as_memref_array
+
+
+def prefetch(array):
+    """Faults in the pages of `array` by reading one element per page."""
+    if array.size == 0:
+        return
+    flat = array.reshape(-1)
+    step = max(1, mmap.PAGESIZE // array.itemsize)
+    np.add.reduce(flat[::step])
+
+
+class StreamingExecutor:
+    """Runs `function_name` of `invoker` (a `RefBackendInvoker` or
+    `AotModule`), compiled for inputs with `tile_rows` rows, over inputs with
+    any number of rows.
+
+    With `out_params`, the function is expected to have been compiled with
+    `out_params=True`, and output tiles are written in place into the output
+    array; otherwise the results are copied from the returned arrays, which
+    should then be owned (`owned_results=True`) so that they are freed.
+
+    `pad_value` fills the rows of the last tile past the end of the inputs; for
+    reductions it must be the identity of the reduction (0 for a sum).
+    """
+
+    def __init__(
+        self,
+        invoker,
+        function_name,
+        tile_rows,
+        out_params=False,
+        pad_value=0,
+        prefetch=1,
+    ):
+        self.invoker = invoker
+        self.function_name = function_name
+        self.tile_rows = tile_rows
+        self.out_params = out_params
+        self.pad_value = pad_value
+        self.prefetch = prefetch
+
+    def tiles(self, num_rows):
+        """Returns the (start, stop) rows of the tiles of `num_rows` rows."""
+        return [
+            (start, min(start + self.tile_rows, num_rows))
+            for start in range(0, num_rows, self.tile_rows)
+        ]
+
+    def _tile_args(self, inputs, start, stop):
+        if stop - start == self.tile_rows:
+            return tuple(input[start:stop] for input in inputs)
+        args = []
+        for input in inputs:
+            staged = np.full(
+                (self.tile_rows, *input.shape[1:]), self.pad_value, input.dtype
+            )
+            staged[: stop - start] = input[start:stop]
+            args.append(staged)
+        return tuple(args)
+
+    def _stream(self, inputs, invoke_tile):
+        """Calls `invoke_tile(start, stop, args)` for every tile, prefetching
+        the inputs of the next tiles in the background."""
+        inputs = [as_memref_array(input) for input in inputs]
+        num_rows = inputs[0].shape[0]
+        if any(input.shape[0] != num_rows for input in inputs):
+            raise ValueError("All inputs must have the same number of rows")
+        tiles = self.tiles(num_rows)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = {}
+            for i, (start, stop) in enumerate(tiles):
+                for j in range(i + 1, min(i + 1 + self.prefetch, len(tiles))):
+                    if j not in pending:
+                        pending[j] = pool.submit(
+                            lambda j=j: [
+                                prefetch(input[tiles[j][0] : tiles[j][1]])
+                                for input in inputs
+                            ]
+                        )
+                if i in pending:
+                    pending.pop(i).result()
+                invoke_tile(start, stop, self._tile_args(inputs, start, stop))
+        return num_rows
+
+    def _invoke(self, args, out=None):
+        result = self.invoker.invoke(self.function_name, *args, out=out)
+        if out is not None:
+            return out
+        if isinstance(result, OwnedMemRef):
+            with result:
+                return np.array(result.array)
+        return np.array(result)
+
+    def map(self, *inputs, out=None, out_path=None, out_dtype=None):
+        """Runs an elementwise (row-wise) kernel over `inputs` and returns the
+        output, written to `out` if given, else to a new `np.memmap` at
+        `out_path` if given, else to a new array. The output has the rows of
+        the inputs and, by default, the shape of a row and the dtype of the
+        first input (of the first result without `out_params`)."""
+
+        def make_out(row_shape, dtype):
+            shape = (num_rows, *row_shape)
+            dtype = out_dtype or dtype
+            if out_path is not None:
+                return np.memmap(out_path, dtype=dtype, mode="w+", shape=shape)
+            return np.empty(shape, dtype)
+
+        inputs = [as_memref_array(input) for input in inputs]
+        num_rows = inputs[0].shape[0]
+        if out is None and self.out_params:
+            out = make_out(inputs[0].shape[1:], inputs[0].dtype)
+        outs = [out]
+
+        def invoke_tile(start, stop, args):
+            if self.out_params:
+                out = outs[0]
+                if stop - start == self.tile_rows:
+                    self._invoke(args, out[start:stop])
+                else:
+                    staged = np.empty((self.tile_rows, *out.shape[1:]), out.dtype)
+                    out[start:stop] = self._invoke(args, staged)[: stop - start]
+                return
+            result = self._invoke(args)
+            if outs[0] is None:
+                outs[0] = make_out(result.shape[1:], result.dtype)
+            outs[0][start:stop] = result[: stop - start]
+
+        self._stream(inputs, invoke_tile)
+        return outs[0]
+
+    def reduce(self, *inputs, combine=np.add, out=None):
+        """Runs a reduction kernel over `inputs` and combines the partial
+        results of the tiles with `combine`. With `out_params`, `out` is
+        required: the partial results are written to arrays like it, and the
+        combined result to it."""
+        if self.out_params and out is None:
+            raise ValueError("`out` is required for kernels with out params")
+        acc = []
+
+        def invoke_tile(start, stop, args):
+            partial_out = np.empty_like(out) if self.out_params else None
+            partial = self._invoke(args, partial_out)
+            acc[:] = [combine(acc[0], partial) if acc else partial]
+
+        self._stream(inputs, invoke_tile)
+        if out is None:
+            return acc[0]
+        out[...] = acc[0]
+        return out
+
+
+@linalg_structured_op
+def sum_columns(I=TensorDef(T, S.M, S.N), O=TensorDef(T, S.N, output=True)):
+    domain(D.m, D.n)
+    O[D.n] += I[D.m, D.n]
+
+
+def build_add(rows, cols, dtype="f32"):
+    with Context(), Location.unknown():
+        module = Module.create()
+        elem_type = ELEMENT_TYPES[dtype][0].get()
+        tensor_type = RankedTensorType.get((rows, cols), elem_type)
+        with InsertionPoint(module.body):
+
+            @func.FuncOp.from_py_func(tensor_type, tensor_type)
+            def add(lhs, rhs):
+                out = linalg.InitTensorOp([rows, cols], elem_type)
+                return linalg.elemwise_binary(lhs, rhs, outs=[out])
+
+    return module
+
+
+def build_column_sum(rows, cols, dtype="f32"):
+    with Context(), Location.unknown():
+        module = Module.create()
+        elem_type = ELEMENT_TYPES[dtype][0].get()
+        with InsertionPoint(module.body):
+
+            @func.FuncOp.from_py_func(RankedTensorType.get((rows, cols), elem_type))
+            def column_sum(input):
+                zero = arith.ConstantOp(elem_type, 0.0)
+                init = linalg.InitTensorOp([cols], elem_type)
+                acc = linalg.fill(zero, outs=[init])
+                return sum_columns(input, outs=[acc])
+
+    return module
+
+
+def load(module):
+    return RefBackendLinalgOnTensorsBackend.load(
+        RefBackendLinalgOnTensorsBackend.compile(module, out_params=True)
+    )
+
+
+def make_memmap(path, rows, cols, dtype, chunk_rows=1 << 16):
+    """Creates an `np.memmap` of random values, written in chunks."""
+    array = np.memmap(path, dtype=dtype, mode="w+", shape=(rows, cols))
+    rng = np.random.default_rng(0)
+    for start in range(0, rows, chunk_rows):
+        stop = min(start + chunk_rows, rows)
+        array[start:stop] = rng.random((stop - start, cols), dtype=dtype)
+    array.flush()
+    return array
+
+
+def check_streaming(cols=64, tile_rows=256, dtype="f32"):
+    """Checks `map` and `reduce`, with and without out params, against NumPy
+    over two and a half tiles, so that full tiles (passed as views at an
+    offset into the inputs) and a padded partial tile are both covered."""
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    rows = 2 * tile_rows + tile_rows // 2
+    rng = np.random.default_rng(0)
+    lhs = rng.random((rows, cols), dtype=np_dtype)
+    rhs = rng.random((rows, cols), dtype=np_dtype)
+
+    add = StreamingExecutor(
+        load(build_add(tile_rows, cols, dtype)), "add", tile_rows, out_params=True
+    )
+    np.testing.assert_allclose(add.map(lhs, rhs), lhs + rhs, rtol=1e-6)
+    add = StreamingExecutor(
+        RefBackendLinalgOnTensorsBackend.load(
+            RefBackendLinalgOnTensorsBackend.compile(build_add(tile_rows, cols, dtype)),
+            owned_results=True,
+        ),
+        "add",
+        tile_rows,
+    )
+    np.testing.assert_allclose(add.map(lhs, rhs), lhs + rhs, rtol=1e-6)
+
+    column_sum = StreamingExecutor(
+        load(build_column_sum(tile_rows, cols, dtype)),
+        "column_sum",
+        tile_rows,
+        out_params=True,
+    )
+    sums = column_sum.reduce(lhs, out=np.empty(cols, np_dtype))
+    np.testing.assert_allclose(sums, np.sum(lhs, axis=0), rtol=1e-4)
+
+
+def bench_streaming(rows, cols, tile_rows, dtype="f32", prefetch_depth=1, tmp_dir=None):
+    """Returns {name: GB/s} of streaming and of whole-array calls of an
+    elementwise add and a column sum over memmaps of `rows` x `cols`."""
+    np_dtype = ELEMENT_TYPES[dtype][1]
+    results = {}
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        lhs = make_memmap(os.path.join(tmp, "lhs"), rows, cols, np_dtype)
+        rhs = make_memmap(os.path.join(tmp, "rhs"), rows, cols, np_dtype)
+        out_path = os.path.join(tmp, "out")
+        nbytes = lhs.nbytes
+
+        def measure(name, run, moved_bytes):
+            start = time.perf_counter()
+            run()
+            results[name] = moved_bytes / (time.perf_counter() - start) / 1e9
+
+        add = StreamingExecutor(
+            load(build_add(tile_rows, cols, dtype)),
+            "add",
+            tile_rows,
+            out_params=True,
+            prefetch=prefetch_depth,
+        )
+        measure(
+            "add streaming", lambda: add.map(lhs, rhs, out_path=out_path), 3 * nbytes
+        )
+        whole_add = load(build_add(rows, cols, dtype))
+        out = np.memmap(out_path, dtype=np_dtype, mode="w+", shape=(rows, cols))
+        measure("add whole", lambda: whole_add.add(lhs, rhs, out=out), 3 * nbytes)
+        del out
+
+        column_sum = StreamingExecutor(
+            load(build_column_sum(tile_rows, cols, dtype)),
+            "column_sum",
+            tile_rows,
+            out_params=True,
+            prefetch=prefetch_depth,
+        )
+        sums = np.empty(cols, np_dtype)
+        measure(
+            "column_sum streaming",
+            lambda: column_sum.reduce(lhs, out=sums),
+            nbytes,
+        )
+        whole_sum = load(build_column_sum(rows, cols, dtype))
+        measure(
+            "column_sum whole",
+            lambda: whole_sum.column_sum(lhs, out=np.empty(cols, np_dtype)),
+            nbytes,
+        )
+        np.testing.assert_allclose(sums, np.sum(lhs, axis=0), rtol=1e-3)
+        del lhs, rhs
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Streaming execution over memory-mapped arrays")
+    parser.add_argument("--rows", default=1 << 20, type=int)
+    parser.add_argument("--cols", default=256, type=int)
+    parser.add_argument("--tile-rows", default=4096, type=int)
+    parser.add_argument("--dtype", choices=list(ELEMENT_TYPES), default="f32")
+    parser.add_argument("--prefetch", default=1, type=int)
+    parser.add_argument("--tmp-dir", help="Directory of the memory-mapped files")
+    args = parser.parse_args()
+
+    check_streaming(dtype=args.dtype)
+    results = bench_streaming(
+        args.rows, args.cols, args.tile_rows, args.dtype, args.prefetch, args.tmp_dir
+    )
+    for name, gbps in results.items():
+        print(f"{name:24} {gbps:8.2f} GB/s")
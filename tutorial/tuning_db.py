@@ -0,0 +1,45 @@
+"""A persistent database of the best known lowering configuration per
+(op, shape, dtype), written by `autotune.py` and consulted by
+`linalg_tut.lower_matmul`.
+"""
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from config import TUNING_DB_PATH
+
+
+def db_key(op, shape, dtype):
+    return f"{op}:{'x'.join(map(str, shape))}:{dtype}"
+
+
+class TuningDatabase:
+    def __init__(self, path=TUNING_DB_PATH):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            self.entries = json.loads(self.path.read_text())
+
+    def lookup(self, op, shape, dtype):
+        """Returns the best known config (a dict of `lower_matmul` keyword
+        arguments plus the JIT `opt_level`), or None."""
+        entry = self.entries.get(db_key(op, shape, dtype))
+        return None if entry is None else entry["config"]
+
+    def record(self, op, shape, dtype, config, time_ns):
+        """Records `config` if it beats the best known time for the key.
+        Returns whether it did."""
+        key = db_key(op, shape, dtype)
+        entry = self.entries.get(key)
+        if entry is not None and entry["time_ns"] <= time_ns:
+            return False
+        self.entries[key] = {"config": config, "time_ns": time_ns}
+        return True
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)